@@ -0,0 +1,49 @@
+from zhongzi.ban import SmartBan, block_digests, block_senders
+from zhongzi.torrent import Block
+import hashlib
+import unittest
+
+
+class SmartBanTests(unittest.TestCase):
+    def test_single_sender_strikes(self):
+        ban = SmartBan(max_failures=2)
+        blocks = {0: ('10.0.0.1', b'a'), 1: ('10.0.0.1', b'b')}
+
+        self.assertEqual(ban.piece_failed(0, blocks), [])
+        self.assertEqual(ban.failures, {'10.0.0.1': 1})
+        self.assertFalse(ban.has_suspects(0))
+
+        self.assertEqual(ban.piece_failed(1, blocks), ['10.0.0.1'])
+        self.assertTrue(ban.is_banned('10.0.0.1'))
+        # 已经封禁的不再重复返回
+        self.assertEqual(ban.piece_failed(2, blocks), [])
+
+    def test_multiple_senders_compared_after_pass(self):
+        ban = SmartBan(max_failures=1)
+        failed = {0: ('10.0.0.1', b'bad'), 1: ('10.0.0.2', b'good1')}
+
+        self.assertEqual(ban.piece_failed(3, failed), [])
+        self.assertEqual(ban.failures, {})
+        self.assertTrue(ban.has_suspects(3))
+
+        self.assertEqual(ban.piece_passed(3, {0: b'good0', 1: b'good1'}), ['10.0.0.1'])
+        self.assertFalse(ban.has_suspects(3))
+        self.assertFalse(ban.is_banned('10.0.0.2'))
+
+    def test_no_senders(self):
+        ban = SmartBan()
+        self.assertEqual(ban.piece_failed(0, {}), [])
+        self.assertEqual(ban.piece_passed(0, {0: b'x'}), [])
+
+    def test_block_digests(self):
+        data = memoryview(b'a' * 4 + b'b' * 4)
+        blocks = [Block(0, 0, 4), Block(1, 4, 4)]
+
+        self.assertEqual(block_digests(data, blocks), {0: hashlib.sha1(b'aaaa').digest(),
+                                                       1: hashlib.sha1(b'bbbb').digest()})
+        self.assertEqual(block_senders(data, blocks, {1: '10.0.0.1'}),
+                         {1: ('10.0.0.1', hashlib.sha1(b'bbbb').digest())})
+
+
+if __name__ == '__main__':
+    unittest.main()
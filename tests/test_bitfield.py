@@ -0,0 +1,47 @@
+from zhongzi.bitfield import Bitfield
+import unittest
+
+
+class BitfieldTests(unittest.TestCase):
+    def test_from_bytes_bit_order(self):
+        bf = Bitfield.from_bytes(b'\x80\x01', 16)
+
+        self.assertEqual(list(bf), [0, 15])
+        self.assertIn(0, bf)
+        self.assertNotIn(1, bf)
+
+    def test_from_bytes_clears_spare_bits(self):
+        bf = Bitfield.from_bytes(b'\xff\xff', 10)
+
+        self.assertEqual(len(bf), 10)
+        self.assertEqual(bf.to_bytes(), b'\xff\xc0')
+        self.assertTrue(bf.all())
+
+    def test_add_discard(self):
+        bf = Bitfield(20)
+        bf.add(9)
+        bf.add(19)
+        bf.discard(9)
+
+        self.assertEqual(list(bf), [19])
+        with self.assertRaises(IndexError):
+            bf.add(20)
+
+    def test_set_operations(self):
+        a = Bitfield(12, [0, 3, 5, 11])
+        b = Bitfield(12, [3, 4, 11])
+
+        self.assertEqual(list(a & b), [3, 11])
+        self.assertEqual(list(a | b), [0, 3, 4, 5, 11])
+        self.assertEqual(list(a - b), [0, 5])
+
+    def test_first(self):
+        self.assertIsNone(Bitfield(9).first())
+        self.assertEqual(Bitfield(9, [8]).first(), 8)
+        self.assertEqual(Bitfield(9, [4, 8]).first_common(Bitfield(9, [8])), 8)
+
+    def test_full(self):
+        bf = Bitfield.full(3)
+
+        self.assertEqual(len(bf), 3)
+        self.assertEqual(bf.to_bytes(), b'\xe0')
@@ -0,0 +1,64 @@
+from zhongzi.buffers import BufferPool
+import unittest
+
+
+class BufferPoolTests(unittest.TestCase):
+    def test_budget_limits_buffers(self):
+        pool = BufferPool(buffer_size=16, budget=32)
+        a = pool.try_acquire()
+        b = pool.try_acquire()
+
+        self.assertIsNone(pool.try_acquire())
+        self.assertEqual(pool.in_use_bytes, 32)
+        self.assertIsNot(a, b)
+
+        pool.release(a)
+        self.assertIs(pool.try_acquire(), a)
+
+    def test_buffers_are_reused(self):
+        pool = BufferPool(buffer_size=16, budget=1024)
+        a = pool.try_acquire()
+        pool.release(a)
+
+        self.assertIs(pool.try_acquire(), a)
+        self.assertEqual(pool.stats()['allocated'], 16)
+
+    def test_budget_smaller_than_buffer(self):
+        pool = BufferPool(buffer_size=64, budget=10, preallocate=4)
+
+        self.assertEqual(pool.capacity, 1)
+        self.assertIsNotNone(pool.try_acquire())
+        self.assertIsNone(pool.try_acquire())
+
+    def test_reservations_share_budget(self):
+        pool = BufferPool(buffer_size=16, budget=32)
+        a = pool.try_acquire()
+        pool.release(a)
+
+        self.assertTrue(pool.try_reserve())
+        self.assertIsNotNone(pool.try_acquire())
+        # 空闲的缓冲区也不能超过预算借出
+        self.assertFalse(pool.try_reserve())
+        self.assertIsNone(pool.try_acquire())
+
+        pool.unreserve()
+        self.assertIsNotNone(pool.try_acquire())
+
+    def test_set_budget(self):
+        pool = BufferPool(buffer_size=16, budget=32)
+        a = pool.try_acquire()
+        b = pool.try_acquire()
+
+        pool.set_budget(48)
+        c = pool.try_acquire()
+        self.assertIsNotNone(c)
+        self.assertEqual(pool.in_use_bytes, 48)
+
+        # 变小之后归还的缓冲区不再复用
+        pool.set_budget(16)
+        pool.release(a)
+        pool.release(b)
+        self.assertIsNone(pool.try_acquire())
+        pool.release(c)
+        self.assertIs(pool.try_acquire(), c)
+        self.assertEqual(pool.stats()['allocated'], 16)
@@ -0,0 +1,92 @@
+from zhongzi.cache import BlockReadCache, FsyncPolicy, WriteBackCache
+from zhongzi.storage import Storage
+from zhongzi.torrent import Torrent
+import asyncio
+import os
+import tempfile
+import unittest
+
+
+class WriteBackCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent('nested.torrent')
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(self.torrent, self.dir.name)
+        self.storage.open()
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def piece(self, index: int) -> memoryview:
+        return memoryview(os.urandom(self.torrent.pieces[index].length))
+
+    def test_adjacent_pieces_are_merged(self):
+        cache = WriteBackCache(self.storage)
+        pieces = {i: self.piece(i) for i in (5, 0, 1, 2)}
+        for i, data in pieces.items():
+            cache.add(i, data, bytearray())
+
+        runs = cache.take()
+        cache.write(runs)
+
+        self.assertEqual([(start, len(datas)) for start, datas, _ in runs], [(0, 3), (5, 1)])
+        self.assertEqual(cache.writes, 2)
+        for i, data in pieces.items():
+            self.assertEqual(self.storage.read_piece(i), data)
+
+    def test_flush_thresholds(self):
+        cache = WriteBackCache(self.storage, max_bytes=2 * self.torrent.piece_length, max_age=60)
+        self.assertFalse(cache.should_flush(pressure=True))
+
+        cache.add(0, self.piece(0), bytearray())
+        self.assertFalse(cache.should_flush())
+        self.assertTrue(cache.should_flush(pressure=True))
+
+        cache.add(1, self.piece(1), bytearray())
+        self.assertTrue(cache.should_flush())
+
+    def test_fsync_policy(self):
+        self.assertEqual(FsyncPolicy('per-64-MB').every, 64 * 2**20)
+        self.assertEqual(FsyncPolicy('on-complete').every, 0)
+        with self.assertRaises(ValueError):
+            FsyncPolicy('sometimes')
+
+
+class BlockReadCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent('nested.torrent')
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(self.torrent, self.dir.name)
+        self.storage.open()
+        self.data = {i: os.urandom(self.torrent.piece_length) for i in range(4)}
+        for i, data in self.data.items():
+            self.storage.write_piece(i, data)
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def test_whole_piece_read_once(self):
+        cache = BlockReadCache(self.storage)
+
+        async def read_all():
+            return [bytes(await cache.read(1, begin, 1024)) for begin in range(0, 4096, 1024)]
+
+        blocks = asyncio.run(read_all())
+
+        self.assertEqual(b''.join(blocks), self.data[1][:4096])
+        self.assertEqual((cache.misses, cache.hits), (1, 3))
+
+    def test_lru_eviction(self):
+        cache = BlockReadCache(self.storage, max_bytes=2 * self.torrent.piece_length)
+
+        async def read(*indices):
+            for i in indices:
+                await cache.read(i, 0, 16)
+
+        asyncio.run(read(0, 1, 0, 2))
+
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+        self.assertIn(2, cache)
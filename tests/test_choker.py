@@ -0,0 +1,57 @@
+from zhongzi.choker import Choker
+from zhongzi.stats import RateMeter
+import unittest
+
+
+class FakePeer:
+    def __init__(self, name: str, interested: bool = True):
+        self.name = name
+        self.peer_interested = interested
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+
+    def __str__(self):
+        return self.name
+
+
+class ChokerTests(unittest.TestCase):
+    def setUp(self):
+        self.choker = Choker(upload_slots=3)
+        self.peers = [FakePeer(f'p{i}') for i in range(6)]
+
+    def test_fastest_downloaders_unchoked(self):
+        for i, peer in enumerate(self.peers):
+            peer.download_rate.update(i * 1000)
+
+        unchoke = self.choker.rechoke(self.peers)
+
+        self.assertLessEqual({self.peers[5], self.peers[4]}, unchoke)
+        self.assertEqual(len(unchoke), 3)
+        self.assertIn(self.choker.optimistic, unchoke)
+        self.assertNotIn(self.choker.optimistic, self.peers[4:])
+
+    def test_seeding_ranks_by_upload(self):
+        for i, peer in enumerate(self.peers):
+            peer.download_rate.update(i * 1000)
+            peer.upload_rate.update((5 - i) * 1000)
+
+        unchoke = self.choker.rechoke(self.peers, seeding=True)
+
+        self.assertLessEqual({self.peers[0], self.peers[1]}, unchoke)
+
+    def test_uninterested_peers_choked(self):
+        for peer in self.peers[1:]:
+            peer.peer_interested = False
+        self.peers[5].download_rate.update(10**6)
+
+        unchoke = self.choker.rechoke(self.peers)
+
+        self.assertEqual(unchoke, {self.peers[0]})
+
+    def test_optimistic_rotates(self):
+        seen = set()
+        for _ in range(30):
+            self.choker.rechoke(self.peers)
+            seen.add(self.choker.optimistic)
+
+        self.assertGreater(len(seen), 1)
@@ -0,0 +1,108 @@
+from aiohttp import web
+from zhongzi import bencode
+from zhongzi.bitfield import Bitfield
+from zhongzi.client import TorrentClient
+from zhongzi.picker import Priority
+from zhongzi.torrent import Torrent
+import asyncio
+import contextlib
+import os
+import tempfile
+import unittest
+
+
+class FilePriorityTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.torrent = Torrent('nested.torrent')
+        # 只要 practice/main.go，它和前后两个文件共用分片 431
+        priorities = [Priority.SKIP] * len(self.torrent.files)
+        priorities[4] = Priority.HIGH
+        self.client = TorrentClient(self.torrent, base_dir=self.dir.name, discovery=False, announce=False,
+                                    file_priorities=priorities)
+
+    async def asyncTearDown(self):
+        self.client.storage.close()
+        self.dir.cleanup()
+
+    async def test_boundary_pieces_are_selected(self):
+        picker = self.client.picker
+        self.assertEqual(list(picker.selected), [431])
+        self.assertEqual(picker.priorities[431], Priority.HIGH)
+        self.assertEqual(self.client.left, self.torrent.piece_length)
+        self.assertEqual(self.client.storage.skipped, set(range(len(self.torrent.files))) - {4})
+
+        self.client.storage.open()
+        self.assertFalse(os.path.exists(self.client.storage.path(3)))
+        self.client._mark_saved(Bitfield(len(self.torrent.pieces), [431]))
+        self.assertTrue(self.client.completed)
+
+    async def test_change_priority(self):
+        self.client.storage.open()
+        self.client.set_file_priority(5, Priority.LOW)
+
+        picker = self.client.picker
+        self.assertEqual(list(picker.selected), [431, 432, 433])
+        # 共用的分片取最高的优先级
+        self.assertEqual([picker.priorities[i] for i in (431, 432, 433)], [Priority.HIGH, Priority.LOW, Priority.LOW])
+        self.assertEqual(os.path.getsize(self.client.storage.path(5)), self.torrent.files[5].length)
+        self.assertFalse(self.client.completed)
+
+        with self.assertRaises(ValueError):
+            self.client.set_file_priorities([Priority.NORMAL])
+
+    async def test_priorities_fixed_after_download(self):
+        self.client.storage.open()
+        self.client._mark_saved(Bitfield(len(self.torrent.pieces), [431]))
+        await self.client.file_saver()
+
+        with self.assertRaises(ValueError):
+            self.client.set_file_priority(5, Priority.LOW)
+        self.assertEqual(list(self.client.picker.selected), [431])
+        self.assertTrue(self.client.completed)
+
+
+class AnnounceTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.announced = asyncio.Queue()
+
+        async def announce(request: web.Request) -> web.Response:
+            self.announced.put_nowait(dict(request.query))
+            return web.Response(body=bytes(bencode.Encoder({b'interval': 1800, b'peers': b''}).encode()))
+
+        app = web.Application()
+        app.router.add_get('/announce', announce)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        self.addAsyncCleanup(runner.cleanup)
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        self.torrent = Torrent('nested.torrent')
+        self.torrent.meta_info[b'announce'] = f'http://127.0.0.1:{runner.addresses[0][1]}/announce'.encode()
+
+    async def run_client(self, client: TorrentClient):
+        task = asyncio.create_task(client.start())
+
+        async def stop():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        self.addAsyncCleanup(stop)
+
+    async def test_announces_listening_port(self):
+        client = TorrentClient(self.torrent, base_dir=self.dir.name, discovery=False, listen_port=0)
+        await self.run_client(client)
+
+        query = await asyncio.wait_for(self.announced.get(), 5)
+        self.assertNotEqual(client.listener.port, 0)
+        self.assertEqual(int(query['port']), client.listener.port)
+
+    async def test_no_announce_without_listener(self):
+        client = TorrentClient(self.torrent, base_dir=self.dir.name, discovery=False, listen_port=None)
+        await self.run_client(client)
+
+        await asyncio.sleep(0.2)
+        self.assertIsNone(client.tracker)
+        self.assertTrue(self.announced.empty())
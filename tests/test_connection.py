@@ -0,0 +1,80 @@
+from zhongzi.connection import ConnectionManager
+import asyncio
+import unittest
+
+
+class ConnectionManagerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+        self.dead = set()
+        self.release = asyncio.Event()
+
+    async def connect(self, addr):
+        self.calls.append(addr)
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await self.release.wait()
+            if addr in self.dead:
+                raise ConnectionRefusedError('refused')
+            return object()
+        finally:
+            self.active -= 1
+
+    def start(self, manager: ConnectionManager):
+        self.task = asyncio.create_task(manager.run())
+
+    async def asyncTearDown(self):
+        self.task.cancel()
+
+    async def test_parallel_attempts_bounded(self):
+        manager = ConnectionManager(self.connect, max_connections=100, max_connecting=5)
+        manager.add_peers(('10.0.0.1', port) for port in range(20))
+        self.start(manager)
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.active, 5)
+        self.release.set()
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(manager.connected, 20)
+        self.assertEqual(self.max_active, 5)
+
+    async def test_connection_cap(self):
+        manager = ConnectionManager(self.connect, max_connections=3, max_connecting=10)
+        manager.add_peers(('10.0.0.1', port) for port in range(10))
+        self.release.set()
+        self.start(manager)
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(manager.connected, 3)
+        self.assertEqual(len(self.calls), 3)
+        self.assertFalse(manager.need_peers())
+
+        manager.disconnected(('10.0.0.1', 0))
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(manager.connected, 3)
+        self.assertEqual(len(self.calls), 4)
+
+    async def test_failed_peers_back_off(self):
+        manager = ConnectionManager(self.connect, base_backoff=0.05, max_failures=3)
+        self.dead.add(('10.0.0.2', 1))
+        manager.add_peers([('10.0.0.2', 1)])
+        self.release.set()
+        self.start(manager)
+        await asyncio.sleep(0.01)
+
+        record = manager.records[('10.0.0.2', 1)]
+        self.assertEqual(record.failures, 1)
+        self.assertEqual(record.last_error, 'refused')
+        self.assertEqual(len(self.calls), 1)
+
+        # 退避时间 0.05、0.1 秒之后再试，三次失败后放弃
+        await asyncio.sleep(0.5)
+        self.assertEqual(record.failures, 3)
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(manager.stats()['dead'], 1)
+        self.assertTrue(manager.need_peers())
@@ -0,0 +1,113 @@
+from zhongzi import message
+from zhongzi.extension import ExtendedHandshake, PeerExchange, PexMessage, decode_peers, encode_peers
+from zhongzi.peer import Peer, PeerListener
+from zhongzi.wire import PeerWireProtocol
+from tests.test_peer import FakeTransport, feed
+import asyncio
+import unittest
+
+
+class ExtensionMessageTests(unittest.TestCase):
+    def test_handshake_roundtrip(self):
+        data = ExtendedHandshake({'ut_pex': 1, 'ut_metadata': 2}, 6881, 'zhongzi').encode()
+        self.assertEqual(data, b'd1:md11:ut_metadatai2e6:ut_pexi1ee1:pi6881e1:v7:zhongzie')
+
+        handshake = ExtendedHandshake.decode(data)
+        self.assertEqual(handshake.extensions, {'ut_pex': 1, 'ut_metadata': 2})
+        self.assertEqual(handshake.listen_port, 6881)
+        self.assertEqual(handshake.client, 'zhongzi')
+
+    def test_disabled_extensions_ignored(self):
+        handshake = ExtendedHandshake.decode(b'd1:md6:ut_pexi0e11:ut_metadatai3eee')
+        self.assertEqual(handshake.extensions, {'ut_metadata': 3})
+        self.assertIsNone(handshake.listen_port)
+
+    def test_compact_peers(self):
+        v4, v6 = encode_peers([('10.0.0.1', 6881), ('::1', 51413)])
+        self.assertEqual(v4, b'\x0a\x00\x00\x01\x1a\xe1')
+        self.assertEqual(decode_peers(v4), [('10.0.0.1', 6881)])
+        self.assertEqual(decode_peers(v6, 6), [('::1', 51413)])
+        # 截断的尾部忽略
+        self.assertEqual(decode_peers(v4 + b'\x01\x02'), [('10.0.0.1', 6881)])
+
+    def test_pex_roundtrip(self):
+        pex = PexMessage.decode(PexMessage([('10.0.0.1', 1), ('::2', 2)], [('10.0.0.3', 3)]).encode())
+        self.assertEqual(pex.added, [('10.0.0.1', 1), ('::2', 2)])
+        self.assertEqual(pex.dropped, [('10.0.0.3', 3)])
+
+    def test_peer_exchange_sends_changes(self):
+        pex = PeerExchange(interval=60)
+        me = ('10.0.0.9', 9)
+        a, b = ('10.0.0.1', 1), ('10.0.0.2', 2)
+
+        first = pex.update(me, {me, a, b}, now=0)
+        self.assertEqual((first.added, first.dropped), ([a, b], []))
+        # 间隔不到一分钟不发送
+        self.assertIsNone(pex.update(me, {me, a}, now=30))
+
+        second = pex.update(me, {me, a}, now=61)
+        self.assertEqual((second.added, second.dropped), ([], [b]))
+        self.assertIsNone(pex.update(me, {me, a}, now=200))
+
+
+class Recorder(PeerListener):
+    def __init__(self):
+        self.handshakes = []
+        self.messages = []
+
+    def peer_extended_handshake(self, peer, handshake):
+        self.handshakes.append(handshake)
+
+    def peer_extension_message(self, peer, name, payload):
+        self.messages.append((name, payload))
+
+
+class PeerExtensionTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.listener = Recorder()
+        self.peer = Peer('-PC0001-000000000000', b'\x00' * 20, ('127.0.0.1', 0), listener=self.listener)
+        self.peer.protocol = PeerWireProtocol()
+        self.peer.protocol._handshake_done = True
+        self.transport = FakeTransport()
+        self.peer.protocol.connection_made(self.transport)
+        self.peer.writer = self.peer.protocol
+        self.peer.extended = True
+        self.peer._state_started()
+        self.run_task = asyncio.create_task(self.peer.run())
+
+    async def asyncTearDown(self):
+        self.run_task.cancel()
+
+    async def test_extension_messages_dispatched(self):
+        handshake = ExtendedHandshake({'ut_pex': 7}).encode()
+        feed(self.peer.protocol, message.Extended(0, handshake).encode() + message.Extended(1, b'pex').encode()
+             + message.Extended(9, b'unknown').encode())
+        await asyncio.sleep(0)
+
+        self.assertTrue(self.peer.supports('ut_pex'))
+        self.assertEqual(len(self.listener.handshakes), 1)
+        self.assertEqual(self.listener.messages, [('ut_pex', b'pex')])
+
+        await self.peer.send_extended('ut_pex', b'hello')
+        await self.peer.send_extended('ut_metadata', b'ignored')
+        self.assertEqual(self.transport.sent, [message.Extended(7, b'hello').encode()])
+
+
+    async def test_listen_port_in_handshake(self):
+        self.peer.listen_port = 6881
+        await self.peer.send_extended_handshake()
+        self.assertEqual(ExtendedHandshake.decode(self.transport.sent[0][6:]).listen_port, 6881)
+
+    async def test_inbound_peer_listen_addr(self):
+        self.assertEqual(self.peer.listen_addr, ('127.0.0.1', 0))
+
+        # 连进来的 peer 的源端口连不上，只用它声明的监听端口
+        self.peer.inbound = True
+        self.assertIsNone(self.peer.listen_addr)
+        feed(self.peer.protocol, message.Extended(0, ExtendedHandshake({}, listen_port=51413).encode()).encode())
+        await asyncio.sleep(0)
+        self.assertEqual(self.peer.listen_addr, ('127.0.0.1', 51413))
+
+
+if __name__ == '__main__':
+    unittest.main()
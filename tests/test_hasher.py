@@ -0,0 +1,48 @@
+from zhongzi.hasher import HashPipeline, PieceHasher
+from zhongzi.torrent import Piece
+import hashlib
+import unittest
+
+
+class PieceHasherTests(unittest.TestCase):
+    def test_in_order(self):
+        data = memoryview(b'abcdef')
+        hasher = PieceHasher(data)
+        hasher.block_received(0, 3)
+        hasher.block_received(3, 3)
+
+        self.assertTrue(hasher.complete)
+        self.assertEqual(hasher.digest(), hashlib.sha1(b'abcdef').digest())
+
+    def test_out_of_order(self):
+        hasher = PieceHasher(memoryview(b'abcdef'))
+        hasher.block_received(3, 3)
+        hasher.block_received(0, 3)
+
+        self.assertTrue(hasher.out_of_order)
+        self.assertFalse(hasher.complete)
+
+
+class HashPipelineTests(unittest.IsolatedAsyncioTestCase):
+    async def test_verify(self):
+        pipeline = HashPipeline()
+        data = memoryview(b'x' * 1000)
+        piece = Piece(0, 1000, 0, hashlib.sha1(data).digest())
+
+        self.assertTrue(await pipeline.verify(piece, data))
+        self.assertFalse(await pipeline.verify(Piece(1, 1000, 20, b'\x00' * 20), data))
+        self.assertEqual(pipeline.stats()['verified'], 1)
+        self.assertEqual(pipeline.stats()['failed'], 1)
+        self.assertEqual(pipeline.stats()['bytes_hashed'], 2000)
+        pipeline.close()
+
+    async def test_incremental_result_skips_thread_pool(self):
+        pipeline = HashPipeline()
+        data = memoryview(b'y' * 100)
+        hasher = PieceHasher(data)
+        hasher.block_received(0, 100)
+
+        self.assertTrue(await pipeline.verify(Piece(0, 100, 0, hashlib.sha1(data).digest()), data, hasher))
+        self.assertEqual(pipeline.stats()['incremental'], 1)
+        self.assertEqual(pipeline.stats()['bytes_hashed'], 0)
+        pipeline.close()
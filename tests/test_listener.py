@@ -0,0 +1,93 @@
+from zhongzi import message
+from zhongzi.bitfield import Bitfield
+from zhongzi.connection import ConnectionManager
+from zhongzi.listener import InboundListener
+from zhongzi.peer import Peer
+from zhongzi.utp import UTPEndpoint
+from zhongzi.wire import PeerWireProtocol
+import asyncio
+import struct
+import unittest
+
+
+INFO_HASH = b'\x02' * 20
+
+
+def handshake(info_hash: bytes = INFO_HASH) -> bytes:
+    return struct.pack('>B19s8s20s20s', 19, b'BitTorrent protocol', bytes(8), info_hash, b'-XX0001-000000000000')
+
+
+class InboundListenerTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.listener = InboundListener('127.0.0.1', 0, handshake_timeout=1)
+        await self.listener.start()
+        self.peers = []
+        self.listener.register(INFO_HASH, self.accept)
+
+    async def asyncTearDown(self):
+        self.listener.close()
+        for peer in self.peers:
+            peer.close()
+
+    async def accept(self, protocol: PeerWireProtocol, addr):
+        peer = Peer('-PC0001-000000000000', INFO_HASH, addr)
+        pieces = Bitfield(8)
+        pieces.add(1)
+        await peer.connect(pieces, protocol=protocol)
+        self.peers.append(peer)
+
+    async def test_routes_by_info_hash(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.listener.port)
+        writer.write(handshake())
+        reply = await asyncio.wait_for(reader.readexactly(68), 5)
+        self.assertEqual(reply[28:48], INFO_HASH)
+        self.assertEqual(reply[48:], b'-PC0001-000000000000')
+
+        # 握手之后是 Bitfield 和 Interested
+        length, id = struct.unpack('>IB', await reader.readexactly(5))
+        self.assertEqual(id, message.PeerMessage.Bitfield.value)
+        await reader.readexactly(length - 1)
+        self.assertEqual(self.listener.accepted, 1)
+        self.assertEqual(self.peers[0].addr, writer.get_extra_info('sockname')[:2])
+        writer.close()
+
+    async def test_unknown_info_hash_is_closed(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.listener.port)
+        writer.write(handshake(b'\x03' * 20))
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        self.assertEqual(self.listener.rejected, 1)
+        writer.close()
+
+    async def test_handshake_timeout(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.listener.port)
+        self.assertEqual(await asyncio.wait_for(reader.read(), 5), b'')
+        self.assertEqual(self.listener.rejected, 1)
+        writer.close()
+
+    async def test_utp_connections(self):
+        server = await UTPEndpoint.create(('127.0.0.1', 0), accept=self.listener.protocol_factory)
+        client = await UTPEndpoint.create(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        peer = Peer('-XX0001-000000000000', INFO_HASH, server.local_addr, utp=client)
+        await asyncio.wait_for(peer.connect(Bitfield(8)), 5)
+        self.peers.append(peer)
+        while not self.listener.accepted:
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.peers[0].stats()['transport'], 'tcp')
+
+
+class AcceptedConnectionTests(unittest.IsolatedAsyncioTestCase):
+    async def test_incoming_connections_count_and_are_not_redialled(self):
+        async def connect(addr):
+            raise AssertionError('should not dial')
+
+        manager = ConnectionManager(connect, max_connections=1)
+        self.assertTrue(manager.accepted(('10.0.0.1', 50000), object()))
+        self.assertFalse(manager.accepted(('10.0.0.2', 50000), object()))
+        self.assertEqual(manager.stats()['incoming'], 1)
+
+        manager.disconnected(('10.0.0.1', 50000))
+        self.assertEqual(manager.connected, 0)
+        self.assertNotIn(('10.0.0.1', 50000), manager.records)
@@ -0,0 +1,140 @@
+from zhongzi import message
+from zhongzi.extension import (METADATA_DATA, METADATA_PIECE_SIZE, METADATA_REJECT, METADATA_REQUEST,
+                               ExtendedHandshake, MetadataMessage)
+from zhongzi.magnet import MagnetLink, MetadataFetcher
+from zhongzi.peer import Peer
+from zhongzi.torrent import Torrent
+from zhongzi.wire import PeerWireProtocol
+from tests.test_peer import FakeTransport
+import asyncio
+import base64
+import hashlib
+import unittest
+
+
+class MagnetLinkTests(unittest.TestCase):
+    def test_parse(self):
+        info_hash = bytes(range(20))
+        link = MagnetLink.parse(f'magnet:?xt=urn:btih:{info_hash.hex()}&dn=hello&tr=http%3A%2F%2Ft.example%2Fannounce'
+                                f'&x.pe=10.0.0.1:6881&x.pe=[::1]:51413')
+        self.assertEqual(link.info_hash, info_hash)
+        self.assertEqual(link.name, 'hello')
+        self.assertEqual(link.trackers, ['http://t.example/announce'])
+        self.assertEqual(link.peers, [('10.0.0.1', 6881), ('::1', 51413)])
+
+    def test_base32_and_bare_hash(self):
+        info_hash = bytes(range(20))
+        b32 = base64.b32encode(info_hash).decode().lower()
+        self.assertEqual(MagnetLink.parse(f'magnet:?xt=urn:btih:{b32}').info_hash, info_hash)
+        self.assertEqual(MagnetLink.parse(info_hash.hex().upper()).info_hash, info_hash)
+        with self.assertRaises(ValueError):
+            MagnetLink.parse('magnet:?dn=nothing')
+
+    def test_torrent_from_info(self):
+        torrent = Torrent('nested.torrent')
+        t = Torrent.from_info(torrent.info_bytes, ['http://t.example/announce'])
+
+        self.assertEqual(t.info_hash, torrent.info_hash)
+        self.assertEqual(t.total_size, torrent.total_size)
+        self.assertEqual([p.checksum for p in t.pieces], [p.checksum for p in torrent.pieces])
+        self.assertEqual(t.announce, 'http://t.example/announce')
+        self.assertIsNone(Torrent.from_info(torrent.info_bytes).announce)
+
+
+def metadata_requests(transport: FakeTransport):
+    requests = []
+    for data in transport.sent:
+        if data[4] == message.PeerMessage.Extended.value:
+            msg = MetadataMessage.decode(data[6:])
+            if msg.msg_type == METADATA_REQUEST:
+                requests.append(msg.piece)
+    return requests
+
+
+class MetadataFetcherTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.info = bytes(range(256)) * 200
+        self.fetcher = MetadataFetcher(hashlib.sha1(self.info).digest(), '-PC0001-000000000000')
+        self.fetcher._done = asyncio.get_running_loop().create_future()
+
+    def make_peer(self, port: int) -> Peer:
+        peer = Peer('-PC0001-000000000000', self.fetcher.info_hash, ('10.0.0.1', port), listener=self.fetcher)
+        peer.protocol = PeerWireProtocol()
+        peer.transport = FakeTransport()
+        peer.protocol.connection_made(peer.transport)
+        peer.writer = peer.protocol
+        peer.extended = True
+        peer._state_started()
+        self.fetcher.peers.append(peer)
+        peer.extensions = {'ut_metadata': 3}
+        self.fetcher.peer_extended_handshake(peer, ExtendedHandshake(peer.extensions, metadata_size=len(self.info)))
+        return peer
+
+    def data(self, piece: int, info: bytes | None = None) -> bytes:
+        info = info or self.info
+        chunk = info[piece * METADATA_PIECE_SIZE:(piece + 1) * METADATA_PIECE_SIZE]
+        return MetadataMessage(METADATA_DATA, piece, len(info), chunk).encode()
+
+    async def test_fetch_from_several_peers(self):
+        a = self.make_peer(1)
+        b = self.make_peer(2)
+        await asyncio.sleep(0)
+        # 4 块，每个 peer 最多 2 个请求
+        self.assertEqual(metadata_requests(a.transport), [0, 1])
+        self.assertEqual(metadata_requests(b.transport), [2, 3])
+
+        # b 拒绝了一块，换给 a
+        self.fetcher.peer_extension_message(b, 'ut_metadata', MetadataMessage(METADATA_REJECT, 3).encode())
+        for piece in (0, 1):
+            self.fetcher.peer_extension_message(a, 'ut_metadata', self.data(piece))
+        await asyncio.sleep(0)
+        self.assertEqual(metadata_requests(a.transport), [0, 1, 3])
+
+        self.fetcher.peer_extension_message(b, 'ut_metadata', self.data(2))
+        self.fetcher.peer_extension_message(a, 'ut_metadata', self.data(3))
+        self.assertEqual(await self.fetcher._done, self.info)
+
+    async def test_bad_metadata_fetched_again(self):
+        a = self.make_peer(1)
+        self.fetcher.max_requests = 4
+        await asyncio.sleep(0)
+        bad = b'x' * len(self.info)
+        for piece in range(4):
+            self.fetcher.peer_extension_message(a, 'ut_metadata', self.data(piece, bad))
+        await asyncio.sleep(0)
+
+        self.assertEqual(self.fetcher.hash_failures, 1)
+        self.assertFalse(self.fetcher._done.done())
+        self.assertEqual(self.fetcher._received, {})
+        # 坏数据全部来自 a，断开它
+        self.assertTrue(a.transport.closed)
+
+    async def test_disagreeing_peer_dropped(self):
+        a = self.make_peer(1)
+        b = Peer('-PC0001-000000000000', self.fetcher.info_hash, ('10.0.0.2', 2), listener=self.fetcher)
+        b.protocol = PeerWireProtocol()
+        b.transport = FakeTransport()
+        b.protocol.connection_made(b.transport)
+        b.extensions = {'ut_metadata': 3}
+        self.fetcher.peers.append(b)
+        self.fetcher.peer_extended_handshake(b, ExtendedHandshake(b.extensions, metadata_size=len(self.info) + 1))
+        self.assertTrue(b.transport.closed)
+        self.assertEqual(self.fetcher.metadata_size, len(self.info))
+
+        # 声明这个大小的 peer 都走了，下一个 peer 重新决定大小
+        self.fetcher.peer_closed(b)
+        self.fetcher.peer_closed(a)
+        self.assertIsNone(self.fetcher.metadata_size)
+        self.assertEqual(self.fetcher._requested, {})
+        c = self.make_peer(3)
+        self.assertEqual(self.fetcher.metadata_size, len(self.info))
+        await asyncio.sleep(0)
+        self.assertEqual(metadata_requests(c.transport), [0, 1])
+
+    async def test_fetch_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.fetcher.fetch(timeout=0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+from zhongzi import message
+from zhongzi.bitfield import Bitfield
+from zhongzi.peer import Peer, PeerListener, RequestCancelled, RequestRejected, allowed_fast_set
+from zhongzi.wire import PeerWireProtocol
+import asyncio
+import struct
+import unittest
+
+
+class FakeTransport(asyncio.Transport):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+        self.cancels = []
+        # 其他消息原样记录
+        self.sent = []
+        self.closed = False
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        self.closed = True
+
+    def write(self, data: bytes):
+        id = data[4]
+        if id not in (message.PeerMessage.Request.value, message.PeerMessage.Cancel.value):
+            self.sent.append(bytes(data))
+            return
+        _, id, index, begin, length = struct.unpack('>IbIII', data)
+        if id == message.PeerMessage.Cancel.value:
+            self.cancels.append((index, begin, length))
+        else:
+            self.requests.append((index, begin, length))
+
+
+def piece_message(index: int, begin: int, block: bytes) -> bytes:
+    return struct.pack('>IbII', 9 + len(block), message.PeerMessage.Piece.value, index, begin) + block
+
+
+def feed(protocol: PeerWireProtocol, data: bytes):
+    while data:
+        buf = protocol.get_buffer(-1)
+        n = min(len(buf), len(data))
+        buf[:n] = data[:n]
+        protocol.buffer_updated(n)
+        data = data[n:]
+
+
+class RequestTests(unittest.IsolatedAsyncioTestCase):
+    def make_peer(self, depth: int) -> Peer:
+        peer = Peer('-PC0001-000000000000', b'\x00' * 20, ('127.0.0.1', 0), pipeline_depth=depth)
+        peer.protocol = PeerWireProtocol()
+        peer.protocol._handshake_done = True
+        self.transport = FakeTransport()
+        peer.protocol.connection_made(self.transport)
+        peer.writer = peer.protocol
+        peer._state_started()
+        return peer
+
+    async def test_request_slots(self):
+        peer = self.make_peer(depth=2)
+        peer.request_block(0, 0, 2**14)
+
+        self.assertEqual(self.transport.requests, [(0, 0, 2**14)])
+        self.assertEqual(peer.request_slots(), 1)
+
+    async def test_blocks_written_into_piece_buffer(self):
+        peer = self.make_peer(depth=4)
+        run = asyncio.create_task(peer.run())
+        buf = bytearray(2**14 + 100)
+        view = memoryview(buf)
+
+        first = peer.request_block(0, 0, 2**14, view[:2**14])
+        second = peer.request_block(0, 2**14, 100, view[2**14:])
+        feed(peer.protocol, piece_message(0, 2**14, b'b' * 100) + piece_message(0, 0, b'a' * 2**14))
+
+        self.assertEqual(len(await first), 2**14)
+        self.assertEqual(len(await second), 100)
+        self.assertEqual(buf, b'a' * 2**14 + b'b' * 100)
+        self.assertEqual(peer.futures, {})
+        run.cancel()
+
+    async def test_cancel_block(self):
+        peer = self.make_peer(depth=2)
+        buf = bytearray(2**14)
+        future = peer.request_block(1, 0, 2**14, memoryview(buf))
+
+        peer.cancel_block(1, 0)
+        with self.assertRaises(RequestCancelled):
+            await future
+        self.assertEqual(self.transport.cancels, [(1, 0, 2**14)])
+        self.assertEqual(peer.futures, {})
+        self.assertEqual(peer.protocol._destinations, {})
+
+    async def test_drop_requests_sends_no_cancel(self):
+        peer = self.make_peer(depth=2)
+        futures = [peer.request_block(1, 0, 2**14), peer.request_block(1, 2**14, 2**14)]
+
+        peer.drop_requests()
+        for future in futures:
+            with self.assertRaises(RequestCancelled):
+                await future
+        self.assertEqual(self.transport.cancels, [])
+
+
+class BlockSource(PeerListener):
+    def __init__(self):
+        self.reads = []
+        self.gate: asyncio.Event | None = None
+
+    async def read_block(self, peer, piece_index, begin, length):
+        self.reads.append((piece_index, begin, length))
+        if self.gate is not None:
+            await self.gate.wait()
+        return bytes([piece_index]) * length
+
+
+def request_message(index: int, begin: int, length: int) -> bytes:
+    return message.Request(index, begin, length).encode()
+
+
+class UploadTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.source = BlockSource()
+        self.peer = Peer('-PC0001-000000000000', b'\x00' * 20, ('127.0.0.1', 0), listener=self.source)
+        self.peer.protocol = PeerWireProtocol()
+        self.peer.protocol._handshake_done = True
+        self.transport = FakeTransport()
+        self.peer.protocol.connection_made(self.transport)
+        self.peer.writer = self.peer.protocol
+        self.peer._state_started()
+        self.run_task = asyncio.create_task(self.peer.run())
+
+    async def asyncTearDown(self):
+        self.run_task.cancel()
+
+    async def test_serves_requests_when_unchoked(self):
+        await self.peer.unchoke()
+        feed(self.peer.protocol, request_message(2, 0, 16) + request_message(2, 16, 16))
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.transport.sent, [
+            message.Unchoke().encode(),
+            message.Piece(2, 0, b'\x02' * 16).encode(),
+            message.Piece(2, 16, b'\x02' * 16).encode(),
+        ])
+        self.assertEqual(self.peer.uploaded, 32)
+
+    async def test_ignores_requests_when_choking(self):
+        feed(self.peer.protocol, request_message(2, 0, 16))
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.source.reads, [])
+        self.assertEqual(self.transport.sent, [])
+
+    async def test_cancel_while_reading(self):
+        await self.peer.unchoke()
+        self.source.gate = asyncio.Event()
+        feed(self.peer.protocol, request_message(1, 0, 16) + request_message(1, 16, 16))
+        await asyncio.sleep(0.01)
+        feed(self.peer.protocol, message.Cancel(1, 0, 16).encode() + message.Cancel(1, 16, 16).encode())
+        self.source.gate.set()
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.source.reads, [(1, 0, 16)])
+        self.assertEqual(self.transport.sent, [message.Unchoke().encode()])
+
+    async def test_interest_tracked(self):
+        feed(self.peer.protocol, message.Interested().encode())
+        await asyncio.sleep(0)
+        self.assertTrue(self.peer.peer_interested)
+
+        feed(self.peer.protocol, message.NotInterested().encode())
+        await asyncio.sleep(0)
+        self.assertFalse(self.peer.peer_interested)
+
+
+class FastExtensionTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.source = BlockSource()
+        self.peer = Peer('-PC0001-000000000000', b'\x00' * 20, ('127.0.0.1', 0), listener=self.source,
+                         num_pieces=8)
+        self.peer.protocol = PeerWireProtocol()
+        self.peer.protocol._handshake_done = True
+        self.transport = FakeTransport()
+        self.peer.protocol.connection_made(self.transport)
+        self.peer.writer = self.peer.protocol
+        self.peer.fast = True
+        self.peer._state_started()
+        self.peer._state_choked()
+        self.run_task = asyncio.create_task(self.peer.run())
+
+    async def asyncTearDown(self):
+        self.run_task.cancel()
+
+    def test_allowed_fast_set(self):
+        # BEP 6 里的例子
+        info_hash = b'\xaa' * 20
+        self.assertEqual(allowed_fast_set('80.4.4.200', info_hash, 1313, 7),
+                         [1059, 431, 808, 1217, 287, 376, 1188])
+        self.assertEqual(allowed_fast_set('80.4.4.200', info_hash, 1313, 9),
+                         [1059, 431, 808, 1217, 287, 376, 1188, 353, 508])
+        self.assertEqual(allowed_fast_set('::1', info_hash, 1313), [])
+
+    async def test_have_all(self):
+        feed(self.peer.protocol, message.HaveAll().encode())
+        await asyncio.sleep(0)
+        self.assertTrue(self.peer.remote_pieces().all())
+
+    async def test_pieces_ignored_before_metadata(self):
+        # 从磁力链接下载元数据时还不知道分片数量
+        self.peer._num_pieces = 0
+        self.peer._remote_pieces = Bitfield(0)
+        with self.assertNoLogs(level='WARNING'):
+            feed(self.peer.protocol, message.Have(piece_index=5).encode() + message.Bitfield(b'\xff').encode()
+                 + message.HaveAll().encode())
+            await asyncio.sleep(0)
+        self.assertEqual(self.peer.remote_pieces().size, 0)
+
+    async def test_reject_fails_request_at_once(self):
+        future = self.peer.request_block(3, 0, 2**14)
+        feed(self.peer.protocol, message.RejectRequest(3, 0, 2**14).encode())
+        await asyncio.sleep(0)
+
+        self.assertIsInstance(future.exception(), RequestRejected)
+        self.assertEqual(self.peer.futures, {})
+        self.assertEqual(self.peer.rejected, 1)
+
+    async def test_allowed_fast_while_choked(self):
+        self.peer._remote_pieces = Bitfield(8, [1, 2])
+        self.assertFalse(self.peer.requestable_pieces())
+
+        feed(self.peer.protocol, message.AllowedFast(2).encode() + message.AllowedFast(5).encode())
+        await asyncio.sleep(0)
+        self.assertEqual(list(self.peer.requestable_pieces()), [2])
+
+    async def test_rejects_requests_when_choking(self):
+        self.peer._allowed_fast_sent = {4}
+        feed(self.peer.protocol, request_message(2, 0, 16) + request_message(4, 0, 16))
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.source.reads, [(4, 0, 16)])
+        self.assertEqual(self.transport.sent, [
+            message.RejectRequest(2, 0, 16).encode(),
+            message.Piece(4, 0, b'\x04' * 16).encode(),
+        ])
+
+    async def test_choke_rejects_queued_requests(self):
+        await self.peer.unchoke()
+        self.source.gate = asyncio.Event()
+        feed(self.peer.protocol, request_message(1, 0, 16) + request_message(1, 16, 16))
+        await asyncio.sleep(0.01)
+        await self.peer.choke()
+        self.source.gate.set()
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.transport.sent, [
+            message.Unchoke().encode(),
+            message.Choke().encode(),
+            message.RejectRequest(1, 16, 16).encode(),
+            message.RejectRequest(1, 0, 16).encode(),
+        ])
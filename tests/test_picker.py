@@ -0,0 +1,165 @@
+from zhongzi.bitfield import Bitfield
+from zhongzi.picker import PiecePicker, Priority, SequentialStrategy, RandomFirstStrategy
+import unittest
+
+
+class RarestFirstTests(unittest.TestCase):
+    def test_nothing_available(self):
+        picker = PiecePicker(4)
+
+        self.assertIsNone(picker.pick())
+
+    def test_pick_rarest(self):
+        picker = PiecePicker(4)
+        picker.add_peer_pieces([0, 1, 2, 3])
+        picker.add_peer_pieces([0, 1, 3])
+        picker.add_peer_pieces([0, 3])
+
+        self.assertIn(picker.pick(), (2, 3, 4, 5))
+        self.assertEqual(picker.pick(), 1)
+
+    def test_pick_respects_peer(self):
+        picker = PiecePicker(4)
+        picker.add_peer_pieces([0, 1, 3])
+
+        self.assertIn(picker.pick(Bitfield(4, [1, 3])), (1, 3))
+        self.assertIsNone(picker.pick(Bitfield(4, [2])))
+
+    def test_abort_returns_piece(self):
+        picker = PiecePicker(2)
+        picker.add_peer_pieces([0])
+
+        self.assertEqual(picker.pick(), 0)
+        self.assertIsNone(picker.pick())
+
+        picker.abort(0)
+        self.assertEqual(picker.pick(), 0)
+
+    def test_remove_peer_pieces(self):
+        picker = PiecePicker(2)
+        picker.add_peer_pieces([0, 1])
+        picker.remove_peer_pieces([0])
+
+        self.assertEqual(picker.availability, [0, 1])
+        self.assertEqual(picker.pick(), 1)
+
+    def test_complete(self):
+        picker = PiecePicker(1)
+        picker.add_peer_pieces([0])
+        picker.complete(picker.pick())
+
+        self.assertTrue(picker.finished)
+
+
+class StrategyTests(unittest.TestCase):
+    def test_sequential(self):
+        picker = PiecePicker(4, SequentialStrategy())
+        picker.add_peer_pieces([3, 1, 2])
+
+        self.assertEqual([picker.pick(), picker.pick(), picker.pick()], [1, 2, 3])
+
+    def test_random_first_falls_back_to_rarest(self):
+        picker = PiecePicker(4, RandomFirstStrategy(n=1))
+        picker.add_peer_pieces([0, 1, 2, 3])
+        picker.add_peer_pieces([0, 1, 3])
+        picker.complete(0)
+
+        self.assertIn(picker.pick(), (2, 3, 4, 5))
+
+    def test_sequential_with_peer(self):
+        picker = PiecePicker(4, SequentialStrategy())
+        picker.add_peer_pieces([0, 1, 2, 3])
+
+        self.assertEqual(picker.pick(Bitfield(4, [2, 3])), 2)
+
+    def test_interesting(self):
+        picker = PiecePicker(4)
+        picker.complete(1)
+
+        self.assertEqual(picker.interesting(Bitfield(4, [1, 3])), 3)
+        self.assertIsNone(picker.interesting(Bitfield(4, [1])))
+
+
+class DeadlineTests(unittest.TestCase):
+    def test_earliest_deadline_first(self):
+        picker = PiecePicker(4)
+        picker.add_peer_pieces([0, 1, 2, 3])
+        picker.add_peer_pieces([0, 1, 2])
+        picker.set_deadline(1, 20.0)
+        picker.set_deadline(2, 10.0)
+
+        self.assertEqual(picker.pick(Bitfield(4, [0, 1, 3])), 1)
+        self.assertIn(picker.pick(), (2, 3, 4, 5))
+        # 没有截止时间的分片按原来的策略选
+        self.assertEqual(picker.pick(), 3)
+
+    def test_complete_clears_deadline(self):
+        picker = PiecePicker(2)
+        picker.add_peer_pieces([0, 1])
+        picker.set_deadline(1, 1.0)
+        picker.complete(picker.pick())
+
+        self.assertEqual(picker.deadlines, {})
+        picker.set_deadline(1, 1.0)
+        self.assertEqual(picker.deadlines, {})
+
+
+class PriorityTests(unittest.TestCase):
+    def test_skipped_pieces_are_not_picked(self):
+        picker = PiecePicker(4)
+        picker.add_peer_pieces([0, 1, 2, 3])
+        picker.set_priorities([Priority.NORMAL, Priority.SKIP, Priority.SKIP, Priority.NORMAL])
+
+        picked = {picker.pick(), picker.pick()}
+        self.assertEqual(picked, {0, 3})
+        self.assertIsNone(picker.pick())
+        self.assertIsNone(picker.interesting(Bitfield(4, [1, 2])))
+
+        for index in picked:
+            picker.complete(index)
+        self.assertTrue(picker.finished)
+
+    def test_higher_priority_first(self):
+        picker = PiecePicker(4)
+        picker.add_peer_pieces([0, 1, 2, 3])
+        picker.add_peer_pieces([0, 1, 3])
+        picker.set_priorities([Priority.HIGH, Priority.LOW, Priority.NORMAL, Priority.HIGH])
+
+        # 分片 2 最稀有，但优先级更低
+        self.assertEqual({picker.pick(), picker.pick()}, {0, 3})
+        self.assertIn(picker.pick(), (2, 3, 4, 5))
+        self.assertEqual(picker.pick(), 1)
+
+    def test_change_while_downloading(self):
+        picker = PiecePicker(3)
+        picker.add_peer_pieces([0, 1, 2])
+        picker.set_priorities([Priority.SKIP, Priority.SKIP, Priority.NORMAL])
+        self.assertIn(picker.pick(), (2, 3, 4, 5))
+
+        # 下载中的分片改成跳过也让它下载完，但失败后不再放回去
+        picker.set_priorities([Priority.NORMAL, Priority.SKIP, Priority.SKIP])
+        picker.abort(2)
+        self.assertEqual(picker.pick(), 0)
+        self.assertIsNone(picker.pick())
+        self.assertFalse(picker.finished)
+        picker.complete(0)
+        self.assertTrue(picker.finished)
+
+    def test_sequential_honours_priority(self):
+        picker = PiecePicker(4, SequentialStrategy())
+        picker.add_peer_pieces([0, 1, 2, 3])
+        picker.set_priorities([Priority.LOW, Priority.NORMAL, Priority.SKIP, Priority.HIGH])
+
+        self.assertEqual([picker.pick(), picker.pick(), picker.pick(), picker.pick()], [3, 1, 0, None])
+
+    def test_bucket_order_follows_changes(self):
+        picker = PiecePicker(8)
+        picker.add_peer_pieces([0, 1, 2, 3, 4, 5])
+        picker.add_peer_pieces([0, 1, 2])
+        picker.set_priorities([Priority.LOW, Priority.HIGH] + [Priority.NORMAL] * 6)
+        picker.remove_peer_pieces([0, 1, 2])
+        picker.complete(picker.pick())
+        picker.abort(picker.pick())
+
+        self.assertEqual(picker._order, sorted((-p, level) for p, level in picker._buckets))
+        self.assertIn(picker.pick(), (2, 3, 4, 5))
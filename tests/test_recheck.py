@@ -0,0 +1,64 @@
+from zhongzi.recheck import Recheck
+from zhongzi.storage import Storage
+from zhongzi.torrent import Torrent
+import asyncio
+import hashlib
+import os
+import tempfile
+import unittest
+
+
+class RecheckTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent('nested.torrent')
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(self.torrent, self.dir.name)
+        self.storage.open()
+        # 写入随机数据，并把对应分片的 checksum 改成这些数据的
+        for index in (0, 1, 2, 5, 400):
+            data = os.urandom(self.torrent.pieces[index].length)
+            self.storage.write_piece(index, data)
+            self.torrent.pieces[index].checksum = hashlib.sha1(data).digest()
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def test_finds_valid_pieces(self):
+        recheck = Recheck(self.storage, workers=4, chunk_size=2**16)
+        progress = []
+
+        valid = asyncio.run(recheck.run(progress=lambda r: progress.append(r.checked)))
+
+        self.assertEqual(list(valid), [0, 1, 2, 5, 400])
+        self.assertEqual(recheck.checked, len(self.torrent.pieces))
+        self.assertEqual(recheck.valid, 5)
+        self.assertEqual(progress[-1], len(self.torrent.pieces))
+        self.assertGreater(recheck.throughput, 0)
+
+    def test_subset_of_pieces(self):
+        recheck = Recheck(self.storage)
+
+        valid = asyncio.run(recheck.run([1, 3, 400]))
+
+        self.assertEqual(list(valid), [1, 400])
+        self.assertEqual(recheck.checked, 3)
+
+    def test_process_pool(self):
+        recheck = Recheck(self.storage, workers=2, executor='process')
+
+        valid = asyncio.run(recheck.run(range(10)))
+
+        self.assertEqual(list(valid), [0, 1, 2, 5])
+
+    def test_missing_file_not_read(self):
+        self.storage.close()
+        path = self.storage.path(0)
+        os.remove(path)
+
+        recheck = Recheck(self.storage)
+        valid = asyncio.run(recheck.run(range(10)))
+
+        # 分片 0 从 .DS_Store 开始
+        self.assertEqual(list(valid), [1, 2, 5])
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,118 @@
+from zhongzi import resume
+from zhongzi.bitfield import Bitfield
+from zhongzi.client import TorrentClient
+from zhongzi.storage import Storage
+from zhongzi.torrent import Torrent
+import asyncio
+import os
+import tempfile
+import unittest
+
+
+class ResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent('nested.torrent')
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(self.torrent, self.dir.name)
+        self.storage.open()
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def resume_data(self, pieces=(0, 1), partial=None) -> resume.ResumeData:
+        n = len(self.torrent.pieces)
+        return resume.ResumeData(self.torrent.info_hash, Bitfield(n, pieces), partial or {},
+                                 resume.file_states(self.storage))
+
+    def test_round_trip(self):
+        partial = {5: Bitfield(1, [0])}
+        resume.save(self.storage, self.resume_data(partial=partial))
+
+        data = resume.load(self.storage)
+
+        self.assertEqual(list(data.pieces), [0, 1])
+        self.assertEqual(list(data.partial), [5])
+        self.assertEqual(list(data.partial[5]), [0])
+        self.assertEqual(data.files, resume.file_states(self.storage))
+        self.assertFalse(os.path.exists(resume.resume_path(self.storage) + '.tmp'))
+
+    def test_load_ignores_other_torrent(self):
+        data = self.resume_data()
+        data.info_hash = b'\x00' * 20
+        resume.save(self.storage, data)
+
+        self.assertIsNone(resume.load(self.storage))
+
+    def test_load_ignores_broken_file(self):
+        with open(resume.resume_path(self.storage), 'wb') as f:
+            f.write(b'd4:piec')
+
+        self.assertIsNone(resume.load(self.storage))
+
+    def test_changed_files(self):
+        data = self.resume_data()
+        with open(self.storage.path(1), 'r+b') as f:
+            f.write(b'x')
+        os.utime(self.storage.path(1), ns=(0, 0))
+
+        self.assertEqual(resume.changed_files(self.storage, data), {1})
+
+
+class ClientResumeTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent('nested.torrent')
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def start(self, client: TorrentClient):
+        async def run():
+            await asyncio.to_thread(client.storage.open)
+            await client.load_resume()
+        asyncio.run(run())
+
+    def save(self, pieces, partial=None):
+        client = TorrentClient(self.torrent, base_dir=self.dir.name)
+        self.start(client)
+        for index in pieces:
+            client.saved_pieces.add(index)
+        client.scheduler.resumed.update(partial or {})
+        asyncio.run(client.save_resume())
+        client.storage.close()
+
+    def test_trusts_unchanged_files(self):
+        self.save([0, 1], {2: Bitfield(1, [0])})
+
+        client = TorrentClient(self.torrent, base_dir=self.dir.name)
+        self.start(client)
+        client.storage.close()
+
+        self.assertEqual(list(client.picker.done), [0, 1])
+        self.assertEqual(list(client.saved_pieces), [0, 1])
+        self.assertEqual(list(client.scheduler.resumed), [2])
+
+    def test_save_follows_fsync_policy(self):
+        for policy, unsynced, expected in (('never', 2**30, 0), ('per-1-MB', 2**10, 0), ('per-1-MB', 2**20, 1)):
+            with self.subTest(policy=policy, unsynced=unsynced):
+                client = TorrentClient(self.torrent, base_dir=self.dir.name, fsync=policy)
+                self.start(client)
+                syncs = []
+                client.storage.sync = lambda: syncs.append(1)
+                client.write_cache._unsynced = unsynced
+                asyncio.run(client.save_resume())
+                client.storage.close()
+                self.assertEqual(len(syncs), expected)
+
+    def test_rechecks_pieces_of_changed_files(self):
+        # 分片 0 跨 .DS_Store 到 practice/practice，分片 3 只在 practice/practice 里
+        self.save([0, 3])
+        os.utime(os.path.join(self.dir.name, self.torrent.name, '.DS_Store'), ns=(0, 0))
+
+        client = TorrentClient(self.torrent, base_dir=self.dir.name)
+        self.start(client)
+        client.storage.close()
+
+        # 文件里都是 0，重新校验失败
+        self.assertEqual(list(client.picker.done), [3])
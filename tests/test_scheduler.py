@@ -0,0 +1,346 @@
+from zhongzi import message
+from zhongzi.bitfield import Bitfield
+from zhongzi.buffers import BufferPool
+from zhongzi.hasher import HashPipeline
+from zhongzi.peer import Peer
+from zhongzi.picker import PiecePicker, SequentialStrategy
+from zhongzi.scheduler import Scheduler
+from zhongzi.torrent import Piece
+from zhongzi.wire import PeerWireProtocol
+from tests.test_peer import FakeTransport, feed, piece_message
+import asyncio
+import hashlib
+import os
+import time
+import unittest
+
+
+PIECE_LENGTH = 2**15
+
+
+class FakeTorrent:
+    def __init__(self, num_pieces: int):
+        self.piece_length = PIECE_LENGTH
+        self.data = [os.urandom(PIECE_LENGTH) for _ in range(num_pieces)]
+        self.pieces = [Piece(i, PIECE_LENGTH, i * 20, hashlib.sha1(d).digest()) for i, d in enumerate(self.data)]
+
+
+class FakeStorage:
+    direct = False
+
+    def piece_buffer(self, index):
+        return None
+
+
+class DirectStorage:
+    '''
+    像 MmapStorage 一样直接提供分片缓冲区
+    '''
+    direct = True
+
+    def __init__(self, num_pieces: int):
+        self.data = bytearray(num_pieces * PIECE_LENGTH)
+        self.released = []
+
+    def piece_buffer(self, index):
+        return memoryview(self.data)[index * PIECE_LENGTH:(index + 1) * PIECE_LENGTH]
+
+    def release_buffer(self, buf):
+        self.released.append(buf)
+
+
+class SchedulerTests(unittest.IsolatedAsyncioTestCase):
+    def make_scheduler(self, num_pieces: int, budget_pieces: int = 8, max_hash_failures: int = 2,
+                       storage=None) -> Scheduler:
+        self.torrent = FakeTorrent(num_pieces)
+        self.picker = PiecePicker(num_pieces, SequentialStrategy())
+        self.pool = BufferPool(PIECE_LENGTH, PIECE_LENGTH * budget_pieces)
+        self.done = []
+        self.bufs = []
+        self.banned = []
+        self.scheduler = Scheduler(self.torrent, self.picker, storage or FakeStorage(), self.pool, HashPipeline(),
+                                   self.piece_done, max_hash_failures=max_hash_failures,
+                                   on_ban=self.banned.append)
+        return self.scheduler
+
+    def piece_done(self, piece, data, buf):
+        self.done.append((piece.index, bytes(data)))
+        self.bufs.append(buf)
+
+    def make_peer(self, depth: int = 2, pieces=None) -> Peer:
+        n = len(self.torrent.pieces)
+        self.runs = getattr(self, 'runs', [])
+        peer = Peer('-PC0001-000000000000', b'\x00' * 20, (f'127.0.0.{len(self.runs) + 1}', 6881),
+                    pipeline_depth=depth, num_pieces=n)
+        peer.protocol = PeerWireProtocol()
+        peer.protocol._handshake_done = True
+        peer.transport = FakeTransport()
+        peer.protocol.connection_made(peer.transport)
+        peer.writer = peer.protocol
+        peer._state_started()
+        peer._state_choked()
+        peer._remote_pieces = Bitfield(n, range(n) if pieces is None else pieces)
+        self.picker.add_peer_pieces(peer.remote_pieces())
+        self.runs.append(asyncio.create_task(peer.run()))
+        return peer
+
+    async def asyncTearDown(self):
+        for run in getattr(self, 'runs', []):
+            run.cancel()
+
+    def deliver(self, peer: Peer, index: int, begin: int):
+        data = self.torrent.data[index][begin:begin + 2**14]
+        feed(peer.protocol, piece_message(index, begin, data))
+
+    async def settle(self):
+        for _ in range(5):
+            await asyncio.sleep(0.01)
+
+    async def test_requests_follow_unchoke(self):
+        self.make_scheduler(2)
+        peer = self.make_peer(depth=3)
+        self.scheduler.add_peer(peer)
+        self.assertEqual(peer.transport.requests, [])
+
+        peer._state_unchoked()
+        self.scheduler.fill(peer)
+
+        self.assertEqual(peer.transport.requests, [(0, 0, 2**14), (0, 2**14, 2**14), (1, 0, 2**14)])
+
+    async def test_blocks_spread_over_peers(self):
+        self.make_scheduler(1)
+        a, b = self.make_peer(depth=1), self.make_peer(depth=1)
+        for peer in (a, b):
+            peer._state_unchoked()
+            self.scheduler.add_peer(peer)
+
+        self.assertEqual(a.transport.requests, [(0, 0, 2**14)])
+        self.assertEqual(b.transport.requests, [(0, 2**14, 2**14)])
+
+        self.deliver(b, 0, 2**14)
+        self.deliver(a, 0, 0)
+        await self.settle()
+
+        self.assertEqual(self.done, [(0, self.torrent.data[0])])
+        self.assertIn(0, self.picker.done)
+
+    async def test_choke_reassigns_blocks(self):
+        self.make_scheduler(1)
+        a, b = self.make_peer(depth=2), self.make_peer(depth=2)
+        a._state_unchoked()
+        self.scheduler.add_peer(a)
+        self.scheduler.add_peer(b)
+
+        a._state_choked()
+        self.scheduler.peer_choked(a)
+        b._state_unchoked()
+        await self.settle()
+
+        self.assertEqual(b.transport.requests, [(0, 0, 2**14), (0, 2**14, 2**14)])
+        self.assertEqual(a.transport.cancels, [])
+
+    async def test_endgame_duplicates_and_cancels_blocks(self):
+        self.make_scheduler(1)
+        a, b = self.make_peer(depth=2), self.make_peer(depth=2)
+        a._state_unchoked()
+        b._state_unchoked()
+        self.scheduler.add_peer(a)
+        self.scheduler.add_peer(b)
+
+        self.assertTrue(self.scheduler.in_endgame)
+        self.assertEqual(sorted(b.transport.requests), [(0, 0, 2**14), (0, 2**14, 2**14)])
+
+        self.deliver(a, 0, 0)
+        self.deliver(b, 0, 2**14)
+        await self.settle()
+
+        self.assertEqual(b.transport.cancels, [(0, 0, 2**14)])
+        self.assertEqual(a.transport.cancels, [(0, 2**14, 2**14)])
+        self.assertEqual(self.done, [(0, self.torrent.data[0])])
+        self.assertEqual(self.scheduler.piece_latency['endgame'].count, 1)
+
+    async def test_late_duplicate_does_not_overwrite_block(self):
+        self.make_scheduler(1)
+        a, b = self.make_peer(depth=2), self.make_peer(depth=2)
+        a._state_unchoked()
+        b._state_unchoked()
+        self.scheduler.add_peer(a)
+        self.scheduler.add_peer(b)
+
+        # a 的两个 block 都到了，还没处理之前 b 的坏副本也到了
+        self.deliver(a, 0, 0)
+        self.deliver(a, 0, 2**14)
+        feed(b.protocol, piece_message(0, 0, b'x' * 2**14))
+        await self.settle()
+
+        self.assertEqual(self.done, [(0, self.torrent.data[0])])
+        self.assertEqual(self.scheduler.smart_ban.failures, {})
+
+    async def test_duplicate_copied_by_winner(self):
+        self.make_scheduler(1)
+        a, b = self.make_peer(depth=2), self.make_peer(depth=2)
+        a._state_unchoked()
+        b._state_unchoked()
+        self.scheduler.add_peer(a)
+        self.scheduler.add_peer(b)
+
+        # b 的副本先到并拷进分片，之后 a 的坏数据才到
+        self.deliver(b, 0, 0)
+        await self.settle()
+        feed(a.protocol, piece_message(0, 0, b'x' * 2**14))
+        self.deliver(b, 0, 2**14)
+        await self.settle()
+
+        self.assertEqual(self.done, [(0, self.torrent.data[0])])
+        self.assertEqual(self.scheduler.smart_ban.failures, {})
+
+    async def test_deadline_piece_first(self):
+        self.make_scheduler(4)
+        peer = self.make_peer(depth=2)
+        peer._state_unchoked()
+        self.picker.set_deadline(2, time.monotonic() + 10)
+        self.scheduler.add_peer(peer)
+
+        self.assertEqual(peer.transport.requests, [(2, 0, 2**14), (2, 2**14, 2**14)])
+
+    async def test_overdue_piece_requested_again(self):
+        self.make_scheduler(4)
+        a, b, c = self.make_peer(depth=1), self.make_peer(depth=1), self.make_peer(depth=1)
+        self.picker.set_deadline(3, time.monotonic() - 1)
+        for peer in (a, b, c):
+            peer._state_unchoked()
+            self.scheduler.add_peer(peer)
+
+        self.assertEqual(a.transport.requests, [(3, 0, 2**14)])
+        self.assertEqual(b.transport.requests, [(3, 2**14, 2**14)])
+        # 所有 block 都请求过了，过了截止时间的分片再向第三个 peer 要一份，而不是开始新的分片
+        index, begin, _ = c.transport.requests[0]
+        self.assertEqual(index, 3)
+
+        self.deliver(c, 3, begin)
+        other = 2**14 - begin
+        self.deliver(a if other == 0 else b, 3, other)
+        await self.settle()
+        self.assertEqual(self.done[0], (3, self.torrent.data[3]))
+        self.assertNotIn(3, self.picker.deadlines)
+
+    async def test_buffer_budget_limits_pieces(self):
+        self.make_scheduler(3, budget_pieces=1)
+        peer = self.make_peer(depth=10)
+        peer._state_unchoked()
+        self.scheduler.add_peer(peer)
+
+        self.assertEqual({r[0] for r in peer.transport.requests}, {0})
+        self.assertTrue(self.scheduler.starved)
+
+        self.deliver(peer, 0, 0)
+        self.deliver(peer, 0, 2**14)
+        await self.settle()
+        # 写盘完成后归还缓冲区
+        self.scheduler.release(self.bufs[0])
+        await self.settle()
+
+        self.assertEqual({r[0] for r in peer.transport.requests}, {0, 1})
+
+    async def test_mapped_pieces_share_buffer_budget(self):
+        storage = DirectStorage(2)
+        self.make_scheduler(2, budget_pieces=1, storage=storage)
+        peer = self.make_peer(depth=4)
+        peer._state_unchoked()
+        self.scheduler.add_peer(peer)
+        # 在线程池里映射，映射好之后才发出请求
+        self.assertEqual(peer.transport.requests, [])
+        await self.settle()
+        self.assertEqual(peer.transport.requests, [(0, 0, 2**14), (0, 2**14, 2**14)])
+        self.assertEqual(self.pool.in_use_bytes, PIECE_LENGTH)
+
+        for begin in (0, 2**14):
+            self.deliver(peer, 0, begin)
+        await self.settle()
+        self.assertEqual(self.done, [(0, self.torrent.data[0])])
+        self.assertEqual(bytes(storage.data[:PIECE_LENGTH]), self.torrent.data[0])
+
+        # 写盘后归还，预算空出来才开始下一个分片
+        self.scheduler.release(self.bufs[0])
+        await self.settle()
+        self.assertEqual(storage.released, [self.bufs[0]])
+        self.assertEqual(peer.transport.requests[2:], [(1, 0, 2**14), (1, 2**14, 2**14)])
+
+        # 关闭时还没下完的分片也要归还
+        self.scheduler.close()
+        self.assertEqual(len(storage.released), 2)
+        self.assertEqual(self.pool.in_use_bytes, 0)
+
+    async def test_hash_failure_requeues_piece(self):
+        self.make_scheduler(1)
+        peer = self.make_peer(depth=2)
+        peer._state_unchoked()
+        self.scheduler.add_peer(peer)
+
+        feed(peer.protocol, piece_message(0, 0, b'x' * 2**14))
+        self.deliver(peer, 0, 2**14)
+        await self.settle()
+
+        self.assertEqual(self.done, [])
+        self.assertNotIn(0, self.picker.done)
+        # 分片放回后立即重新请求
+        self.assertEqual(peer.transport.requests[2:], [(0, 0, 2**14), (0, 2**14, 2**14)])
+        self.assertEqual(self.scheduler.smart_ban.failures, {'127.0.0.1': 1})
+
+    async def test_bad_block_sender_banned(self):
+        self.make_scheduler(1, max_hash_failures=1)
+        a, b = self.make_peer(depth=1), self.make_peer(depth=1)
+        for peer in (a, b):
+            peer._state_unchoked()
+            self.scheduler.add_peer(peer)
+
+        # 两个 peer 各发了一个 block，校验失败时不知道是谁的错
+        feed(a.protocol, piece_message(0, 0, b'x' * 2**14))
+        self.deliver(b, 0, 2**14)
+        await self.settle()
+        self.assertEqual(self.banned, [])
+        self.assertTrue(self.scheduler.smart_ban.has_suspects(0))
+
+        # 从 b 重新下载整个分片，校验通过后比较 block 找出 a
+        self.scheduler.remove_peer(a)
+        b.pipeline_depth = 2
+        self.scheduler.fill(b)
+        for begin in (0, 2**14):
+            self.deliver(b, 0, begin)
+        await self.settle()
+
+        self.assertEqual(self.done, [(0, self.torrent.data[0])])
+        self.assertEqual(self.banned, ['127.0.0.1'])
+        self.assertNotIn('127.0.0.2', self.scheduler.smart_ban.failures)
+
+    async def test_rejected_block_reissued(self):
+        self.make_scheduler(1)
+        a, b = self.make_peer(depth=1), self.make_peer(depth=1)
+        a.fast = True
+        for peer in (a, b):
+            peer._state_unchoked()
+            self.scheduler.add_peer(peer)
+        self.assertEqual(a.transport.requests, [(0, 0, 2**14)])
+
+        # a 被 choke 后拒绝了请求，b 空出名额时马上拿到这个 block
+        a._state_choked()
+        self.scheduler.peer_choked(a)
+        self.assertIn((0, 0), a.futures)
+        feed(a.protocol, message.RejectRequest(0, 0, 2**14).encode())
+        self.deliver(b, 0, 2**14)
+        await self.settle()
+
+        self.assertEqual(b.transport.requests, [(0, 2**14, 2**14), (0, 0, 2**14)])
+
+    async def test_allowed_fast_while_choked(self):
+        self.make_scheduler(2)
+        peer = self.make_peer(depth=4)
+        peer.fast = True
+        self.scheduler.add_peer(peer)
+        self.assertEqual(peer.transport.requests, [])
+
+        feed(peer.protocol, message.AllowedFast(1).encode())
+        await self.settle()
+        self.scheduler.fill(peer)
+
+        self.assertEqual(peer.transport.requests, [(1, 0, 2**14), (1, 2**14, 2**14)])
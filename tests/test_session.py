@@ -0,0 +1,74 @@
+from zhongzi.session import Session, fair_share
+from zhongzi.torrent import Torrent
+import asyncio
+import tempfile
+import unittest
+
+
+class FairShareTests(unittest.TestCase):
+    def test_small_demands_are_satisfied(self):
+        self.assertEqual(fair_share(10, {'a': 2, 'b': 100, 'c': 100}), {'a': 2, 'b': 4, 'c': 4})
+
+    def test_enough_for_everyone(self):
+        self.assertEqual(fair_share(100, {'a': 3, 'b': 0, 'c': 7}), {'a': 3, 'b': 0, 'c': 7})
+
+    def test_remainder_rotates(self):
+        self.assertEqual(fair_share(3, {'a': 5, 'b': 5}, start=0), {'a': 2, 'b': 1})
+        self.assertEqual(fair_share(3, {'a': 5, 'b': 5}, start=1), {'a': 1, 'b': 2})
+
+    def test_fewer_units_than_torrents(self):
+        demands = {i: 1 for i in range(10)}
+        shares = [fair_share(4, demands, start=i) for i in range(10)]
+        self.assertTrue(all(sum(s.values()) == 4 for s in shares))
+        # 轮流拿到名额
+        self.assertEqual([sum(s[i] for s in shares) for i in range(10)], [4] * 10)
+
+
+class SessionTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.session = Session(base_dir=self.dir.name, max_active_downloads=1, memory_budget=2**22,
+                               max_connections=10, announce=False)
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        self.dir.cleanup()
+
+    async def test_shared_resources_and_queue(self):
+        a = self.session.add(Torrent('nested.torrent'))
+        b = self.session.add(Torrent('single-file.torrent'))
+        self.assertIs(self.session.add(Torrent('nested.torrent')), a)
+        self.assertEqual(a.peer_id, b.peer_id)
+        self.assertIs(a.hash_pipeline, b.hash_pipeline)
+        self.assertFalse(a.discovery)
+
+        self.session._activate()
+        await asyncio.sleep(0.05)
+        stats = self.session.stats()
+        self.assertEqual((stats['running'], stats['queued']), (1, 1))
+
+        self.session.rebalance()
+        self.assertEqual(a.buffer_pool.budget, 2**22)
+        # 还没有候选地址，也留 1 个连接的份额
+        self.assertEqual(a.connections.max_connections, 1)
+
+        await self.session.remove(a.torrent.info_hash)
+        await asyncio.sleep(0.05)
+        stats = self.session.stats()
+        self.assertEqual((stats['torrents'], stats['running'], stats['queued']), (1, 1, 0))
+        self.session.rebalance()
+        self.assertEqual(b.buffer_pool.budget, 2**22)
+
+    async def test_open_files_shared(self):
+        session = Session(base_dir=self.dir.name, max_open_files=4, announce=False)
+        self.addAsyncCleanup(session.close)
+        a = session.add(Torrent('nested.torrent'))
+        b = session.add(Torrent('single-file.torrent'))
+        session._activate()
+        await asyncio.sleep(0.05)
+
+        session.rebalance()
+        await asyncio.sleep(0.05)
+        # 单文件的种子只需要 1 个，剩下的都给多文件的种子
+        self.assertEqual((a.storage.max_open_files, b.storage.max_open_files), (3, 1))
+        self.assertLessEqual(len(a.storage._fds), 3)
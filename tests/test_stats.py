@@ -0,0 +1,38 @@
+from zhongzi.stats import LatencyStats, RateMeter
+import unittest
+
+
+class RateMeterTests(unittest.TestCase):
+    def test_rate_over_window(self):
+        meter = RateMeter(window=10)
+        for second in range(20):
+            meter.update(1000, now=100.0 + second)
+
+        self.assertAlmostEqual(meter.rate(now=119.5), 1000)
+        self.assertEqual(meter.total, 20000)
+
+    def test_old_samples_expire(self):
+        meter = RateMeter(window=10)
+        meter.update(10**6, now=100.0)
+        meter.update(1000, now=115.0)
+
+        self.assertAlmostEqual(meter.rate(now=115.5), 100)
+
+    def test_first_sample_not_inflated(self):
+        meter = RateMeter()
+        meter.update(2**14, now=50.0)
+
+        self.assertEqual(meter.rate(now=50.001), 2**14)
+        self.assertEqual(RateMeter().rate(), 0.0)
+
+
+class LatencyStatsTests(unittest.TestCase):
+    def test_percentiles(self):
+        stats = LatencyStats()
+        for i in range(1, 101):
+            stats.record(i / 100)
+
+        summary = stats.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['p50'], 0.51)
+        self.assertAlmostEqual(summary['max'], 1.0)
@@ -0,0 +1,190 @@
+from zhongzi import bencode
+from zhongzi.storage import FileSpan, MmapStorage, Storage
+from zhongzi.torrent import Torrent
+import os
+import tempfile
+import unittest
+
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent('nested.torrent')
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = Storage(self.torrent, self.dir.name)
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def test_spans_cross_files(self):
+        # .DS_Store 6148 字节，go.mod 154 字节，go.sum 6211 字节
+        spans = self.storage.spans(6000, 500)
+
+        self.assertEqual(spans, [
+            FileSpan(0, 6000, 0, 148),
+            FileSpan(1, 0, 148, 154),
+            FileSpan(2, 0, 302, 198),
+        ])
+
+    def test_piece_spans_cover_piece(self):
+        for index in (0, 1, len(self.torrent.pieces) - 1):
+            spans = self.storage.piece_spans(index)
+            self.assertEqual(sum(s.length for s in spans), self.torrent.pieces[index].length)
+
+    def test_open_creates_files(self):
+        self.storage.open()
+
+        path = self.storage.path(1)
+        self.assertEqual(path, os.path.join(self.dir.name, self.torrent.name, 'practice', 'go.mod'))
+        for i, file in enumerate(self.torrent.files):
+            self.assertEqual(os.path.getsize(self.storage.path(i)), file.length)
+
+    def test_write_and_read_piece(self):
+        self.storage.open()
+        data = os.urandom(self.torrent.piece_length)
+
+        self.storage.write_piece(0, data)
+
+        self.assertEqual(self.storage.read_piece(0), data)
+        with open(self.storage.path(1), 'rb') as f:
+            self.assertEqual(f.read(), data[6148:6148 + 154])
+
+    def test_fd_cache_is_bounded(self):
+        storage = Storage(self.torrent, self.dir.name, max_open_files=2)
+        storage.open()
+
+        self.assertLessEqual(len(storage._fds), 2)
+        storage.close()
+
+
+    def test_skipped_files(self):
+        # 分片 431 跨 practice/practice、practice/main.go 和 practice/1.jpg
+        self.storage.set_skipped({3, 4})
+        self.storage.open()
+        self.assertFalse(os.path.exists(self.storage.path(3)))
+        self.assertFalse(os.path.exists(self.storage.path(4)))
+
+        data = os.urandom(self.torrent.pieces[431].length)
+        self.storage.write_piece(431, data)
+        self.assertEqual(self.storage.read_piece(431), data)
+        st = os.stat(self.storage.path(3))
+        self.assertEqual(st.st_size, self.torrent.files[3].length)
+        # 只有边界分片的数据占用磁盘
+        self.assertLess(st.st_blocks * 512, 2 * self.torrent.piece_length)
+
+        self.storage.set_skipped({3})
+        self.assertEqual(os.path.getsize(self.storage.path(4)), self.torrent.files[4].length)
+
+
+def make_torrent(name: bytes, paths=None) -> bytes:
+    info = {b'name': name, b'piece length': 16384, b'pieces': bytes(20)}
+    if paths is None:
+        info[b'length'] = 10
+    else:
+        info[b'files'] = [{b'length': 10, b'path': path} for path in paths]
+    return bytes(bencode.Encoder({b'info': info}).encode())
+
+
+class PathSafetyTests(unittest.TestCase):
+    def test_unsafe_names_rejected(self):
+        for name, paths in [
+            (b'..', None),
+            (b'a/../../etc', None),
+            (b'/etc/passwd', None),
+            (b'', None),
+            (b'ok', [[b'..', b'..', b'evil']]),
+            (b'ok', [[b'/etc', b'passwd']]),
+            (b'ok', [[b'a', b'', b'b']]),
+            (b'ok', [[b'.', b'b']]),
+            (b'ok', [[b'a\\..\\b']]),
+            (b'ok', [[b'a\x00b']]),
+            (b'ok', [[]]),
+        ]:
+            with self.subTest(name=name, paths=paths):
+                with self.assertRaises(ValueError):
+                    Torrent.from_bytes(make_torrent(name, paths))
+
+    def test_path_stays_under_base_dir(self):
+        torrent = Torrent.from_bytes(make_torrent(b'ok', [[b'dir', b'file']]))
+        with tempfile.TemporaryDirectory() as d:
+            storage = Storage(torrent, d)
+            self.assertEqual(storage.path(0), os.path.join(d, 'ok', 'dir', 'file'))
+            # 绕过加载时的检查也写不到外面
+            torrent.files[0].name = '../../evil'
+            with self.assertRaises(ValueError):
+                storage.path(0)
+
+
+class MmapStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.torrent = Torrent('nested.torrent')
+        self.dir = tempfile.TemporaryDirectory()
+        self.storage = MmapStorage(self.torrent, self.dir.name, window_size=2**16, max_windows=2)
+        self.storage.open()
+
+    def tearDown(self):
+        self.storage.close()
+        self.dir.cleanup()
+
+    def test_piece_buffer_is_backed_by_file(self):
+        # 分片 10 完全落在 practice/practice 里
+        buf = self.storage.piece_buffer(10)
+        buf[:] = b'm' * len(buf)
+        del buf
+        self.storage.sync()
+
+        self.assertEqual(Storage(self.torrent, self.dir.name).read_piece(10), b'm' * self.torrent.piece_length)
+
+    def test_piece_across_files_has_no_buffer(self):
+        self.assertIsNone(self.storage.piece_buffer(0))
+
+    def test_write_and_read_across_windows(self):
+        data = os.urandom(self.torrent.piece_length * 3)
+
+        self.storage.write(self.torrent.piece_length, data)
+
+        self.assertEqual(bytes(self.storage.read(self.torrent.piece_length, len(data))), data)
+
+    def test_windows_are_bounded(self):
+        for index in range(0, len(self.torrent.pieces), 50):
+            self.storage.read_piece(index)
+
+        self.assertLessEqual(len(self.storage._windows), 2)
+
+    def test_borrowed_windows_are_not_evicted(self):
+        # 分片 10 和 13 在 practice/practice 的两个不同窗口里，分片 17 在第三个窗口
+        a = self.storage.piece_buffer(10)
+        b = self.storage.piece_buffer(13)
+        self.assertIsNone(self.storage.piece_buffer(17))
+
+        # 窗口都被借出时读写改用 pwrite/preadv
+        data = os.urandom(self.torrent.piece_length)
+        self.storage.write_piece(17, data)
+        self.assertEqual(bytes(self.storage.read_piece(17)), data)
+        self.assertEqual(len(self.storage._windows), 2)
+
+        self.storage.release_buffer(a)
+        with self.assertRaises(ValueError):
+            a[0]
+        c = self.storage.piece_buffer(17)
+        self.assertEqual(bytes(c), data)
+        self.storage.release_buffer(b)
+        self.storage.release_buffer(c)
+
+    def test_close_releases_borrowed_buffers(self):
+        buf = self.storage.piece_buffer(10)
+        with self.assertNoLogs(level='WARNING'):
+            self.storage.close()
+        with self.assertRaises(ValueError):
+            buf[0]
+
+    def test_skipped_file_boundary_piece(self):
+        storage = MmapStorage(self.torrent, os.path.join(self.dir.name, 'skip'), window_size=2**16)
+        storage.set_skipped({3})
+        storage.open()
+        self.addCleanup(storage.close)
+
+        data = os.urandom(self.torrent.pieces[431].length)
+        storage.write_piece(431, data)
+        self.assertEqual(bytes(storage.read_piece(431)), data)
+        self.assertEqual(os.path.getsize(storage.path(3)), self.torrent.files[3].length)
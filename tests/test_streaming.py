@@ -0,0 +1,123 @@
+from zhongzi.bitfield import Bitfield
+from zhongzi.client import TorrentClient
+from zhongzi.picker import Priority
+from zhongzi.streaming import StreamServer, TorrentStream
+from zhongzi.torrent import Torrent
+import aiohttp
+import asyncio
+import os
+import tempfile
+import unittest
+
+
+class StreamingTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.torrent = Torrent('nested.torrent')
+        self.client = TorrentClient(self.torrent, base_dir=self.dir.name, discovery=False, announce=False)
+        self.client.storage.open()
+        self.data = os.urandom(2**20)
+        self.client.storage.write(0, self.data)
+        # practice/practice 从第 12513 个字节开始
+        self.file = self.torrent.files[3]
+
+    async def asyncTearDown(self):
+        self.client.storage.close()
+        self.dir.cleanup()
+
+    def mark(self, pieces):
+        self.client._mark_saved(Bitfield(len(self.torrent.pieces), pieces))
+
+    def expected(self, start: int, length: int, file=None) -> bytes:
+        offset = (file or self.file).offset + start
+        return self.data[offset:offset + length]
+
+    async def test_read_waits_for_pieces_and_sets_deadlines(self):
+        stream = TorrentStream(self.client, 3, readahead=8)
+        stream.seek(100000)
+        reading = asyncio.create_task(stream.read(50000))
+        await asyncio.sleep(0.01)
+
+        self.assertFalse(reading.done())
+        first = (self.file.offset + 100000) // self.torrent.piece_length
+        # 要读的 4 个分片加上后面 8 个
+        self.assertEqual(sorted(self.client.picker.deadlines), list(range(first, first + 12)))
+        deadlines = [self.client.picker.deadlines[i] for i in range(first, first + 12)]
+        self.assertEqual(deadlines, sorted(deadlines))
+
+        self.mark(range(first, first + 3))
+        await asyncio.sleep(0.01)
+        self.assertFalse(reading.done())
+        self.mark([first + 3])
+        self.assertEqual(await asyncio.wait_for(reading, 1), self.expected(100000, 50000))
+        self.assertEqual(stream.tell(), 150000)
+        # 下载完的分片不再有截止时间
+        self.assertNotIn(first, self.client.picker.deadlines)
+
+        stream.close()
+        self.assertEqual(self.client.picker.deadlines, {})
+
+    async def test_read_to_end_of_file(self):
+        self.mark(range(64))
+        stream = TorrentStream(self.client, 1)
+        self.assertEqual(await stream.read(), self.expected(0, 154, self.torrent.files[1]))
+        self.assertEqual(await stream.read(), b'')
+
+    async def test_http_range_requests(self):
+        self.mark(range(64))
+        server = StreamServer(self.client)
+        await server.start()
+        self.addAsyncCleanup(server.close)
+
+        async with aiohttp.ClientSession() as session:
+            async with session.get(server.url(3), headers={'Range': 'bytes=1000-99999'}) as res:
+                self.assertEqual(res.status, 206)
+                self.assertEqual(res.headers['Content-Range'], f'bytes 1000-99999/{self.file.length}')
+                self.assertEqual(await res.read(), self.expected(1000, 99000))
+
+            go_mod = self.torrent.files[1]
+            async with session.get(server.url(1)) as res:
+                self.assertEqual(res.status, 200)
+                self.assertEqual(await res.read(), self.expected(0, 154, go_mod))
+            async with session.get(server.url(1), headers={'Range': 'bytes=-10'}) as res:
+                self.assertEqual(res.status, 206)
+                self.assertEqual(await res.read(), self.expected(144, 10, go_mod))
+            async with session.get(server.url(1), headers={'Range': 'bytes=200-'}) as res:
+                self.assertEqual(res.status, 416)
+            async with session.get(server.url(99)) as res:
+                self.assertEqual(res.status, 404)
+            async with session.get(f'http://{server.host}:{server.port}/') as res:
+                files = await res.json()
+                self.assertEqual(files[3]['length'], self.file.length)
+
+    async def test_stream_skipped_file(self):
+        self.client.set_file_priority(3, Priority.SKIP)
+        first = self.file.offset // self.torrent.piece_length
+        self.assertNotIn(first + 1, self.client.picker.wanted)
+
+        # 打开跳过的文件时把它加回下载
+        stream = TorrentStream(self.client, 3)
+        self.assertEqual(self.client.file_priorities[3], Priority.NORMAL)
+        reading = asyncio.create_task(stream.read(10))
+        await asyncio.sleep(0.01)
+        self.assertIsNotNone(self.client.picker.urgent())
+        self.mark([first])
+        self.assertEqual(await asyncio.wait_for(reading, 1), self.expected(0, 10))
+
+    async def test_skipped_file_after_download_is_not_found(self):
+        priorities = [Priority.SKIP] * len(self.torrent.files)
+        priorities[1] = Priority.NORMAL
+        self.client.set_file_priorities(priorities)
+        self.mark([0])
+        self.assertTrue(self.client.completed)
+        with self.assertRaises(ValueError):
+            TorrentStream(self.client, 3)
+
+        server = StreamServer(self.client)
+        await server.start()
+        self.addAsyncCleanup(server.close)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(server.url(3)) as res:
+                self.assertEqual(res.status, 404)
+            async with session.get(server.url(1)) as res:
+                self.assertEqual(await res.read(), self.expected(0, 154, self.torrent.files[1]))
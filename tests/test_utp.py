@@ -0,0 +1,210 @@
+from zhongzi import message
+from zhongzi.bitfield import Bitfield
+from zhongzi.peer import Peer
+from zhongzi.utp import ST_DATA, ST_FIN, ST_STATE, Packet, UTPEndpoint, open_utp_connection
+from zhongzi.wire import PeerWireProtocol
+import asyncio
+import os
+import struct
+import unittest
+
+
+class Sink(asyncio.Protocol):
+    def __init__(self):
+        self.transport = None
+        self.data = bytearray()
+        self.lost = asyncio.get_running_loop().create_future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data: bytes):
+        self.data += data
+
+    def connection_lost(self, exc):
+        if not self.lost.done():
+            self.lost.set_result(exc)
+
+
+class LossyEndpoint(UTPEndpoint):
+    '''
+    每 drop_every 个包丢掉一个
+    '''
+    drop_every = 7
+
+    def __init__(self, accept=None):
+        super().__init__(accept)
+        self.sent = 0
+
+    def _sendto(self, data: bytes, addr):
+        self.sent += 1
+        if self.sent % self.drop_every == 0:
+            return
+        super()._sendto(data, addr)
+
+
+class FinAckDroppingEndpoint(UTPEndpoint):
+    '''
+    丢掉收到第一个 FIN 之后发出的确认，forget 为 True 时同时忘掉这个连接
+    '''
+    forget = False
+
+    def __init__(self, accept=None):
+        super().__init__(accept)
+        self.fin_seen = False
+        self.dropped = 0
+
+    def datagram_received(self, data: bytes, addr):
+        packet = Packet.decode(data)
+        if packet.type == ST_FIN and not self.fin_seen:
+            self.fin_seen = True
+            super().datagram_received(data, addr)
+            if self.forget:
+                self._connections.clear()
+            return
+        super().datagram_received(data, addr)
+
+    def _sendto(self, data: bytes, addr):
+        if self.fin_seen and not self.dropped and Packet.decode(data).type == ST_STATE:
+            self.dropped += 1
+            return
+        super()._sendto(data, addr)
+
+
+class PacketTests(unittest.TestCase):
+    def test_roundtrip(self):
+        p = Packet(ST_DATA, 1234, 65535, 7, wnd_size=2**20, timestamp=1, timestamp_diff=2, payload=b'hello')
+        q = Packet.decode(p.encode())
+        self.assertEqual((q.type, q.connection_id, q.seq_nr, q.ack_nr, q.wnd_size, q.timestamp, q.timestamp_diff),
+                         (ST_DATA, 1234, 65535, 7, 2**20, 1, 2))
+        self.assertEqual(q.payload, b'hello')
+        self.assertIsNone(q.sack)
+
+    def test_sack_extension(self):
+        p = Packet(ST_STATE, 1, 2, 3, sack=b'\x05\x00\x00\x80')
+        data = p.encode()
+        self.assertEqual(data[1], 1)
+        self.assertEqual(data[20:22], b'\x00\x04')
+        q = Packet.decode(data)
+        self.assertEqual(q.sack, b'\x05\x00\x00\x80')
+        self.assertEqual(q.payload, b'')
+
+    def test_bad_packets(self):
+        with self.assertRaises(ValueError):
+            Packet.decode(b'\x01' * 10)
+        # 版本号不对
+        with self.assertRaises(ValueError):
+            Packet.decode(bytes([0x02]) + bytes(19))
+        # 扩展长度超出包的长度
+        with self.assertRaises(ValueError):
+            Packet.decode(Packet(ST_STATE, 1, 2, 3, sack=b'\xff' * 4).encode()[:22])
+
+
+class TransferTests(unittest.IsolatedAsyncioTestCase):
+    async def transfer(self, endpoint_class, size: int):
+        sinks = []
+
+        def accept():
+            sinks.append(Sink())
+            return sinks[-1]
+
+        server = await endpoint_class.create(('127.0.0.1', 0), accept=accept)
+        client = await endpoint_class.create(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        payload = os.urandom(size)
+        conn, proto = await client.connect(Sink, server.local_addr)
+        conn.write(payload)
+        conn.close()
+        await asyncio.wait_for(sinks[0].lost, 30)
+        self.assertEqual(bytes(sinks[0].data), payload)
+        # 两边都是正常关闭
+        self.assertIsNone(await asyncio.wait_for(proto.lost, 5))
+        return conn
+
+    async def test_transfer(self):
+        await self.transfer(UTPEndpoint, 2**20 + 123)
+
+    async def test_transfer_with_loss(self):
+        conn = await self.transfer(LossyEndpoint, 2**20)
+        self.assertGreater(conn.stats()['retransmits'], 0)
+
+    async def test_lost_fin_ack(self):
+        # 对方重传 FIN 时再确认一次
+        conn = await self.transfer(FinAckDroppingEndpoint, 2**16)
+        self.assertGreater(conn.stats()['retransmits'], 0)
+
+    async def test_lost_fin_ack_after_forgetting(self):
+        # 对方已经忘了连接时回复的 RESET 也能匹配到我们的连接
+        class Forgetting(FinAckDroppingEndpoint):
+            forget = True
+
+        conn = await self.transfer(Forgetting, 2**16)
+        self.assertGreater(conn.stats()['retransmits'], 0)
+
+    async def test_both_directions(self):
+        sinks = []
+
+        def accept():
+            sinks.append(Sink())
+            return sinks[-1]
+
+        server = await UTPEndpoint.create(('127.0.0.1', 0), accept=accept)
+        self.addCleanup(server.close)
+        conn, proto = await open_utp_connection(Sink, *server.local_addr)
+        conn.write(b'ping')
+        while not sinks or sinks[0].data != b'ping':
+            await asyncio.sleep(0.01)
+        sinks[0].transport.write(b'pong')
+        while proto.data != b'pong':
+            await asyncio.sleep(0.01)
+        conn.close()
+        await asyncio.wait_for(sinks[0].lost, 5)
+
+    async def test_connection_refused(self):
+        # 对方不接受连接时回复 RESET
+        server = await UTPEndpoint.create(('127.0.0.1', 0))
+        client = await UTPEndpoint.create(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(client.connect(Sink, server.local_addr), 5)
+
+
+class PeerOverUTPTests(unittest.IsolatedAsyncioTestCase):
+    async def test_handshake_and_messages(self):
+        info_hash = b'\x01' * 20
+        remotes = []
+
+        def accept():
+            remotes.append(PeerWireProtocol())
+            return remotes[-1]
+
+        server = await UTPEndpoint.create(('127.0.0.1', 0), accept=accept)
+        client = await UTPEndpoint.create(('127.0.0.1', 0))
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        peer = Peer('-PC0001-000000000000', info_hash, server.local_addr, utp=client)
+        pieces = Bitfield(8)
+        pieces.add(3)
+        connecting = asyncio.create_task(peer.connect(pieces))
+        while not remotes:
+            await asyncio.sleep(0.01)
+        remote = remotes[0]
+        handshake = await asyncio.wait_for(remote.handshake, 5)
+        self.assertEqual(handshake[28:48], info_hash)
+        remote.write(struct.pack('>B19s8s20s20s', 19, b'BitTorrent protocol', bytes(8), info_hash,
+                                 b'-XX0001-000000000000'))
+        await asyncio.wait_for(connecting, 5)
+        self.assertEqual(peer.stats()['transport'], 'utp')
+
+        # 对方不支持 fast extension，我们发了 Bitfield 和 Interested
+        received = []
+        async for msg in remote:
+            received.append(type(msg))
+            if isinstance(msg, message.Interested):
+                break
+        self.assertEqual(received, [message.Bitfield, message.Interested])
+        peer.close()
@@ -0,0 +1,85 @@
+from zhongzi import message
+from zhongzi.wire import PeerWireProtocol
+from tests.test_peer import feed, piece_message
+import struct
+import unittest
+
+
+def drain_messages(protocol: PeerWireProtocol):
+    msgs = list(protocol._messages)
+    protocol._messages.clear()
+    return msgs
+
+
+class FramingTests(unittest.IsolatedAsyncioTestCase):
+    async def test_handshake_then_messages(self):
+        protocol = PeerWireProtocol()
+        data = b'\x13' + b'x' * 67 + struct.pack('>I', 0) + message.Have(7).encode()
+
+        for i in range(len(data)):
+            feed(protocol, data[i:i + 1])
+
+        self.assertEqual(await protocol.handshake, b'\x13' + b'x' * 67)
+        msgs = drain_messages(protocol)
+        self.assertIsInstance(msgs[0], message.KeepAlive)
+        self.assertEqual(msgs[1].piece_index, 7)
+
+    async def test_piece_without_destination_is_copied(self):
+        protocol = PeerWireProtocol()
+        protocol._handshake_done = True
+
+        feed(protocol, piece_message(1, 16, b'abc'))
+
+        msg = drain_messages(protocol)[0]
+        self.assertEqual((msg.index, msg.begin, msg.block), (1, 16, b'abc'))
+        self.assertIsInstance(msg.block, bytes)
+
+    async def test_piece_direct_write(self):
+        protocol = PeerWireProtocol(buffer_size=32)
+        protocol._handshake_done = True
+        dest = bytearray(100)
+        protocol.register_destination(2, 0, memoryview(dest))
+
+        feed(protocol, piece_message(2, 0, bytes(range(100))) + message.Have(1).encode())
+
+        msgs = drain_messages(protocol)
+        self.assertEqual(dest, bytes(range(100)))
+        self.assertIs(msgs[0].block.obj, dest)
+        self.assertEqual(msgs[1].piece_index, 1)
+
+    async def test_discarded_destination_is_not_written(self):
+        protocol = PeerWireProtocol(buffer_size=32)
+        protocol._handshake_done = True
+        dest = bytearray(100)
+        protocol.register_destination(2, 0, memoryview(dest))
+
+        data = piece_message(2, 0, b'z' * 100)
+        feed(protocol, data[:40])
+        protocol.discard_destination(2, 0)
+        feed(protocol, data[40:])
+
+        self.assertEqual(dest[27:], bytes(73))
+        self.assertEqual(drain_messages(protocol), [])
+
+    async def test_large_message_grows_buffer(self):
+        protocol = PeerWireProtocol(buffer_size=16)
+        protocol._handshake_done = True
+        bitfield = b'\xff' * 1000
+
+        feed(protocol, struct.pack('>Ib', 1 + len(bitfield), message.PeerMessage.Bitfield.value) + bitfield)
+
+        self.assertEqual(drain_messages(protocol)[0].bitfield, bitfield)
+
+    async def test_fast_extension_messages(self):
+        protocol = PeerWireProtocol()
+        protocol._handshake_done = True
+
+        feed(protocol, message.HaveAll().encode() + message.HaveNone().encode() + message.Suggest(3).encode()
+             + message.RejectRequest(1, 2, 3).encode() + message.AllowedFast(9).encode())
+
+        msgs = drain_messages(protocol)
+        self.assertEqual([type(m) for m in msgs], [message.HaveAll, message.HaveNone, message.Suggest,
+                                                   message.RejectRequest, message.AllowedFast])
+        self.assertEqual(msgs[2].piece_index, 3)
+        self.assertEqual((msgs[3].index, msgs[3].begin, msgs[3].length), (1, 2, 3))
+        self.assertEqual(msgs[4].piece_index, 9)
@@ -0,0 +1,92 @@
+import hashlib
+import logging
+from typing import Dict, List, Set, Tuple
+
+
+BlockSenders = Dict[int, Tuple[str, bytes]]
+
+
+def block_digests(data: memoryview, blocks) -> Dict[int, bytes]:
+    '''
+    分片里每个 block 的 sha1
+    '''
+    return {block.index: hashlib.sha1(data[block.offset:block.offset + block.length]).digest() for block in blocks}
+
+
+def block_senders(data: memoryview, blocks, senders: Dict[int, str]) -> BlockSenders:
+    '''
+    每个 block 的发送者和 sha1，只包含来自 peer 的 block
+    '''
+    return {index: (senders[index], digest)
+            for index, digest in block_digests(data, [b for b in blocks if b.index in senders]).items()}
+
+
+class SmartBan:
+    '''
+    按 IP 统计校验失败。分片只来自一个 peer 时直接记在它头上；来自多个 peer 时先记下每个 block 的 sha1，
+    等这个分片重新下载并校验通过后逐个 block 比较，数据不一样的 block 的发送者就是发坏数据的 peer。
+    失败次数达到 max_failures 的 IP 被封禁。
+    '''
+    def __init__(self, max_failures: int = 2):
+        self.max_failures = max_failures
+        self.failures: Dict[str, int] = {}
+        self.banned: Set[str] = set()
+        # 校验失败的分片：index -> block 下标 -> [(ip, sha1)]
+        self._suspects: Dict[int, Dict[int, List[Tuple[str, bytes]]]] = {}
+
+    def is_banned(self, ip: str) -> bool:
+        return ip in self.banned
+
+    def has_suspects(self, index: int) -> bool:
+        return index in self._suspects
+
+    def _strike(self, ip: str) -> bool:
+        if ip in self.banned:
+            return False
+        self.failures[ip] = self.failures.get(ip, 0) + 1
+        if self.failures[ip] < self.max_failures:
+            return False
+        self.banned.add(ip)
+        logging.warning(f'banning {ip} after {self.failures[ip]} hash failures')
+        return True
+
+    def piece_failed(self, index: int, blocks: BlockSenders) -> List[str]:
+        '''
+        返回需要封禁的 IP
+        '''
+        senders = {ip for ip, _ in blocks.values()}
+        if not senders:
+            return []
+        if len(senders) == 1:
+            ip = senders.pop()
+            logging.info(f'piece {index} failed, all blocks came from {ip}')
+            return [ip] if self._strike(ip) else []
+
+        logging.info(f'piece {index} failed, blocks came from {sorted(senders)}, keeping block digests')
+        suspects = self._suspects.setdefault(index, {})
+        for block_index, sender in blocks.items():
+            if sender not in suspects.setdefault(block_index, []):
+                suspects[block_index].append(sender)
+        return []
+
+    def piece_passed(self, index: int, blocks: Dict[int, bytes]) -> List[str]:
+        '''
+        blocks 是校验通过的数据里每个 block 的 sha1。返回需要封禁的 IP
+        '''
+        suspects = self._suspects.pop(index, None)
+        if suspects is None:
+            return []
+        bad = set()
+        for block_index, senders in suspects.items():
+            good = blocks.get(block_index)
+            for ip, digest in senders:
+                if good is not None and digest != good:
+                    bad.add(ip)
+        return [ip for ip in sorted(bad) if self._strike(ip)]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'suspect_pieces': len(self._suspects),
+            'peers_with_failures': len(self.failures),
+            'banned': len(self.banned),
+        }
@@ -16,6 +16,13 @@ class Decoder:
         self._data = data
         self._index = 0
 
+    @property
+    def position(self) -> int:
+        '''
+        已经解码的字节数，bencode 后面还跟着其他数据时用
+        '''
+        return self._index
+
     def _peek(self) -> bytes | None:
         if self._index + 1 > len(self._data):
             return None
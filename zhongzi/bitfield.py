@@ -0,0 +1,113 @@
+from typing import Iterable, Iterator, Self
+
+
+# 每个字节值对应的置位下标，高位在前（与 Bitfield 消息的位序一致）
+_BYTE_INDICES = [tuple(i for i in range(8) if (b >> (7 - i)) & 1) for b in range(256)]
+
+
+class Bitfield:
+    '''
+    bytearray 实现的分片集合，位序与 Bitfield 消息相同：第 0 个分片是第一个字节的最高位。
+    用法和 set 类似，len() 返回置位的数量，批量操作转成 int 之后一次完成。
+    '''
+    def __init__(self, size: int, indices: Iterable[int] = ()):
+        self.size = size
+        self._bits = bytearray((size + 7) // 8)
+        for index in indices:
+            self.add(index)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, size: int | None = None) -> Self:
+        if size is None:
+            size = len(data) * 8
+        bf = cls(size)
+        n = min(len(bf._bits), len(data))
+        bf._bits[:n] = data[:n]
+        bf._clear_spare_bits()
+        return bf
+
+    @classmethod
+    def full(cls, size: int) -> Self:
+        bf = cls(size)
+        bf._bits[:] = b'\xff' * len(bf._bits)
+        bf._clear_spare_bits()
+        return bf
+
+    def _clear_spare_bits(self):
+        spare = len(self._bits) * 8 - self.size
+        if spare:
+            self._bits[-1] &= (0xff << spare) & 0xff
+
+    def _to_int(self) -> int:
+        return int.from_bytes(self._bits, 'big')
+
+    def _with_int(self, value: int) -> Self:
+        bf = Bitfield(self.size)
+        bf._bits[:] = value.to_bytes(len(self._bits), 'big')
+        return bf
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._bits)
+
+    def __contains__(self, index: int) -> bool:
+        if not 0 <= index < self.size:
+            return False
+        return bool(self._bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def add(self, index: int):
+        if not 0 <= index < self.size:
+            raise IndexError(f'piece index {index} out of range [0, {self.size})')
+        self._bits[index >> 3] |= 0x80 >> (index & 7)
+
+    def discard(self, index: int):
+        if 0 <= index < self.size:
+            self._bits[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def __iter__(self) -> Iterator[int]:
+        for i, byte in enumerate(self._bits):
+            if byte:
+                base = i << 3
+                for j in _BYTE_INDICES[byte]:
+                    yield base + j
+
+    def __len__(self) -> int:
+        return self._to_int().bit_count()
+
+    def __bool__(self) -> bool:
+        return any(self._bits)
+
+    def all(self) -> bool:
+        return len(self) == self.size
+
+    def __and__(self, other: Self) -> Self:
+        return self._with_int(self._to_int() & other._to_int())
+
+    def __or__(self, other: Self) -> Self:
+        return self._with_int(self._to_int() | other._to_int())
+
+    def __sub__(self, other: Self) -> Self:
+        return self._with_int(self._to_int() & ~other._to_int())
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Bitfield) and self.size == other.size and self._bits == other._bits
+
+    def copy(self) -> Self:
+        return Bitfield.from_bytes(self._bits, self.size)
+
+    def first(self) -> int | None:
+        value = self._to_int()
+        if not value:
+            return None
+        return len(self._bits) * 8 - value.bit_length()
+
+    def first_common(self, other: Self) -> int | None:
+        '''
+        两个集合交集中最小的下标，比如 peer 拥有而我们还缺少的第一个分片
+        '''
+        value = self._to_int() & other._to_int()
+        if not value:
+            return None
+        return len(self._bits) * 8 - value.bit_length()
+
+    def __repr__(self):
+        return f'Bitfield({len(self)}/{self.size})'
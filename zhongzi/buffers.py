@@ -0,0 +1,70 @@
+from typing import Dict, List
+
+
+class BufferPool:
+    '''
+    复用 piece 大小的缓冲区。所有借出的缓冲区加起来不超过 budget 字节，
+    超过时 try_acquire 返回 None，调度器不再开始新的分片，等有缓冲区归还后再继续，下载因此自然地慢下来。
+    直接写进 mmap 映射的分片不借缓冲区，但用 try_reserve 占一个名额，映射里的脏页同样计入预算。
+    '''
+    def __init__(self, buffer_size: int, budget: int, preallocate: int = 0):
+        self.buffer_size = buffer_size
+        # 至少能借出一个缓冲区，否则永远无法前进
+        self.capacity = max(1, budget // buffer_size)
+        self._free: List[bytearray] = [bytearray(buffer_size) for _ in range(min(preallocate, self.capacity))]
+        self._allocated = len(self._free)
+        self._in_use = 0
+
+    @property
+    def budget(self) -> int:
+        return self.capacity * self.buffer_size
+
+    @property
+    def in_use_bytes(self) -> int:
+        return self._in_use * self.buffer_size
+
+    def try_acquire(self) -> bytearray | None:
+        if self._in_use >= self.capacity:
+            return None
+        if self._free:
+            self._in_use += 1
+            return self._free.pop()
+        if self._allocated < self.capacity:
+            self._allocated += 1
+            self._in_use += 1
+            return bytearray(self.buffer_size)
+        return None
+
+    def try_reserve(self) -> bool:
+        if self._in_use >= self.capacity:
+            return False
+        self._in_use += 1
+        return True
+
+    def unreserve(self):
+        self._in_use -= 1
+
+    def set_budget(self, budget: int):
+        '''
+        调整预算：变小时丢掉多余的空闲缓冲区，借出的缓冲区归还时再丢
+        '''
+        self.capacity = max(1, budget // self.buffer_size)
+        while self._free and self._allocated > self.capacity:
+            self._free.pop()
+            self._allocated -= 1
+
+    def release(self, buf: bytearray):
+        self._in_use -= 1
+        if self._allocated > self.capacity:
+            # 预算变小了，不再复用
+            self._allocated -= 1
+            return
+        self._free.append(buf)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'buffer_size': self.buffer_size,
+            'budget': self.budget,
+            'allocated': self._allocated * self.buffer_size,
+            'in_use': self.in_use_bytes,
+        }
@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+from .storage import Storage
+
+
+class FsyncPolicy:
+    '''
+    never: 从不 fsync；on-complete: 下载完成时 fsync 一次；per-N-MB: 每写入 N MiB fsync 一次
+    '''
+    def __init__(self, policy: str = 'never'):
+        self.policy = policy
+        self.every = 0
+        if policy in ('never', 'on-complete'):
+            return
+        m = re.fullmatch(r'per-(\d+)-MB', policy)
+        if m is None:
+            raise ValueError(f'unknown fsync policy: {policy}')
+        self.every = int(m.group(1)) * 2**20
+        if self.every == 0:
+            raise ValueError(f'invalid fsync policy: {policy}')
+
+    def __str__(self):
+        return self.policy
+
+
+class WriteBackCache:
+    '''
+    暂存校验通过的分片，满足大小、时间或内存压力条件时一起写盘，相邻分片合并为一次 pwritev
+    '''
+    def __init__(self, storage: Storage, max_bytes: int = 2**26, max_age: float = 5.0, fsync: str = 'never'):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync_policy = FsyncPolicy(fsync)
+
+        # index -> (数据, 来自 BufferPool 的缓冲区)
+        self._pieces: Dict[int, Tuple[memoryview, bytearray]] = {}
+        self._bytes = 0
+        self._oldest: float | None = None
+        self._unsynced = 0
+
+        self.flushes = 0
+        self.writes = 0
+        self.bytes_written = 0
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._pieces)
+
+    def get(self, index: int) -> memoryview | None:
+        entry = self._pieces.get(index)
+        return None if entry is None else entry[0]
+
+    def add(self, index: int, data: memoryview, buf: bytearray):
+        if not self._pieces:
+            self._oldest = time.monotonic()
+        self._pieces[index] = (data, buf)
+        self._bytes += len(data)
+
+    def time_to_flush(self) -> float | None:
+        '''
+        距离按时间阈值必须写盘还有多久，缓存为空时返回 None
+        '''
+        if self._oldest is None:
+            return None
+        return max(0.0, self._oldest + self.max_age - time.monotonic())
+
+    def should_flush(self, pressure: bool = False) -> bool:
+        if not self._pieces:
+            return False
+        return pressure or self._bytes >= self.max_bytes or self.time_to_flush() == 0
+
+    def take(self) -> List[Tuple[int, List[memoryview], List[bytearray]]]:
+        '''
+        取出缓存中的全部分片，按连续的分片下标分组
+        '''
+        runs = []
+        for index in sorted(self._pieces):
+            data, buf = self._pieces[index]
+            if runs and runs[-1][0] + len(runs[-1][1]) == index:
+                runs[-1][1].append(data)
+                runs[-1][2].append(buf)
+            else:
+                runs.append((index, [data], [buf]))
+        self._pieces.clear()
+        self._bytes = 0
+        self._oldest = None
+        return runs
+
+    def write(self, runs: List[Tuple[int, List[memoryview], List[bytearray]]]):
+        '''
+        在工作线程中执行：每组连续的分片写一次，并按 fsync 策略同步
+        '''
+        for start, datas, _ in runs:
+            self.storage.writev(start * self.storage.torrent.piece_length, datas)
+            n = sum(len(d) for d in datas)
+            self.writes += 1
+            self.bytes_written += n
+            self._unsynced += n
+        self.flushes += 1
+        self.maybe_sync()
+        logging.debug(f'write cache flushed {len(runs)} runs, {self.bytes_written} bytes written in total')
+
+    def written_in_place(self, nbytes: int):
+        '''
+        数据已经直接落在存储里（比如 mmap 映射），不需要再写，只计入 fsync 的统计
+        '''
+        self.bytes_written += nbytes
+        self._unsynced += nbytes
+
+    def needs_sync(self) -> bool:
+        return bool(self.fsync_policy.every) and self._unsynced >= self.fsync_policy.every
+
+    def maybe_sync(self):
+        if self.needs_sync():
+            self.storage.sync()
+            self._unsynced = 0
+
+    def finish(self):
+        '''
+        下载完成，除 never 外的策略都做最后一次 fsync
+        '''
+        if self.fsync_policy.policy != 'never' and self._unsynced:
+            self.storage.sync()
+            self._unsynced = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'cached_pieces': len(self._pieces),
+            'cached_bytes': self._bytes,
+            'flushes': self.flushes,
+            'writes': self.writes,
+            'bytes_written': self.bytes_written,
+        }
+
+
+class BlockReadCache:
+    '''
+    上传用的读缓存。peer 一般按顺序请求一个分片的所有 block，所以一次读入整个分片，按 LRU 淘汰
+    '''
+    def __init__(self, storage: Storage, max_bytes: int = 2**24):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self._pieces: OrderedDict[int, bytes] = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, index: int) -> bool:
+        return index in self._pieces
+
+    def get(self, index: int, begin: int, length: int) -> memoryview | None:
+        data = self._pieces.get(index)
+        if data is None:
+            return None
+        self._pieces.move_to_end(index)
+        self.hits += 1
+        return memoryview(data)[begin:begin + length]
+
+    def put(self, index: int, data: bytes):
+        if index in self._pieces:
+            return
+        self._pieces[index] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes and len(self._pieces) > 1:
+            _, old = self._pieces.popitem(last=False)
+            self._bytes -= len(old)
+
+    async def read(self, index: int, begin: int, length: int) -> memoryview:
+        block = self.get(index, begin, length)
+        if block is not None:
+            return block
+        self.misses += 1
+        # 拷贝一份：mmap 存储返回的是映射的视图，缓存它会让窗口无法被淘汰
+        data = bytes(await asyncio.to_thread(self.storage.read_piece, index))
+        self.put(index, data)
+        return memoryview(data)[begin:begin + length]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'cached_pieces': len(self._pieces),
+            'cached_bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
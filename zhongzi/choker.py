@@ -0,0 +1,56 @@
+import logging
+import random
+from typing import List, Set
+from .peer import Peer
+
+
+class Choker:
+    '''
+    tit-for-tat：每轮按最近的速率给感兴趣的 peer 排序，最快的几个 unchoke。
+    下载时看对方给我们的下载速率，做种时看我们给对方的上传速率。
+    另外留一个乐观 unchoke 名额，每隔几轮随机换一个被 choke 的 peer，让新 peer 有机会证明自己。
+    '''
+    def __init__(self, upload_slots: int = 4, interval: float = 10.0, optimistic_rounds: int = 3):
+        self.upload_slots = upload_slots
+        self.interval = interval
+        self.optimistic_rounds = optimistic_rounds
+
+        self.optimistic: Peer | None = None
+        self._round = 0
+
+    def rechoke(self, peers: List[Peer], seeding: bool = False) -> Set[Peer]:
+        '''
+        决定这一轮 unchoke 哪些 peer，其余的都应该 choke
+        '''
+        interested = [p for p in peers if p.peer_interested]
+        # 最近 20 秒的滚动速率
+        if seeding:
+            rates = {p: p.upload_rate.rate() for p in interested}
+        else:
+            rates = {p: p.download_rate.rate() for p in interested}
+        interested.sort(key=lambda p: rates[p], reverse=True)
+
+        regular = max(0, self.upload_slots - 1)
+        unchoke = set(interested[:regular])
+
+        rotate = self._round % self.optimistic_rounds == 0
+        if rotate or self.optimistic not in interested or self.optimistic in unchoke:
+            candidates = [p for p in interested if p not in unchoke]
+            self.optimistic = random.choice(candidates) if candidates else None
+        if self.optimistic is not None:
+            unchoke.add(self.optimistic)
+        self._round += 1
+
+        logging.debug(f'rechoke: unchoking {[str(p) for p in unchoke]}, optimistic {self.optimistic}')
+        return unchoke
+
+    async def run_round(self, peers: List[Peer], seeding: bool = False):
+        unchoke = self.rechoke(peers, seeding)
+        for peer in peers:
+            try:
+                if peer in unchoke:
+                    await peer.unchoke()
+                else:
+                    await peer.choke()
+            except Exception as e:
+                logging.debug(f'failed to update choke state of peer {peer}: {e}')
@@ -1,129 +1,640 @@
 import asyncio
 import logging
-from .tracker import Tracker
+from .tracker import Tracker, _calculate_peer_id
 from .torrent import Torrent, Piece
-from .peer import Peer
+from .peer import Peer, PeerListener
+from .picker import PiecePicker, PickStrategy, Priority
+from .bitfield import Bitfield
+from .buffers import BufferPool
+from .hasher import HashPipeline
+from .storage import STORAGE_BACKENDS
+from .cache import BlockReadCache, WriteBackCache
+from .choker import Choker
+from .scheduler import Scheduler
+from .connection import ConnectionManager
+from .extension import (MAX_PEX_PEERS, METADATA_DATA, METADATA_PIECE_SIZE, METADATA_REJECT, METADATA_REQUEST,
+                        MetadataMessage, PeerExchange, PexMessage)
+from .magnet import MagnetLink, MetadataFetcher
+from . import resume
+from .recheck import Recheck
 from .dht import DHTServer
-from typing import List
-import random
+from .utp import UTPEndpoint
+from .listener import InboundListener
+from .wire import PeerWireProtocol
+from typing import Dict, List, Sequence, Tuple
+import time
 
 
-class TorrentClient:
-    def __init__(self, torrent: Torrent):
+class TorrentClient(PeerListener):
+    def __init__(self, torrent: Torrent, pipeline_depth: int = 5, strategy: PickStrategy | None = None,
+                 endgame: bool = True, endgame_redundancy: int = 2, memory_budget: int = 2**28,
+                 hash_workers: int = 2, base_dir: str = '.', allocation: str = 'sparse',
+                 write_cache_bytes: int = 2**26, write_cache_age: float = 5.0, fsync: str = 'never',
+                 storage_backend: str = 'file', resume_interval: float = 30.0, recheck: bool = False,
+                 upload_slots: int = 4, read_cache_bytes: int = 2**24, seed: bool = False,
+                 max_connections: int = 50, max_connecting: int = 20, max_hash_failures: int = 2,
+                 dht: DHTServer | None = None, dht_port: int = 9999, utp: bool = False, peer_id: str | None = None,
+                 hash_pipeline: HashPipeline | None = None, utp_endpoint: UTPEndpoint | None = None,
+                 discovery: bool = True, listen_port: int | None = 6881, listener: InboundListener | None = None,
+                 announce: bool = True, file_priorities: Sequence[int] | None = None):
         self.torrent = torrent
-        self.tracker = Tracker(torrent)
-        self.peer_id = self.tracker.peer_id
+        self.pipeline_depth = pipeline_depth
+        self.picker = PiecePicker(len(torrent.pieces), strategy)
+        # 正在下载和等待写盘的分片数据总量不超过 memory_budget
+        self.buffer_pool = BufferPool(torrent.piece_length, memory_budget)
+        # 多个种子可以共用一个校验线程池（Session），这时由创建者负责关闭
+        self._owns_hash_pipeline = hash_pipeline is None
+        self.hash_pipeline = HashPipeline(hash_workers) if hash_pipeline is None else hash_pipeline
+        # file: pwrite/pwritev；mmap: block 直接写进文件映射
+        self.storage = STORAGE_BACKENDS[storage_backend](torrent, base_dir, allocation=allocation)
+        self.write_cache = WriteBackCache(self.storage, write_cache_bytes, write_cache_age, fsync)
+        self.read_cache = BlockReadCache(self.storage, read_cache_bytes)
+        self.choker = Choker(upload_slots)
+        # 下载完成后继续做种，直到调用 stop()
+        self.seed = seed
+        self._stopped = asyncio.Event()
+        # 已经写进存储的分片，快速恢复文件只记录这些
+        self.saved_pieces = Bitfield(len(torrent.pieces))
+        # 下载完成、写盘任务已经退出，之后不能再选中新的分片
+        self._download_finished = False
+        self.resume_interval = resume_interval
+        # 不用快速恢复文件，启动时完整校验磁盘上已有的数据
+        self.recheck = recheck
+        self._last_resume_save = time.monotonic()
+
+        # endgame: 剩余分片都已分配后，还没收到的 block 同时向多个 peer 请求
+        self.scheduler = Scheduler(torrent, self.picker, self.storage, self.buffer_pool, self.hash_pipeline,
+                                   self.piece_done, endgame, endgame_redundancy,
+                                   max_hash_failures=max_hash_failures, on_ban=self.ban_peer)
+        self.piece_latency = self.scheduler.piece_latency
+        self.peer_id = peer_id or _calculate_peer_id()
+        # 开始监听之后才知道汇报给 tracker 的端口，没有监听时不汇报
+        self.tracker: Tracker | None = None
         self.info_hash = torrent.info_hash
         self.valid_peers: List[Peer] = []
         self.valid_peers_lock = asyncio.Lock()
+        self.connections = ConnectionManager(self.open_peer, max_connections, max_connecting)
+        # 通过 ut_pex 和已连接的 peer 交换各自连着的 peer
+        self.pex = PeerExchange()
+        # 已经启动的 DHT（Session 共享的或者下载元数据时用过的），为 None 时 collecting_peers 在 dht_port 上自己启动一个
+        self.dht = dht
+        self.dht_port = dht_port
+        self._owns_dht = False
+        # 为 False 时不自己去 DHT 找 peer，由 Session 统一查找后调用 connections.add_peers
+        self.discovery = discovery
+        # 先尝试 uTP 连接 peer，失败再用 TCP。传入 utp_endpoint 时使用共享的端点
+        self.utp = utp or utp_endpoint is not None
+        self.utp_endpoint = utp_endpoint
+        self._owns_utp_endpoint = False
+        # 接受别人连进来：传入 listener 时使用共享的监听端口，否则 listen_port 不为 None 时自己监听（0 表示由系统分配）
+        self.listen_port = listen_port
+        self.listener = listener
+        self._owns_listener = False
+        # 定期向 tracker 汇报并获取 peer
+        self.announce = announce
+        # 已经断开的 peer 的上传量，汇报给 tracker 用
+        self.uploaded = 0
+        self._tasks: List[asyncio.Task] = []
+
+        # 流式读取时等待分片变得可读（在写缓存里或者已经写盘）
+        self._piece_waiters: Dict[int, List[asyncio.Future]] = {}
+
+        # 不限长度，积压的数据量由 buffer_pool 限制
+        self.piece_saver_queue: asyncio.Queue[Tuple[Piece, bytearray]] = asyncio.Queue()
 
-        self.piece_download_queue: asyncio.Queue[Piece] = asyncio.Queue(maxsize=5)
-        self.piece_saver_queue: asyncio.Queue[Piece] = asyncio.Queue(maxsize=1)
+        self.file_priorities = [Priority.NORMAL] * len(torrent.files)
+        if file_priorities is not None:
+            self.set_file_priorities(file_priorities)
 
         logging.info(f'torrent total pieces: {len(self.torrent.pieces)}')
 
+    @classmethod
+    async def from_magnet(cls, uri: str, dht: DHTServer | None = None, **kwargs) -> 'TorrentClient':
+        '''
+        从磁力链接或 info hash 启动：通过 DHT 找 peer，用 ut_metadata 下载 info 字典并校验，
+        在内存里构造 Torrent。下载元数据时连上的 peer 和 DHT 都留给返回的 TorrentClient 使用，
+        dht 为 None 时在 dht_port 上启动一个，由返回的 TorrentClient 负责关闭
+        '''
+        link = MagnetLink.parse(uri)
+        owns_dht = dht is None
+        if owns_dht:
+            dht = DHTServer(('0.0.0.0', kwargs.get('dht_port', 9999)))
+            await dht.run()
+
+        logging.info(f'fetching metadata for {link.info_hash.hex()} ({link.name})')
+        fetcher = MetadataFetcher(link.info_hash, _calculate_peer_id())
+        try:
+            info = await fetcher.fetch(dht, link.peers)
+            torrent = Torrent.from_info(info, link.trackers)
+        except BaseException:
+            if owns_dht:
+                dht.close()
+            raise
+
+        client = cls(torrent, dht=dht, **kwargs)
+        client._owns_dht = owns_dht
+        client.connections.add_peers(link.peers + fetcher.known_peers)
+        return client
+
     async def start(self):
-        asyncio.create_task(self.collecting_peers())
+        if self.recheck:
+            # 在扩展文件之前校验，缺失和不完整的文件不用读
+            await self.recheck_existing()
+            await asyncio.to_thread(self.storage.open)
+        else:
+            await asyncio.to_thread(self.storage.open)
+            await self.load_resume()
 
-        asyncio.create_task(self.download())
+        if self.listener is None and self.listen_port is not None:
+            listener = InboundListener(port=self.listen_port)
+            try:
+                await listener.start()
+                self.listener = listener
+                self._owns_listener = True
+            except OSError as e:
+                logging.warning(f'unable to listen on port {self.listen_port}, incoming peers disabled: {e}')
+        if self.listener is not None:
+            self.listener.register(self.info_hash, self.accept_peer)
+            self.tracker = Tracker(self.torrent, self.listener.port, self.peer_id)
 
-        await self.file_saver()
+        if self.utp and self.utp_endpoint is None:
+            # 自己监听时 uTP 也用这个端口号，连进来的 uTP 连接同样交给 listener
+            port = self.listener.port if self._owns_listener else 0
+            accept = self.listener.protocol_factory if self._owns_listener else None
+            self.utp_endpoint = await UTPEndpoint.create(('0.0.0.0', port), accept)
+            self._owns_utp_endpoint = True
+            logging.info(f'utp endpoint listening on {self.utp_endpoint.local_addr}')
 
-    async def download(self):
-        asyncio.create_task(self.piece_generator())
+        self._tasks = [
+            asyncio.create_task(self.connections.run()),
+            asyncio.create_task(self.scheduler.run()),
+            asyncio.create_task(self.choking()),
+            asyncio.create_task(self.exchanging_peers()),
+        ]
+        if self.discovery:
+            self._tasks.append(asyncio.create_task(self.collecting_peers()))
+        if self.announce and self.torrent.announce is not None:
+            if self.tracker is not None:
+                self._tasks.append(asyncio.create_task(self.announcing()))
+            else:
+                logging.warning('not listening for incoming peers, not announcing to tracker')
 
-        async with asyncio.TaskGroup() as tg:
-            for i in range(150):
-                tg.create_task(self.download_piece_worker(i))
+        try:
+            await self.file_saver()
+            if self.seed:
+                logging.info('download complete, seeding')
+                await self._stopped.wait()
+        finally:
+            for task in self._tasks:
+                task.cancel()
+            for peer in list(self.valid_peers):
+                peer.close()
+            # 先释放还在下载的分片引用的映射，关闭时的 msync 放到线程池里
+            self.scheduler.close()
+            await asyncio.to_thread(self.storage.close)
+            if self.listener is not None:
+                self.listener.unregister(self.info_hash)
+                if self._owns_listener:
+                    self.listener.close()
+            if self.utp_endpoint is not None and self._owns_utp_endpoint:
+                self.utp_endpoint.close()
+            if self.dht is not None and self._owns_dht:
+                self.dht.close()
 
-    async def piece_generator(self):
-        for piece in self.torrent.pieces:
-            await self.piece_download_queue.put(piece)
-        
-    async def download_piece_worker(self, index):
-        while True:
+    def stop(self):
+        self._stopped.set()
+
+    def set_file_priorities(self, priorities: Sequence[int]):
+        '''
+        每个文件的优先级。和别的文件共用的边界分片取其中最高的优先级，SKIP 的文件不下载也不在磁盘上分配。
+        下载完成之前修改马上生效。下载完成后写盘任务已经退出，再修改抛出 ValueError
+        '''
+        if self._download_finished:
+            raise ValueError('download already finished, file priorities can no longer change')
+        if len(priorities) != len(self.torrent.files):
+            raise ValueError(f'expected {len(self.torrent.files)} file priorities, got {len(priorities)}')
+        self.file_priorities = [Priority(p) for p in priorities]
+
+        pieces = [Priority.SKIP] * len(self.torrent.pieces)
+        for i, priority in enumerate(self.file_priorities):
+            for index in self.torrent.file_pieces(i):
+                pieces[index] = max(pieces[index], priority)
+        self.picker.set_priorities(pieces)
+        self.storage.set_skipped(i for i, p in enumerate(self.file_priorities) if p == Priority.SKIP)
+        logging.info(f'file priorities: {[p.name for p in self.file_priorities]}, '
+                     f'{len(self.picker.selected)}/{len(self.torrent.pieces)} pieces selected')
+        self.scheduler.fill_all()
+
+    def set_file_priority(self, file_index: int, priority: int):
+        priorities = list(self.file_priorities)
+        priorities[file_index] = priority
+        self.set_file_priorities(priorities)
+
+    @property
+    def completed(self) -> bool:
+        '''
+        没有跳过的分片都已经写进存储
+        '''
+        return not self.picker.selected - self.saved_pieces
+
+    @property
+    def left(self) -> int:
+        return sum(self.torrent.pieces[i].length for i in self.picker.selected - self.saved_pieces)
+
+    @property
+    def in_endgame(self) -> bool:
+        return self.scheduler.in_endgame
+
+    def latency_stats(self) -> Dict[str, Dict[str, float]]:
+        return {phase: stats.summary() for phase, stats in self.piece_latency.items()}
+
+    def peer_have(self, peer: Peer, piece_index: int):
+        self.picker.add_peer_pieces([piece_index])
+        self.scheduler.fill(peer)
+
+    def peer_bitfield(self, peer: Peer, pieces: Bitfield):
+        self.picker.add_peer_pieces(pieces)
+        self.scheduler.fill(peer)
+
+    def peer_unchoked(self, peer: Peer):
+        self.scheduler.fill(peer)
+
+    def peer_choked(self, peer: Peer):
+        self.scheduler.peer_choked(peer)
+
+    def peer_allowed_fast(self, peer: Peer, piece_index: int):
+        self.scheduler.fill(peer)
+
+    def peer_closed(self, peer: Peer):
+        self.picker.remove_peer_pieces(peer.remote_pieces())
+        self.scheduler.remove_peer(peer)
+        if peer in self.valid_peers:
+            self.valid_peers.remove(peer)
+        self.connections.disconnected(peer.addr)
+        self.pex.forget(peer.addr)
+        self.uploaded += peer.uploaded
+
+    def readable(self, piece_index: int) -> bool:
+        return piece_index in self.saved_pieces or self.write_cache.get(piece_index) is not None
+
+    async def wait_piece(self, piece_index: int):
+        '''
+        等到分片校验通过并且可以读
+        '''
+        if self.readable(piece_index):
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._piece_waiters.setdefault(piece_index, []).append(waiter)
+        try:
+            await waiter
+        finally:
+            waiters = self._piece_waiters.get(piece_index)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._piece_waiters[piece_index]
+
+    def _piece_readable(self, piece_index: int):
+        for waiter in self._piece_waiters.pop(piece_index, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def read_block(self, peer: Peer | None, piece_index: int, begin: int, length: int) -> memoryview | None:
+        if piece_index >= len(self.torrent.pieces) or piece_index not in self.picker.done:
+            return None
+        if begin + length > self.torrent.pieces[piece_index].length:
+            return None
+        # 校验过但还在写缓存里的分片直接从缓存里取
+        data = self.write_cache.get(piece_index)
+        if data is not None:
+            return data[begin:begin + length]
+        if piece_index not in self.saved_pieces:
+            return None
+        return await self.read_cache.read(piece_index, begin, length)
+
+    async def choking(self):
+        while not self._stopped.is_set():
+            async with self.valid_peers_lock:
+                peers = list(self.valid_peers)
+            await self.choker.run_round(peers, seeding=self.picker.finished)
+            await asyncio.sleep(self.choker.interval)
+
+    def piece_done(self, piece: Piece, data: memoryview, buf: bytearray | memoryview):
+        piece.data = data
+        self.piece_saver_queue.put_nowait((piece, buf))
+        asyncio.create_task(self.broadcast_have(piece.index))
+
+    async def broadcast_have(self, piece_index: int):
+        for peer in list(self.valid_peers):
             try:
-                piece = await self.piece_download_queue.get()
-            except asyncio.QueueShutDown:
-                logging.info(f'piece queue is shutdown, worker {index} exiting')
-                break
+                await peer.send_have(piece_index)
+            except Exception as e:
+                logging.debug(f'failed to send have to peer {peer}: {e}')
+
+    def peer_extension_message(self, peer: Peer, name: str, payload: bytes):
+        if name == 'ut_metadata':
+            self._metadata_request(peer, payload)
+            return
+        if name != 'ut_pex':
+            return
+        try:
+            pex = PexMessage.decode(payload)
+        except Exception as e:
+            logging.warning(f'bad pex message from {peer}: {e}')
+            return
+        added = self.connections.add_peers(pex.added[:MAX_PEX_PEERS])
+        logging.debug(f'pex from {peer}: {len(pex.added)} added, {len(pex.dropped)} dropped, {added} new')
+
+    def _metadata_request(self, peer: Peer, payload: bytes):
+        try:
+            msg = MetadataMessage.decode(payload)
+        except Exception as e:
+            logging.warning(f'bad metadata message from {peer}: {e}')
+            return
+        if msg.msg_type != METADATA_REQUEST:
+            return
+        info = self.torrent.info_bytes
+        start = msg.piece * METADATA_PIECE_SIZE
+        if 0 <= start < len(info):
+            reply = MetadataMessage(METADATA_DATA, msg.piece, len(info), info[start:start + METADATA_PIECE_SIZE])
+        else:
+            reply = MetadataMessage(METADATA_REJECT, msg.piece)
 
-            peer = await self.choose_peer(piece.index)
+        async def send():
             try:
-                piece.data = await peer.download_piece(piece)
-                await self.piece_saver_queue.put(piece)
-            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
-                logging.error(f'peer {peer} disconnected: {e}')
-                async with self.valid_peers_lock:
-                    if peer in self.valid_peers:
-                        self.valid_peers.remove(peer)
-                await self.piece_download_queue.put(piece)
+                await peer.send_extended('ut_metadata', reply.encode())
             except Exception as e:
-                logging.error(f'failed to download piece {piece.index} from peer {peer}: {e}')
-                await self.piece_download_queue.put(piece)
+                logging.debug(f'failed to send metadata to peer {peer}: {e}')
 
-    async def choose_peer(self, piece_index: int) -> Peer:
+        asyncio.create_task(send())
+
+    async def exchanging_peers(self):
+        '''
+        定期把当前连着的 peer 告诉支持 ut_pex 的 peer，PeerExchange 限制每个 peer 的发送间隔
+        '''
         while True:
-            async with self.valid_peers_lock:
-                random.shuffle(self.valid_peers)
-                for peer in self.valid_peers:
-                    if not peer.can_downlowd():
-                        continue
-                    if peer.has_piece(piece_index):
-                        return peer
-            
-            logging.info(f'no peer can download piece {piece_index}, waiting')
             await asyncio.sleep(10)
+            async with self.valid_peers_lock:
+                peers = list(self.valid_peers)
+            # 连进来的 peer 用它声明的监听端口，没有声明的连不上，不告诉别人
+            connected = {p.listen_addr for p in peers if p.listen_addr is not None}
+            for peer in peers:
+                if not peer.supports('ut_pex'):
+                    continue
+                pex = self.pex.update(peer.addr, connected - {peer.listen_addr})
+                if pex is None:
+                    continue
+                try:
+                    await peer.send_extended('ut_pex', pex.encode())
+                except Exception as e:
+                    logging.debug(f'failed to send pex to peer {peer}: {e}')
+
+    def ban_peer(self, ip: str):
+        '''
+        发送坏数据次数太多的 IP：断开所有连接，以后也不再连接
+        '''
+        self.connections.ban(ip)
+        for peer in self.valid_peers:
+            if peer.addr[0] == ip:
+                logging.warning(f'disconnecting banned peer {peer}')
+                peer.close()
+
+    def peer_stats(self) -> List[Dict[str, float | str | bool]]:
+        stats = []
+        for p in self.valid_peers:
+            s = p.stats()
+            s['hash_failures'] = self.scheduler.smart_ban.failures.get(p.addr[0], 0)
+            stats.append(s)
+        return sorted(stats, key=lambda s: s['download_rate'], reverse=True)
 
     async def collecting_peers(self):
-        s = DHTServer(('0.0.0.0', 9999), ids=bytes.fromhex("8df9e68813c4232db0506c897ae4c210daa98250"))
-        await s.run()
+        s = self.dht
+        if s is None:
+            s = DHTServer(('0.0.0.0', self.dht_port))
+            await s.run()
+            self.dht = s
+            self._owns_dht = True
 
         while True:
-            async with self.valid_peers_lock:
-                if len(self.valid_peers) > 15:
-                    logging.debug(f'valid peers count is sufficient: {len(self.valid_peers)}, skipping DHT bootstrap')
-                    await asyncio.sleep(10)
-                    continue
+            if not self.connections.need_peers():
+                logging.debug(f'peer candidates are sufficient: {self.connections.stats()}, skipping DHT bootstrap')
+                await asyncio.sleep(10)
+                continue
 
             await s.bootstrap(max_nodes=100)
             self.peers = await s.get_peers(self.info_hash)
 
             logging.info(f'got {len(self.peers)} peers from DHT network: {self.peers}')
+            if not self.connections.add_peers(self.peers):
+                await asyncio.sleep(10)
 
-            for peer_info in self.peers:
-                p = Peer(self.peer_id, self.info_hash, peer_info)
-                try:
-                    await p.connect()
-                except Exception as e:
-                    logging.error(f'skip, failed to connect to peer {peer_info}: {e}')
-                    continue
-                
-                asyncio.create_task(p.run())
+    async def open_peer(self, addr: tuple) -> Peer:
+        if self.scheduler.smart_ban.is_banned(addr[0]):
+            raise ConnectionRefusedError(f'{addr[0]} is banned')
+        p = None
+        if self.utp_endpoint is not None:
+            p = self._new_peer(addr, self.utp_endpoint)
+            try:
+                await p.connect(self.picker.done.copy())
+            except Exception as e:
+                logging.debug(f'utp connection to {addr} failed: {e!r}, trying tcp')
+                p = None
+        if p is None:
+            p = self._new_peer(addr)
+            await p.connect(self.picker.done.copy())
 
-                async with self.valid_peers_lock:
-                    self.valid_peers.append(p)
-                    logging.info(f'connected to peer: {peer_info}')
+        async with self.valid_peers_lock:
+            self.valid_peers.append(p)
+        self.scheduler.add_peer(p)
+        asyncio.create_task(p.run())
+        return p
+
+    async def accept_peer(self, protocol: PeerWireProtocol, addr: tuple):
+        '''
+        listener 收到了这个种子的握手：回复握手后和主动连接的 peer 一样处理
+        '''
+        if self.scheduler.smart_ban.is_banned(addr[0]):
+            raise ConnectionRefusedError(f'{addr[0]} is banned')
+        if self.connections.connected >= self.connections.max_connections:
+            raise ConnectionRefusedError('too many connections')
+        p = self._new_peer(addr)
+        await p.connect(self.picker.done.copy(), protocol=protocol)
+        if not self.connections.accepted(addr, p):
+            p.close()
+            raise ConnectionRefusedError(f'already connected to {addr}')
+
+        async with self.valid_peers_lock:
+            self.valid_peers.append(p)
+        self.scheduler.add_peer(p)
+        asyncio.create_task(p.run())
+
+    async def announcing(self):
+        '''
+        定期向 tracker 汇报实际监听的端口，返回的 peer 交给 connections
+        '''
+        while True:
+            downloaded = min(self.torrent.total_size, len(self.saved_pieces) * self.torrent.piece_length)
+            uploaded = self.uploaded + sum(p.uploaded for p in self.valid_peers)
+            try:
+                res = await self.tracker.connect(uploaded, downloaded, self.left)
+                added = self.connections.add_peers(res.peers)
+                logging.info(f'got {len(res.peers)} peers from tracker, {added} new')
+                interval = res.interval or 1800
+            except Exception as e:
+                logging.warning(f'failed to announce to tracker: {e!r}')
+                interval = 300
+            await asyncio.sleep(interval)
+
+    def _new_peer(self, addr: tuple, utp: UTPEndpoint | None = None) -> Peer:
+        return Peer(self.peer_id, self.info_hash, addr, pipeline_depth=self.pipeline_depth, listener=self,
+                    num_pieces=len(self.torrent.pieces), metadata_size=len(self.torrent.info_bytes), utp=utp,
+                    listen_port=self.listener.port if self.listener is not None else None)
 
     async def file_saver(self):
-        downloaded_pieces = 0
+        while not self.completed:
+            try:
+                piece, buf = await asyncio.wait_for(self.piece_saver_queue.get(), timeout=self._saver_timeout())
+                if isinstance(buf, bytearray):
+                    self.write_cache.add(piece.index, piece.data, buf)
+                else:
+                    # 数据已经在 mmap 映射里
+                    self.write_cache.written_in_place(len(piece.data))
+                    self.saved_pieces.add(piece.index)
+                    self.scheduler.release(buf)
+                    if self.write_cache.needs_sync():
+                        await asyncio.to_thread(self.write_cache.maybe_sync)
+                self._piece_readable(piece.index)
+                piece.data = None
+            except TimeoutError:
+                pass
+            except asyncio.QueueShutDown:
+                logging.info('data queue is empty, file saver exiting')
+                return
 
-        with open(self.torrent.name, 'wb') as f:
-            while True:
-                try:
-                    piece = await self.piece_saver_queue.get()
-                except asyncio.QueueShutDown:
-                    logging.info('data queue is empty, file saver exiting')
-                    break
-
-                f.seek(piece.index * self.torrent.piece_length)
-                f.write(piece.data)
-                f.flush()
-                logging.info(f'saved piece {piece.index} to file {self.torrent.name}')
-
-                downloaded_pieces += 1
-                if downloaded_pieces == len(self.torrent.pieces):
-                    logging.info('all pieces downloaded, exiting')
-                    self.piece_download_queue.shutdown()
-                    self.piece_saver_queue.shutdown()
-                    return
+            # 调度因为没有缓冲区停下来时立即写盘，把内存还给下载
+            pressure = self.scheduler.starved or self.picker.finished
+            if self.write_cache.should_flush(pressure):
+                await self.flush_write_cache()
+            if time.monotonic() - self._last_resume_save >= self.resume_interval:
+                await self.save_resume()
+
+        self._download_finished = True
+        await asyncio.to_thread(self.write_cache.finish)
+        await self.save_resume()
+        logging.info('all pieces downloaded, exiting')
+        for phase, stats in self.piece_latency.items():
+            logging.info(f'{phase} piece latency: {stats}')
+        logging.info(f'hash pipeline: {self.hash_pipeline.stats()}')
+        logging.info(f'write cache: {self.write_cache.stats()}')
+        logging.info(f'smart ban: {self.scheduler.smart_ban.stats()}')
+        if self._owns_hash_pipeline:
+            self.hash_pipeline.close()
+        self.piece_saver_queue.shutdown()
+
+    def _saver_timeout(self) -> float:
+        resume_due = max(0.0, self._last_resume_save + self.resume_interval - time.monotonic())
+        flush_due = self.write_cache.time_to_flush()
+        return resume_due if flush_due is None else min(flush_due, resume_due)
+
+    async def flush_write_cache(self) -> int:
+        runs = self.write_cache.take()
+        await asyncio.to_thread(self.write_cache.write, runs)
+
+        saved = 0
+        for start, datas, bufs in runs:
+            for buf in bufs:
+                self.scheduler.release(buf)
+            for index in range(start, start + len(datas)):
+                self.saved_pieces.add(index)
+            saved += len(datas)
+            logging.info(f'saved pieces {start}-{start + len(datas) - 1} to {self.storage.base_dir}')
+        return saved
+
+    async def save_resume(self):
+        '''
+        写快速恢复文件。先把缓存和未完成分片里已收到的 block 写盘，是否 fsync 由 fsync 策略决定：
+        不 fsync 时断电后文件里记录的内容不一定在磁盘上
+        '''
+        if self.write_cache:
+            await self.flush_write_cache()
+
+        blocks = []
+        partial = {}
+        for index, (progress, buf) in self.scheduler.partial().items():
+            received = progress.copy()
+            resumed = self.scheduler.resumed.get(index)
+            if resumed is not None:
+                received = received | resumed
+            if not received:
+                continue
+            partial[index] = received
+            if isinstance(buf, bytearray):
+                # 分片还在下载，缓冲区随时可能被放回 buffer_pool，先拷贝出来
+                start = index * self.torrent.piece_length
+                for block in self.torrent.pieces[index].blocks:
+                    if block.index in progress:
+                        blocks.append((start + block.offset, bytes(buf[block.offset:block.offset + block.length])))
+        for index, received in self.scheduler.resumed.items():
+            partial.setdefault(index, received)
+
+        pieces = self.saved_pieces.copy()
+
+        def write():
+            for offset, block_data in blocks:
+                self.storage.write(offset, block_data)
+            self.write_cache.maybe_sync()
+            states = resume.file_states(self.storage)
+            resume.save(self.storage, resume.ResumeData(self.info_hash, pieces, partial, states))
+
+        await asyncio.to_thread(write)
+        self._last_resume_save = time.monotonic()
+        logging.info(f'resume data saved: {len(self.saved_pieces)} pieces, {len(partial)} partial pieces')
+
+    async def load_resume(self):
+        '''
+        文件没有变化时直接相信快速恢复文件；变化过的文件只重新校验记录在它上面的分片
+        '''
+        data = await asyncio.to_thread(resume.load, self.storage)
+        if data is None:
+            return
+
+        changed = await asyncio.to_thread(resume.changed_files, self.storage, data)
+        if changed:
+            logging.info(f'files changed since last run: {sorted(changed)}, rechecking their pieces')
+
+        trusted = Bitfield(len(self.torrent.pieces))
+        suspect = []
+        for index in data.pieces:
+            if resume.piece_files(self.storage, index) & changed:
+                suspect.append(index)
+            else:
+                trusted.add(index)
+        if suspect:
+            trusted = trusted | await Recheck(self.storage).run(suspect)
+        self._mark_saved(trusted)
+
+        for index, blocks in data.partial.items():
+            if index in self.saved_pieces or resume.piece_files(self.storage, index) & changed:
+                continue
+            self.scheduler.resumed[index] = blocks
+
+        logging.info(f'resumed {len(self.saved_pieces)} pieces and {len(self.scheduler.resumed)} partial pieces, '
+                     f'rechecked {len(suspect)}')
+
+    async def recheck_existing(self):
+        last = 0
+
+        def report(recheck: Recheck):
+            nonlocal last
+            percent = recheck.checked * 100 // len(self.torrent.pieces)
+            if percent >= last + 10:
+                last = percent
+                logging.info(f'recheck {percent}%: {recheck.valid} valid, {recheck.throughput / 2**20:.1f} MiB/s')
+
+        self._mark_saved(await Recheck(self.storage).run(progress=report))
+
+    def _mark_saved(self, pieces: Bitfield):
+        for index in pieces:
+            self.picker.complete(index)
+            self.saved_pieces.add(index)
+            self._piece_readable(index)
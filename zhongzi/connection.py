@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Set, Tuple
+from .peer import Peer
+
+
+Address = Tuple[str, int]
+
+
+class PeerRecord:
+    '''
+    一个候选 peer 地址的连接历史
+    '''
+    def __init__(self, addr: Address):
+        self.addr = addr
+        self.failures = 0
+        self.attempts = 0
+        self.next_attempt = 0.0
+        self.last_error: str | None = None
+        self.connected = False
+        self.connecting = False
+        # 对方连进来的，端口是对方的临时端口，断开后不去重连
+        self.incoming = False
+
+    def __repr__(self):
+        return f'PeerRecord({self.addr}, failures={self.failures}, connected={self.connected})'
+
+
+class ConnectionManager:
+    '''
+    并发地连接候选 peer：同时进行的连接和握手不超过 max_connecting 个，已建立的连接不超过 max_connections 个。
+    连接失败的地址按指数退避重试，退避时间最长 max_backoff 秒，失败次数太多的地址不再尝试。
+    '''
+    def __init__(self, connect: Callable[[Address], Awaitable[Peer]], max_connections: int = 50,
+                 max_connecting: int = 20, base_backoff: float = 10.0, max_backoff: float = 900.0,
+                 max_failures: int = 10):
+        self._connect = connect
+        self.max_connections = max_connections
+        self.max_connecting = max_connecting
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_failures = max_failures
+
+        self.records: Dict[Address, PeerRecord] = {}
+        self.peers: Dict[Address, Peer] = {}
+        self._connecting: Set[Address] = set()
+        # 被封禁的 IP 上所有端口都不再连接
+        self.banned: Set[str] = set()
+        self._changed = asyncio.Event()
+
+        self.attempts = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.incoming = 0
+
+    @property
+    def connected(self) -> int:
+        return len(self.peers)
+
+    @property
+    def connecting(self) -> int:
+        return len(self._connecting)
+
+    def add_peers(self, addrs: Iterable[Address]) -> int:
+        added = 0
+        for addr in addrs:
+            addr = (addr[0], addr[1])
+            if addr not in self.records and addr[0] not in self.banned:
+                self.records[addr] = PeerRecord(addr)
+                added += 1
+        if added:
+            logging.debug(f'{added} new peer candidates, {len(self.records)} in total')
+            self._changed.set()
+        return added
+
+    def need_peers(self) -> bool:
+        '''
+        连接数不够而且没有可以马上尝试的候选地址时，需要从 DHT/tracker 找更多 peer
+        '''
+        if self.connected + self.connecting >= self.max_connections:
+            return False
+        now = time.monotonic()
+        return not any(self._eligible(r, now) for r in self.records.values())
+
+    def wanted(self) -> int:
+        '''
+        现有的连接加上马上可以尝试的候选地址，Session 按这个分配连接数
+        '''
+        now = time.monotonic()
+        return self.connected + self.connecting + sum(1 for r in self.records.values() if self._eligible(r, now))
+
+    def set_limits(self, max_connections: int, max_connecting: int):
+        '''
+        调整上限。超出新上限的已有连接不会断开，只是不再发起新连接
+        '''
+        if (max_connections, max_connecting) == (self.max_connections, self.max_connecting):
+            return
+        self.max_connections = max_connections
+        self.max_connecting = max_connecting
+        self._changed.set()
+
+    def _eligible(self, record: PeerRecord, now: float) -> bool:
+        return (not record.connected and not record.connecting and record.failures < self.max_failures
+                and record.next_attempt <= now)
+
+    def _backoff(self, failures: int) -> float:
+        delay = min(self.max_backoff, self.base_backoff * 2 ** (failures - 1))
+        # 加一点抖动，避免同一批失败的地址同时重试
+        return delay * random.uniform(0.8, 1.2)
+
+    def _candidates(self, n: int) -> List[PeerRecord]:
+        now = time.monotonic()
+        # 优先尝试没失败过的地址
+        eligible = [r for r in self.records.values() if self._eligible(r, now)]
+        eligible.sort(key=lambda r: r.failures)
+        return eligible[:n]
+
+    def _start_attempts(self):
+        free = min(self.max_connecting - self.connecting,
+                   self.max_connections - self.connected - self.connecting)
+        if free <= 0:
+            return
+        for record in self._candidates(free):
+            record.connecting = True
+            record.attempts += 1
+            self._connecting.add(record.addr)
+            self.attempts += 1
+            asyncio.create_task(self._attempt(record))
+
+    async def _attempt(self, record: PeerRecord):
+        try:
+            peer = await self._connect(record.addr)
+        except Exception as e:
+            record.failures += 1
+            record.last_error = str(e) or type(e).__name__
+            record.next_attempt = time.monotonic() + self._backoff(record.failures)
+            self.failed += 1
+            logging.debug(f'failed to connect to peer {record.addr} ({record.failures} failures): {record.last_error}')
+        else:
+            record.failures = 0
+            record.last_error = None
+            record.connected = True
+            self.peers[record.addr] = peer
+            self.succeeded += 1
+            logging.info(f'connected to peer {record.addr}, {self.connected} connections')
+        finally:
+            record.connecting = False
+            self._connecting.discard(record.addr)
+            self._changed.set()
+
+    def accepted(self, addr: Address, peer: Peer) -> bool:
+        '''
+        对方连进来的连接也占用连接数，连接数已满时返回 False
+        '''
+        addr = (addr[0], addr[1])
+        if addr[0] in self.banned or self.connected >= self.max_connections or addr in self.peers:
+            return False
+        record = self.records.get(addr)
+        if record is None:
+            record = self.records[addr] = PeerRecord(addr)
+            record.incoming = True
+        record.connected = True
+        self.peers[addr] = peer
+        self.incoming += 1
+        logging.info(f'accepted peer {addr}, {self.connected} connections')
+        return True
+
+    def ban(self, ip: str):
+        '''
+        不再连接这个 IP，已有的候选地址直接标记为失效
+        '''
+        self.banned.add(ip)
+        for record in self.records.values():
+            if record.addr[0] == ip:
+                record.failures = self.max_failures
+                record.last_error = 'banned'
+
+    def disconnected(self, addr: Address):
+        '''
+        已建立的连接断开：不算失败，但也不马上重连
+        '''
+        record = self.records.get(addr)
+        self.peers.pop(addr, None)
+        if record is None:
+            return
+        if record.incoming:
+            del self.records[addr]
+            self._changed.set()
+            return
+        record.connected = False
+        record.next_attempt = time.monotonic() + self.base_backoff
+        self._changed.set()
+
+    def _next_wakeup(self) -> float | None:
+        now = time.monotonic()
+        times = [r.next_attempt - now for r in self.records.values()
+                 if not r.connected and not r.connecting and r.failures < self.max_failures and r.next_attempt > now]
+        return min(times, default=None)
+
+    async def run(self):
+        while True:
+            self._changed.clear()
+            self._start_attempts()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout=self._next_wakeup())
+            except TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'candidates': len(self.records),
+            'connected': self.connected,
+            'connecting': self.connecting,
+            'attempts': self.attempts,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'incoming': self.incoming,
+            'dead': sum(1 for r in self.records.values() if r.failures >= self.max_failures),
+            'banned': len(self.banned),
+        }
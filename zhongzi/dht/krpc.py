@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import os
 from typing import Dict, List, Tuple
 from ..bencode import Encoder, Decoder
 from .util import decode_addr
@@ -12,7 +13,7 @@ class KRPCProtocol(asyncio.DatagramProtocol):
         self.transaction_id = 1
 
         if node_id is None:
-            node_id = bytes.fromhex("8df9e68813c4232db0506c897ae4c210daa98250")
+            node_id = os.urandom(20)
         self.node_id = node_id
 
     def connection_made(self, transport):
@@ -1,4 +1,5 @@
 import asyncio
+import os
 from typing import Tuple, List, Set
 from .krpc import KRPCProtocol
 from .node import Node
@@ -8,8 +9,9 @@ from .util import decode_id
 
 
 class DHTServer:
-    def __init__(self, bind: Tuple[str, int], ids: bytes):
-        self._ids = ids
+    def __init__(self, bind: Tuple[str, int], ids: bytes | None = None):
+        # node id 默认随机生成，所有用户共用一个固定 id 会挤在路由表的同一个位置
+        self._ids = os.urandom(20) if ids is None else ids
         self.id = decode_id(self._ids)
         self.bind = bind
         self._bootstrap_nodes = [
@@ -27,6 +29,9 @@ class DHTServer:
         )
         self.protocol = protocol
 
+    def close(self):
+        self.protocol.transport.close()
+
     async def bootstrap(self, max_nodes: int | None):
         async def _find_node_with_catch(node: Node):
             try:
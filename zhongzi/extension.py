@@ -0,0 +1,187 @@
+import ipaddress
+import struct
+import time
+from typing import Dict, Iterable, List, Set, Tuple
+from . import bencode
+
+
+Address = Tuple[str, int]
+
+# 握手 reserved 字段里的扩展协议标志位（第 6 个字节的 0x10），BEP 10
+EXTENSION_BYTE = 5
+EXTENSION_BIT = 0x10
+EXTENDED_HANDSHAKE_ID = 0
+# 我们支持的扩展以及对方发给我们时使用的消息编号
+LOCAL_EXTENSIONS = {'ut_pex': 1, 'ut_metadata': 2}
+CLIENT_NAME = 'zhongzi'
+
+# BEP 11：同一个 peer 最多每分钟发一次 PEX，每次最多 50 个新增和 50 个断开的地址
+PEX_INTERVAL = 60.0
+MAX_PEX_PEERS = 50
+
+# BEP 9：元数据按 16KiB 分块传输
+METADATA_PIECE_SIZE = 2**14
+METADATA_REQUEST = 0
+METADATA_DATA = 1
+METADATA_REJECT = 2
+
+
+class ExtendedHandshake:
+    '''
+    扩展握手：m 是扩展名到消息编号的映射，编号为 0 表示不支持
+    '''
+    def __init__(self, extensions: Dict[str, int], listen_port: int | None = None, client: str | None = None,
+                 metadata_size: int | None = None):
+        self.extensions = extensions
+        self.listen_port = listen_port
+        self.client = client
+        # info 字典的字节数，ut_metadata 用
+        self.metadata_size = metadata_size
+
+    def encode(self) -> bytes:
+        d = {b'm': {name.encode(): id for name, id in sorted(self.extensions.items())}}
+        if self.metadata_size is not None:
+            d[b'metadata_size'] = self.metadata_size
+        if self.listen_port is not None:
+            d[b'p'] = self.listen_port
+        if self.client is not None:
+            d[b'v'] = self.client.encode('utf-8')
+        return bytes(bencode.Encoder(dict(sorted(d.items()))).encode())
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        d = bencode.Decoder(payload).decode()
+        if not isinstance(d, dict):
+            raise ValueError('extended handshake is not a dict')
+        m = d.get(b'm', {})
+        if not isinstance(m, dict):
+            raise ValueError('bad extension map')
+        extensions = {name.decode('utf-8', 'replace'): id for name, id in m.items()
+                      if isinstance(id, int) and 0 < id < 256}
+        port = d.get(b'p')
+        client = d.get(b'v')
+        metadata_size = d.get(b'metadata_size')
+        return cls(extensions,
+                   port if isinstance(port, int) and 0 < port < 65536 else None,
+                   client.decode('utf-8', 'replace') if isinstance(client, bytes) else None,
+                   metadata_size if isinstance(metadata_size, int) and metadata_size > 0 else None)
+
+
+def encode_peers(addrs: Iterable[Address]) -> Tuple[bytes, bytes]:
+    '''
+    compact 格式，返回 (IPv4, IPv6)
+    '''
+    v4 = bytearray()
+    v6 = bytearray()
+    for host, port in addrs:
+        ip = ipaddress.ip_address(host)
+        if ip.version == 4:
+            v4 += ip.packed + struct.pack('>H', port)
+        else:
+            v6 += ip.packed + struct.pack('>H', port)
+    return bytes(v4), bytes(v6)
+
+
+def decode_peers(data: bytes, version: int = 4) -> List[Address]:
+    size = 4 if version == 4 else 16
+    addrs = []
+    for i in range(0, len(data) - len(data) % (size + 2), size + 2):
+        ip = ipaddress.ip_address(data[i:i + size])
+        port = struct.unpack_from('>H', data, i + size)[0]
+        if port != 0:
+            addrs.append((str(ip), port))
+    return addrs
+
+
+class PexMessage:
+    '''
+    ut_pex：和上一条 PEX 消息相比新连上和断开的 peer
+    '''
+    def __init__(self, added: List[Address], dropped: List[Address]):
+        self.added = added
+        self.dropped = dropped
+
+    def encode(self) -> bytes:
+        added, added6 = encode_peers(self.added)
+        dropped, dropped6 = encode_peers(self.dropped)
+        d = {
+            b'added': added,
+            b'added.f': bytes(len(added) // 6),
+            b'added6': added6,
+            b'added6.f': bytes(len(added6) // 18),
+            b'dropped': dropped,
+            b'dropped6': dropped6,
+        }
+        return bytes(bencode.Encoder(d).encode())
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        d = bencode.Decoder(payload).decode()
+        if not isinstance(d, dict):
+            raise ValueError('pex message is not a dict')
+
+        def peers(key: bytes, version: int) -> List[Address]:
+            value = d.get(key, b'')
+            return decode_peers(value, version) if isinstance(value, bytes) else []
+
+        return cls(peers(b'added', 4) + peers(b'added6', 6), peers(b'dropped', 4) + peers(b'dropped6', 6))
+
+
+class MetadataMessage:
+    '''
+    ut_metadata：msg_type 为请求、数据或拒绝，数据消息的 bencode 字典后面紧跟着这一块元数据
+    '''
+    def __init__(self, msg_type: int, piece: int, total_size: int | None = None, data: bytes = b''):
+        self.msg_type = msg_type
+        self.piece = piece
+        self.total_size = total_size
+        self.data = data
+
+    def encode(self) -> bytes:
+        d = {b'msg_type': self.msg_type, b'piece': self.piece}
+        if self.total_size is not None:
+            d[b'total_size'] = self.total_size
+        return bytes(bencode.Encoder(d).encode()) + self.data
+
+    @classmethod
+    def decode(cls, payload: bytes):
+        decoder = bencode.Decoder(payload)
+        d = decoder.decode()
+        if not isinstance(d, dict) or not isinstance(d.get(b'msg_type'), int) or not isinstance(d.get(b'piece'), int):
+            raise ValueError('bad metadata message')
+        total_size = d.get(b'total_size')
+        return cls(d[b'msg_type'], d[b'piece'], total_size if isinstance(total_size, int) else None,
+                   payload[decoder.position:])
+
+
+class PeerExchange:
+    '''
+    记录发给每个 peer 的 PEX 状态，每次只发送和上次相比的变化
+    '''
+    def __init__(self, interval: float = PEX_INTERVAL):
+        self.interval = interval
+        self._sent: Dict[Address, Set[Address]] = {}
+        self._last: Dict[Address, float] = {}
+
+    def update(self, addr: Address, connected: Set[Address], now: float | None = None) -> PexMessage | None:
+        '''
+        connected 是当前连接着的 peer，距离上次发送不到 interval 秒或者没有变化时返回 None
+        '''
+        now = time.monotonic() if now is None else now
+        last = self._last.get(addr)
+        if last is not None and now - last < self.interval:
+            return None
+
+        sent = self._sent.get(addr, set())
+        current = connected - {addr}
+        added = sorted(current - sent)[:MAX_PEX_PEERS]
+        dropped = sorted(sent - current)[:MAX_PEX_PEERS]
+        if not added and not dropped:
+            return None
+        self._sent[addr] = (sent | set(added)) - set(dropped)
+        self._last[addr] = now
+        return PexMessage(added, dropped)
+
+    def forget(self, addr: Address):
+        self._sent.pop(addr, None)
+        self._last.pop(addr, None)
@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from .torrent import Piece
+
+
+class PieceHasher:
+    '''
+    block 按顺序到达时直接增量计算 sha1；一旦乱序就停止，整个分片交给线程池计算
+    '''
+    def __init__(self, data: memoryview):
+        self._data = data
+        self._sha1 = hashlib.sha1()
+        self.hashed = 0
+        self.out_of_order = False
+
+    def block_received(self, offset: int, length: int):
+        if self.out_of_order:
+            return
+        if offset != self.hashed:
+            self.out_of_order = True
+            return
+        self._sha1.update(self._data[offset:offset + length])
+        self.hashed += length
+
+    @property
+    def complete(self) -> bool:
+        return not self.out_of_order and self.hashed == len(self._data)
+
+    def digest(self) -> bytes:
+        return self._sha1.digest()
+
+
+class HashPipeline:
+    '''
+    分片校验。增量计算完成的分片直接比较结果，其余的在线程池里计算（hashlib 计算时会释放 GIL）
+    '''
+    def __init__(self, max_workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sha1')
+        self.queue_depth = 0
+        self.verified = 0
+        self.failed = 0
+        self.incremental = 0
+        self._bytes_hashed = 0
+        self._hash_seconds = 0.0
+
+    async def verify(self, piece: Piece, data: memoryview, hasher: PieceHasher | None = None) -> bool:
+        if hasher is not None and hasher.complete:
+            self.incremental += 1
+            digest = hasher.digest()
+        else:
+            self.queue_depth += 1
+            try:
+                loop = asyncio.get_running_loop()
+                digest = await loop.run_in_executor(self._executor, self._sha1, data)
+            finally:
+                self.queue_depth -= 1
+
+        ok = digest == piece.checksum
+        if ok:
+            self.verified += 1
+        else:
+            self.failed += 1
+            logging.warning(f'piece {piece.index} checksum mismatch: {digest.hex()} != {piece.checksum.hex()}')
+        return ok
+
+    def _sha1(self, data: memoryview) -> bytes:
+        started = time.perf_counter()
+        digest = hashlib.sha1(data).digest()
+        self._hash_seconds += time.perf_counter() - started
+        self._bytes_hashed += len(data)
+        return digest
+
+    @property
+    def throughput(self) -> float:
+        '''
+        线程池里的 sha1 吞吐量，字节/秒
+        '''
+        if self._hash_seconds == 0:
+            return 0.0
+        return self._bytes_hashed / self._hash_seconds
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'queue_depth': self.queue_depth,
+            'verified': self.verified,
+            'failed': self.failed,
+            'incremental': self.incremental,
+            'bytes_hashed': self._bytes_hashed,
+            'throughput': self.throughput,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import struct
+from typing import Awaitable, Callable, Dict, Set, Tuple
+from .wire import PeerWireProtocol
+
+
+Address = Tuple[str, int]
+AcceptHandler = Callable[[PeerWireProtocol, Address], Awaitable[None]]
+
+
+class InboundListener:
+    '''
+    接受别人发起的连接：先读对方的握手，按 info hash 交给 register 过的种子，没有对应种子的连接直接关闭。
+    protocol_factory 也可以作为 UTPEndpoint 的 accept，这样 uTP 连接走同样的路由。
+    '''
+    def __init__(self, host: str = '0.0.0.0', port: int = 6881, handshake_timeout: float = 10.0,
+                 max_pending: int = 64):
+        self.host = host
+        self.port = port
+        self.handshake_timeout = handshake_timeout
+        # 还没收到握手的连接数上限，超过的直接关闭
+        self.max_pending = max_pending
+        self.server: asyncio.Server | None = None
+        self._handlers: Dict[bytes, AcceptHandler] = {}
+        self._pending: Set[asyncio.Task] = set()
+
+        self.accepted = 0
+        self.rejected = 0
+
+    def register(self, info_hash: bytes, handler: AcceptHandler):
+        self._handlers[info_hash] = handler
+
+    def unregister(self, info_hash: bytes):
+        self._handlers.pop(info_hash, None)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(self.protocol_factory, self.host, self.port)
+        # port 为 0 时由系统分配
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f'listening for incoming peers on {self.host}:{self.port}')
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for task in list(self._pending):
+            task.cancel()
+
+    def protocol_factory(self) -> PeerWireProtocol:
+        protocol = PeerWireProtocol()
+        task = asyncio.create_task(self._route(protocol))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+        return protocol
+
+    def _reject(self, protocol: PeerWireProtocol, addr, reason: str):
+        self.rejected += 1
+        logging.debug(f'rejected incoming connection from {addr}: {reason}')
+        protocol.close()
+
+    async def _route(self, protocol: PeerWireProtocol):
+        # 等 connection_made
+        await asyncio.sleep(0)
+        addr = protocol.transport.get_extra_info('peername') if protocol.transport is not None else None
+        if len(self._pending) > self.max_pending:
+            self._reject(protocol, addr, 'too many pending handshakes')
+            return
+        try:
+            data = await asyncio.wait_for(protocol.handshake, timeout=self.handshake_timeout)
+        except Exception as e:
+            self._reject(protocol, addr, f'no handshake: {e!r}')
+            return
+
+        pstrlen, pstr, _, info_hash, _ = struct.unpack('>B19s8s20s20s', data)
+        if pstrlen != 19 or pstr != b'BitTorrent protocol':
+            self._reject(protocol, addr, 'not a bittorrent handshake')
+            return
+        handler = self._handlers.get(info_hash)
+        if handler is None:
+            self._reject(protocol, addr, f'unknown info hash {info_hash.hex()}')
+            return
+
+        try:
+            await handler(protocol, (addr[0], addr[1]))
+        except Exception as e:
+            self._reject(protocol, addr, repr(e))
+            return
+        self.accepted += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'port': self.port,
+            'torrents': len(self._handlers),
+            'pending': len(self._pending),
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+        }
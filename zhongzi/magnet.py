@@ -0,0 +1,268 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import time
+from typing import Dict, Iterable, List, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+from .bitfield import Bitfield
+from .connection import Address, ConnectionManager
+from .dht import DHTServer
+from .extension import (METADATA_DATA, METADATA_PIECE_SIZE, METADATA_REJECT, METADATA_REQUEST, ExtendedHandshake,
+                        MetadataMessage)
+from .peer import Peer, PeerListener
+
+
+class MagnetLink:
+    '''
+    magnet:?xt=urn:btih:<info hash>&dn=<名字>&tr=<tracker>&x.pe=<host:port>，也接受单独的 info hash
+    '''
+    def __init__(self, info_hash: bytes, name: str | None = None, trackers: List[str] | None = None,
+                 peers: List[Address] | None = None):
+        self.info_hash = info_hash
+        self.name = name
+        self.trackers = trackers or []
+        self.peers = peers or []
+
+    @staticmethod
+    def _decode_hash(value: str) -> bytes:
+        if len(value) == 40:
+            return bytes.fromhex(value)
+        if len(value) == 32:
+            return base64.b32decode(value.upper())
+        raise ValueError(f'bad info hash: {value}')
+
+    @classmethod
+    def parse(cls, uri: str) -> 'MagnetLink':
+        uri = uri.strip()
+        if not uri.startswith('magnet:'):
+            return cls(cls._decode_hash(uri))
+
+        params = parse_qs(urlparse(uri).query)
+        info_hash = None
+        for xt in params.get('xt', []):
+            if xt.startswith('urn:btih:'):
+                info_hash = cls._decode_hash(xt[len('urn:btih:'):])
+                break
+        if info_hash is None:
+            raise ValueError(f'no btih info hash in magnet link: {uri}')
+
+        peers = []
+        for pe in params.get('x.pe', []):
+            host, _, port = pe.rpartition(':')
+            if host and port.isdigit():
+                peers.append((host.strip('[]'), int(port)))
+        name = params.get('dn', [None])[0]
+        return cls(info_hash, name, params.get('tr', []), peers)
+
+
+class MetadataFetcher(PeerListener):
+    '''
+    通过 ut_metadata（BEP 9）从多个 peer 并行下载 info 字典：每块分给当前请求最少的 peer，
+    超时或被拒绝的块换一个 peer 重新请求，拼好后用 info hash 校验。
+    元数据大小以第一个声明的 peer 为准，声明不同大小的 peer 直接断开；声明这个大小的 peer 都断开后从头再来，
+    这样第一个 peer 说了假的大小也不会一直卡住。
+    '''
+    def __init__(self, info_hash: bytes, peer_id: str, max_peers: int = 8, max_requests: int = 2,
+                 request_timeout: float = 10.0, max_metadata_size: int = 2**24):
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.max_requests = max_requests
+        self.request_timeout = request_timeout
+        self.max_metadata_size = max_metadata_size
+        self.connections = ConnectionManager(self.open_peer, max_connections=max_peers, max_connecting=max_peers)
+
+        self.peers: List[Peer] = []
+        self.metadata_size: int | None = None
+        # 能提供元数据的 peer 声明的大小
+        self._claims: Dict[Peer, int] = {}
+        self._num_pieces = 0
+        self._received: Dict[int, bytes] = {}
+        self._senders: Dict[int, Peer] = {}
+        # 元数据块 -> (请求的 peer, 请求时间)
+        self._requested: Dict[int, Tuple[Peer, float]] = {}
+        # peer -> 它拒绝过的块
+        self._rejected: Dict[Peer, Set[int]] = {}
+        self._done: asyncio.Future | None = None
+        self.hash_failures = 0
+        # 下载元数据时连上过的 peer，之后可以直接交给 TorrentClient
+        self.known_peers: List[Address] = []
+
+    async def open_peer(self, addr: Address) -> Peer:
+        p = Peer(self.peer_id, self.info_hash, addr, listener=self)
+        # 还不知道分片数量，告诉对方我们什么都没有
+        await p.connect(Bitfield(0))
+        if not p.extended:
+            p.close()
+            raise ConnectionError(f'peer {addr} does not support the extension protocol')
+        self.peers.append(p)
+        asyncio.create_task(p.run())
+        return p
+
+    def peer_extended_handshake(self, peer: Peer, handshake: ExtendedHandshake):
+        size = handshake.metadata_size
+        if not peer.supports('ut_metadata') or size is None:
+            logging.debug(f'peer {peer} cannot send metadata')
+            return
+        if size > self.max_metadata_size:
+            logging.warning(f'peer {peer} claims metadata of {size} bytes, ignoring it')
+            return
+        if self.metadata_size is None:
+            self.metadata_size = size
+            self._num_pieces = (size + METADATA_PIECE_SIZE - 1) // METADATA_PIECE_SIZE
+            logging.info(f'metadata is {size} bytes in {self._num_pieces} pieces')
+        elif size != self.metadata_size:
+            logging.warning(f'peer {peer} claims metadata of {size} bytes, expected {self.metadata_size}, dropping it')
+            peer.close()
+            return
+        self._claims[peer] = size
+        self._rejected[peer] = set()
+        self._request_more()
+
+    def peer_extension_message(self, peer: Peer, name: str, payload: bytes):
+        if name != 'ut_metadata':
+            return
+        try:
+            msg = MetadataMessage.decode(payload)
+        except Exception as e:
+            logging.warning(f'bad metadata message from {peer}: {e}')
+            return
+
+        if msg.msg_type == METADATA_REQUEST:
+            # 我们自己也还没有元数据
+            asyncio.create_task(self._send(peer, MetadataMessage(METADATA_REJECT, msg.piece)))
+        elif msg.msg_type == METADATA_DATA:
+            self._data_received(peer, msg)
+        elif msg.msg_type == METADATA_REJECT:
+            logging.debug(f'peer {peer} rejected metadata piece {msg.piece}')
+            if self._requested.get(msg.piece, (None,))[0] is peer:
+                del self._requested[msg.piece]
+            self._rejected.setdefault(peer, set()).add(msg.piece)
+            self._request_more()
+
+    def peer_closed(self, peer: Peer):
+        if peer in self.peers:
+            self.peers.remove(peer)
+        self._rejected.pop(peer, None)
+        self._claims.pop(peer, None)
+        for piece in [i for i, (p, _) in self._requested.items() if p is peer]:
+            del self._requested[piece]
+        self.connections.disconnected(peer.addr)
+        if self.metadata_size is not None and self.metadata_size not in self._claims.values():
+            self._restart()
+        self._request_more()
+
+    def _restart(self):
+        '''
+        没有 peer 再声明当前的元数据大小，它可能是假的：忘掉它，由下一个 peer 的扩展握手重新确定
+        '''
+        logging.info(f'no peer left claiming metadata of {self.metadata_size} bytes, starting over')
+        self.metadata_size = None
+        self._num_pieces = 0
+        self._received.clear()
+        self._senders.clear()
+        self._requested.clear()
+
+    def _piece_length(self, piece: int) -> int:
+        return min(METADATA_PIECE_SIZE, self.metadata_size - piece * METADATA_PIECE_SIZE)
+
+    def _data_received(self, peer: Peer, msg: MetadataMessage):
+        piece = msg.piece
+        if self.metadata_size is None or not 0 <= piece < self._num_pieces or piece in self._received:
+            return
+        if len(msg.data) != self._piece_length(piece):
+            logging.warning(f'metadata piece {piece} from {peer} has {len(msg.data)} bytes')
+            return
+        if self._requested.get(piece, (None,))[0] is peer:
+            del self._requested[piece]
+        self._received[piece] = msg.data
+        self._senders[piece] = peer
+        logging.debug(f'metadata piece {piece} from {peer}, {len(self._received)}/{self._num_pieces}')
+        if len(self._received) == self._num_pieces:
+            self._assemble()
+        else:
+            self._request_more()
+
+    def _assemble(self):
+        info = b''.join(self._received[i] for i in range(self._num_pieces))
+        if hashlib.sha1(info).digest() == self.info_hash:
+            logging.info(f'got metadata from {len(set(self._senders.values()))} peers')
+            if self._done is not None and not self._done.done():
+                self._done.set_result(info)
+            return
+
+        self.hash_failures += 1
+        senders = set(self._senders.values())
+        logging.warning(f'metadata does not match the info hash, fetching again ({self.hash_failures} failures)')
+        if len(senders) == 1:
+            # 全部来自同一个 peer，不再找它要
+            senders.pop().close()
+        self._received.clear()
+        self._senders.clear()
+        self._request_more()
+
+    async def _send(self, peer: Peer, msg: MetadataMessage):
+        try:
+            await peer.send_extended('ut_metadata', msg.encode())
+        except Exception as e:
+            logging.debug(f'failed to send metadata message to {peer}: {e}')
+
+    def _request_more(self):
+        if self.metadata_size is None or (self._done is not None and self._done.done()):
+            return
+        now = time.monotonic()
+        load: Dict[Peer, int] = {p: 0 for p in self._rejected if p in self.peers}
+        for p, _ in self._requested.values():
+            if p in load:
+                load[p] += 1
+
+        for piece in range(self._num_pieces):
+            if piece in self._received:
+                continue
+            requested = self._requested.get(piece)
+            if requested is not None and now - requested[1] < self.request_timeout:
+                continue
+            candidates = [p for p, n in load.items() if n < self.max_requests and piece not in self._rejected[p]
+                          and (requested is None or p is not requested[0])]
+            if not candidates:
+                continue
+            peer = min(candidates, key=lambda p: load[p])
+            load[peer] += 1
+            self._requested[piece] = (peer, now)
+            asyncio.create_task(self._send(peer, MetadataMessage(METADATA_REQUEST, piece)))
+
+    async def _find_peers(self, dht: DHTServer):
+        while True:
+            if not self.connections.need_peers():
+                await asyncio.sleep(10)
+                continue
+            await dht.bootstrap(max_nodes=100)
+            peers = await dht.get_peers(self.info_hash)
+            logging.info(f'got {len(peers)} peers from DHT network for metadata')
+            if not self.connections.add_peers(peers):
+                await asyncio.sleep(10)
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(self.request_timeout / 4)
+            self._request_more()
+
+    async def fetch(self, dht: DHTServer | None = None, peers: Iterable[Address] = (),
+                    timeout: float | None = 600.0) -> bytes:
+        '''
+        返回校验过的 info 字典。peers 是已知的 peer（比如磁力链接里的 x.pe），dht 不为 None 时继续从 DHT 找 peer。
+        timeout 秒之内没有拿到时抛出 TimeoutError
+        '''
+        self._done = asyncio.get_running_loop().create_future()
+        self.connections.add_peers(peers)
+        tasks = [asyncio.create_task(self.connections.run()), asyncio.create_task(self._expire())]
+        if dht is not None:
+            tasks.append(asyncio.create_task(self._find_peers(dht)))
+        try:
+            return await asyncio.wait_for(self._done, timeout)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.known_peers = [p.addr for p in self.peers]
+            for peer in list(self.peers):
+                peer.close()
@@ -1,5 +1,4 @@
 import struct
-import asyncio
 from enum import Enum
 import logging
 
@@ -17,6 +16,21 @@ class PeerMessage(Enum):
     Request = 6
     Piece = 7
     Cancel = 8
+    # BEP 6 Fast Extension
+    Suggest = 0x0d
+    HaveAll = 0x0e
+    HaveNone = 0x0f
+    RejectRequest = 0x10
+    AllowedFast = 0x11
+    # BEP 10 Extension Protocol
+    Extended = 20
+
+
+_HEADER = struct.Struct('>Ib')
+_INDEX = struct.Struct('>I')
+_BLOCK = struct.Struct('>III')
+_PIECE_HEADER = struct.Struct('>II')
+_PIECE_MESSAGE_HEADER = struct.Struct('>IbII')
 
 
 class KeepAlive:
@@ -37,6 +51,9 @@ class Choke:
     def __str__(self):
         return 'Choke'
 
+    def encode(self) -> bytes:
+        return _HEADER.pack(1, PeerMessage.Choke.value)
+
 
 class Unchoke:
     '''
@@ -44,6 +61,9 @@ class Unchoke:
     '''
     def __str__(self):
         return 'Unchoke'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(1, PeerMessage.Unchoke.value)
     
 
 class Interested:
@@ -53,8 +73,8 @@ class Interested:
     def __str__(self):
         return 'Interested'
 
-    def decode(self) -> bytes:
-        return struct.pack('>Ib', 1, PeerMessage.Interested.value)
+    def encode(self) -> bytes:
+        return _HEADER.pack(1, PeerMessage.Interested.value)
 
 
 class NotInterested:
@@ -63,6 +83,9 @@ class NotInterested:
     '''
     def __str__(self):
         return 'NotInterested'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(1, PeerMessage.NotInterested.value)
     
 
 class Have:
@@ -83,7 +106,7 @@ class Have:
         
     @classmethod
     def decode(cls, data: bytes):
-        piece_index = struct.unpack('>I', data)[0]
+        piece_index = _INDEX.unpack(data)[0]
         return Have(piece_index)
 
 
@@ -96,11 +119,13 @@ class Bitfield:
 
     def __str__(self):
         return 'Bitfield'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(1 + len(self.bitfield), PeerMessage.Bitfield.value) + self.bitfield
     
     @classmethod
     def decode(cls, data: bytes):
-        parts = struct.unpack('>' + str(len(data)) + 's', data)
-        return cls(parts[0])
+        return cls(bytes(data))
 
 
 class Request:
@@ -120,6 +145,11 @@ class Request:
                            self.begin,
                            self.length)
 
+    @classmethod
+    def decode(cls, data: bytes):
+        parts = _BLOCK.unpack(data)
+        return cls(parts[0], parts[1], parts[2])
+
     def __str__(self):
         return 'Request'
     
@@ -127,8 +157,10 @@ class Request:
 class Piece:
     '''
     |len=9+X|id=7|index|begin|block|
+
+    block 可能是 memoryview，只在收到消息的回调里有效
     '''
-    def __init__(self, index: int, begin: int, block: bytes):
+    def __init__(self, index: int, begin: int, block: bytes | memoryview):
         self.index = index
         self.begin = begin
         self.block = block
@@ -136,10 +168,14 @@ class Piece:
     def __str__(self):
         return 'Piece'
 
+    def encode(self) -> bytes:
+        return _PIECE_MESSAGE_HEADER.pack(9 + len(self.block), PeerMessage.Piece.value,
+                                          self.index, self.begin) + self.block
+
     @classmethod
-    def decode(cls, data: bytes):
-        parts = struct.unpack('>II'+str(len(data)-8)+'s', data)
-        return cls(parts[0], parts[1], parts[2])
+    def decode(cls, data: bytes | memoryview):
+        index, begin = _PIECE_HEADER.unpack_from(data)
+        return cls(index, begin, memoryview(data)[_PIECE_HEADER.size:])
     
 
 class Cancel:
@@ -151,28 +187,124 @@ class Cancel:
         self.begin = begin
         self.length = length
 
+    def encode(self) -> bytes:
+        return struct.pack('>IbIII',
+                           13,
+                           PeerMessage.Cancel.value,
+                           self.index,
+                           self.begin,
+                           self.length)
+
     @classmethod
     def decode(cls, data: bytes):
-        parts = struct.unpack('>III', data)
+        parts = _BLOCK.unpack(data)
         return cls(parts[0], parts[1], parts[2])
 
     def __str__(self):
         return 'Cancel'
 
 
-async def parse_one_message(reader: asyncio.StreamReader) -> KeepAlive | Choke:
-    length_bytes = await reader.readexactly(4)
-    length = struct.unpack('>I', length_bytes)[0]
-    if length == 0:
-        return KeepAlive()
-    
-    id_bytes = await reader.readexactly(1)
-    id = struct.unpack('>b', id_bytes)[0]
+class Suggest:
+    '''
+    |len=5|id=0x0d|piece_index|
+    '''
+    def __init__(self, piece_index: int):
+        self.piece_index = piece_index
+
+    def __str__(self):
+        return 'Suggest'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(5, PeerMessage.Suggest.value) + _INDEX.pack(self.piece_index)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        return cls(_INDEX.unpack(data)[0])
+
+
+class HaveAll:
+    '''
+    |len=1|id=0x0e|
+    '''
+    def __str__(self):
+        return 'HaveAll'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(1, PeerMessage.HaveAll.value)
+
+
+class HaveNone:
+    '''
+    |len=1|id=0x0f|
+    '''
+    def __str__(self):
+        return 'HaveNone'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(1, PeerMessage.HaveNone.value)
+
+
+class RejectRequest:
+    '''
+    |len=13|id=0x10|index|begin|length|
+    '''
+    def __init__(self, index = 0, begin = 0, length: int = 2**14):
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(13, PeerMessage.RejectRequest.value) + _BLOCK.pack(self.index, self.begin, self.length)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        parts = _BLOCK.unpack(data)
+        return cls(parts[0], parts[1], parts[2])
+
+    def __str__(self):
+        return 'RejectRequest'
+
+
+class AllowedFast:
+    '''
+    |len=5|id=0x11|piece_index|
+    '''
+    def __init__(self, piece_index: int):
+        self.piece_index = piece_index
+
+    def __str__(self):
+        return 'AllowedFast'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(5, PeerMessage.AllowedFast.value) + _INDEX.pack(self.piece_index)
+
+    @classmethod
+    def decode(cls, data: bytes):
+        return cls(_INDEX.unpack(data)[0])
+
+
+class Extended:
+    '''
+    |len=2+X|id=20|extended_id|payload|
+
+    extended_id 为 0 是扩展握手，其余是对方在握手里声明的扩展消息编号
+    '''
+    def __init__(self, extended_id: int, payload: bytes):
+        self.extended_id = extended_id
+        self.payload = payload
+
+    def __str__(self):
+        return 'Extended'
+
+    def encode(self) -> bytes:
+        return _HEADER.pack(2 + len(self.payload), PeerMessage.Extended.value) + bytes([self.extended_id]) + self.payload
+
+    @classmethod
+    def decode(cls, data: bytes | memoryview):
+        return cls(data[0], bytes(data[1:]))
 
-    data = b''
-    if length > 1:
-        data = await reader.readexactly(length - 1)
 
+def decode_message(id: int, data: bytes | memoryview):
     match id:
         case PeerMessage.Choke.value:
             logging.info('received choke message')
@@ -195,8 +327,9 @@ async def parse_one_message(reader: asyncio.StreamReader) -> KeepAlive | Choke:
             logging.info(f'received bitfield message')
             return b
         case PeerMessage.Request.value:
-            logging.info('received request message')
-            return Request()
+            r = Request.decode(data)
+            logging.info(f'received request message {r.index}-{r.begin}-{r.length}')
+            return r
         case PeerMessage.Piece.value:
             p = Piece.decode(data)
             logging.info(f'received piece message {p.index}-{p.begin}-{len(p.block)}')
@@ -205,23 +338,29 @@ async def parse_one_message(reader: asyncio.StreamReader) -> KeepAlive | Choke:
             c = Cancel.decode(data)
             logging.info('received cancel message')
             return c
+        case PeerMessage.Suggest.value:
+            s = Suggest.decode(data)
+            logging.info(f'received suggest message: {s.piece_index}')
+            return s
+        case PeerMessage.HaveAll.value:
+            logging.info('received have all message')
+            return HaveAll()
+        case PeerMessage.HaveNone.value:
+            logging.info('received have none message')
+            return HaveNone()
+        case PeerMessage.RejectRequest.value:
+            r = RejectRequest.decode(data)
+            logging.info(f'received reject request message {r.index}-{r.begin}-{r.length}')
+            return r
+        case PeerMessage.AllowedFast.value:
+            a = AllowedFast.decode(data)
+            logging.info(f'received allowed fast message: {a.piece_index}')
+            return a
+        case PeerMessage.Extended.value:
+            e = Extended.decode(data)
+            logging.debug(f'received extended message {e.extended_id}, {len(e.payload)} bytes')
+            return e
         case _:
             logging.error(f'unknown message id: {id}')
             raise ValueError(f'unknown message id: {id}')
 
-
-class PeerMessageIterator:
-    def __init__(self, reader: asyncio.StreamReader):
-        self.reader = reader
-
-    def __aiter__(self):
-        return self
-    
-    async def __anext__(self):
-        try:
-            return await parse_one_message(self.reader)
-        except Exception as e:
-            logging.info(f'peer message exception: {e}')
-            if self.reader.at_eof():
-                logging.error(f'peer message iterator stopped')
-                raise StopAsyncIteration()
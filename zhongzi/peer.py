@@ -1,12 +1,30 @@
 import asyncio
+import hashlib
+import ipaddress
 import logging
 import struct
-from .message import parse_one_message
 from . import message
+from .wire import PeerWireProtocol
+from .utp import UTPEndpoint
 from enum import Enum
-from .torrent import Piece
-import hashlib
-from typing import Dict
+from .bitfield import Bitfield
+from .extension import (CLIENT_NAME, EXTENDED_HANDSHAKE_ID, EXTENSION_BIT, EXTENSION_BYTE, LOCAL_EXTENSIONS,
+                        ExtendedHandshake)
+from .stats import LatencyStats, RateMeter
+import time
+from collections import deque
+from typing import Deque, Dict, List, Set, Tuple
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class RequestRejected(Exception):
+    '''
+    对方用 RejectRequest 明确拒绝了请求（BEP 6）
+    '''
+    pass
 
 
 class PeerState(Enum):
@@ -14,29 +32,203 @@ class PeerState(Enum):
     Choked = 1 << 2
 
 
+class PeerListener:
+    '''
+    Peer 事件回调，默认实现什么都不做
+    '''
+    def peer_have(self, peer: 'Peer', piece_index: int):
+        pass
+
+    def peer_bitfield(self, peer: 'Peer', pieces: Bitfield):
+        pass
+
+    def peer_closed(self, peer: 'Peer'):
+        pass
+
+    def peer_choked(self, peer: 'Peer'):
+        pass
+
+    def peer_unchoked(self, peer: 'Peer'):
+        pass
+
+    def peer_allowed_fast(self, peer: 'Peer', piece_index: int):
+        pass
+
+    def peer_extended_handshake(self, peer: 'Peer', handshake: ExtendedHandshake):
+        pass
+
+    def peer_extension_message(self, peer: 'Peer', name: str, payload: bytes):
+        '''
+        对方发来的扩展消息，name 是 LOCAL_EXTENSIONS 里的扩展名
+        '''
+        pass
+
+    async def read_block(self, peer: 'Peer', piece_index: int, begin: int, length: int) -> bytes | memoryview | None:
+        '''
+        peer 请求的数据，没有（还没校验或还没写盘）时返回 None
+        '''
+        return None
+
+
+# 单个 Request 最多请求的字节数，超过的请求直接忽略
+MAX_REQUEST_LENGTH = 2**17
+# 每个 peer 最多排队的上传请求
+MAX_UPLOAD_QUEUE = 256
+# 同时发出的请求数量随下载速率增长，保证请求队列里有大约 REQUEST_QUEUE_TIME 秒的数据
+REQUEST_QUEUE_TIME = 2.0
+MAX_PIPELINE_DEPTH = 256
+
+# 握手 reserved 字段里的 Fast Extension 标志位（第 8 个字节的 0x04）
+FAST_EXTENSION_BYTE = 7
+FAST_EXTENSION_BIT = 0x04
+# 给每个 peer 的 allowed fast 分片数
+ALLOWED_FAST_COUNT = 10
+# 最多记住对方最近建议的多少个分片
+MAX_SUGGESTED = 16
+
+_FAST_MESSAGES = (message.Suggest, message.HaveAll, message.HaveNone, message.RejectRequest, message.AllowedFast)
+
+
+def allowed_fast_set(ip: str, info_hash: bytes, num_pieces: int, k: int = ALLOWED_FAST_COUNT) -> List[int]:
+    '''
+    BEP 6 规定的 allowed fast 集合算法，只对 IPv4 地址有定义
+    '''
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return []
+    if addr.version != 4 or num_pieces == 0:
+        return []
+
+    k = min(k, num_pieces)
+    result: List[int] = []
+    x = (int(addr) & 0xffffff00).to_bytes(4, 'big') + info_hash
+    while len(result) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(5):
+            if len(result) >= k:
+                break
+            index = struct.unpack_from('>I', x, i * 4)[0] % num_pieces
+            if index not in result:
+                result.append(index)
+    return result
+
+
 class Peer:
-    def __init__(self, my_peer_id: str, info_hash: bytes, peer_addr: tuple):
+    def __init__(self, my_peer_id: str, info_hash: bytes, peer_addr: tuple, pipeline_depth: int = 5,
+                 listener: PeerListener | None = None, num_pieces: int = 0, metadata_size: int | None = None,
+                 utp: UTPEndpoint | None = None, listen_port: int | None = None):
         self._peer_addr = peer_addr
+        # 不为 None 时通过这个 uTP 端点连接，否则用 TCP
+        self._utp = utp
+        self._listener = listener or PeerListener()
         self._my_peer_id = my_peer_id.encode('utf-8')
         self._info_hash = info_hash
         self._state_stopped()
-        self._remote_pieces = {}
+        # num_pieces 为 0 表示分片数量未知（还在下载元数据），这时忽略 Have、Bitfield 和 HaveAll
+        self._num_pieces = num_pieces
+        self._remote_pieces = Bitfield(num_pieces)
+        # 对方是否支持 Fast Extension，握手时确定
+        self.fast = False
+        # 对方允许我们在被 choke 时请求的分片
+        self.allowed_fast: Set[int] = set()
+        # 对方建议我们下载的分片，最近的在后面
+        self.suggested: Deque[int] = deque(maxlen=MAX_SUGGESTED)
+        self.rejected = 0
+        # 对方是否支持扩展协议（BEP 10），以及扩展握手里声明的扩展名 -> 消息编号
+        self.extended = False
+        self.extensions: Dict[str, int] = {}
+        self.client_name: str | None = None
+        # 对方在扩展握手里声明的监听端口
+        self.remote_listen_port: int | None = None
+        # 对方主动连进来时，peer_addr 里的是对方的临时端口
+        self.inbound = False
+        # 我们监听的端口，在扩展握手里告诉对方，对方才能把我们通过 PEX 告诉别人
+        self.listen_port = listen_port
+        # 我们的 info 字典大小，在扩展握手里告诉对方；从磁力链接启动、还没有元数据时为 None
+        self.metadata_size = metadata_size
+
+        # 同一连接上至少允许同时发出 pipeline_depth 个 Request，速率快时更多（见 request_slots）
+        self.pipeline_depth = pipeline_depth
+        self.futures: Dict[Tuple[int, int], asyncio.Future] = {}
+        # 已经发出、尚未收到回复的请求
+        self._inflight: Dict[Tuple[int, int], message.Request] = {}
+
+        # 上传：我们是否 choke 对方，对方是否对我们的数据感兴趣
+        self.am_choking = True
+        self.peer_interested = False
+        self._uploads: Deque[message.Request] = deque()
+        self._uploader: asyncio.Task | None = None
+        # 正在读取的请求，读取期间收到 Cancel 时置为 None
+        self._serving: Tuple[int, int, int] | None = None
+        # 我们允许对方在被 choke 时请求的分片
+        self._allowed_fast_sent: Set[int] = set()
+        self.uploaded = 0
+        self.downloaded = 0
+        self.download_rate = RateMeter()
+        self.upload_rate = RateMeter()
+        # 从发出 Request 到收到对应 block 的时间
+        self.block_latency = LatencyStats(max_samples=1000)
+        self._sent_at: Dict[Tuple[int, int], float] = {}
+
+    def __str__(self):
+        return f'{self._peer_addr[0]}:{self._peer_addr[1]}'
 
-        self.futures: Dict[str, asyncio.Future] = {}
+    @property
+    def addr(self) -> tuple:
+        return self._peer_addr
 
-    async def connect(self):
+    @property
+    def listen_addr(self) -> tuple | None:
+        '''
+        别人可以连接的地址，通过 PEX 告诉别的 peer。连进来的 peer 没有声明监听端口时为 None
+        '''
+        if not self.inbound:
+            return self._peer_addr
+        if self.remote_listen_port is None:
+            return None
+        return (self._peer_addr[0], self.remote_listen_port)
+
+    async def connect(self, pieces: Bitfield | None = None, protocol: PeerWireProtocol | None = None):
+        '''
+        protocol 不为 None 时是对方发起的连接，对方的握手已经收到了，这里只回复我们的握手
+        '''
         try:
-            logging.info(f'opening tcp connetion to {self._peer_addr}')
-            self.reader, self.writer = await asyncio.wait_for(
-                asyncio.open_connection(self._peer_addr[0], self._peer_addr[1]),
-                timeout=2
-            )
+            if protocol is not None:
+                self.protocol = protocol
+                self.inbound = True
+            elif self._utp is not None:
+                logging.info(f'opening utp connetion to {self._peer_addr}')
+                # SYN 丢失时要等重传，比 TCP 多给一些时间
+                _, self.protocol = await asyncio.wait_for(
+                    self._utp.connect(PeerWireProtocol, self._peer_addr),
+                    timeout=5
+                )
+            else:
+                logging.info(f'opening tcp connetion to {self._peer_addr}')
+                loop = asyncio.get_running_loop()
+                _, self.protocol = await asyncio.wait_for(
+                    loop.create_connection(PeerWireProtocol, self._peer_addr[0], self._peer_addr[1]),
+                    timeout=2
+                )
+            self.writer = self.protocol
         except Exception as e:
             logging.error(f'connection to {self._peer_addr} refused: {e}')
             raise
         
-        await self.handshake()
-        await self.send_interested()
+        try:
+            await self.handshake()
+            if pieces is not None:
+                # Bitfield 只能是握手后的第一条消息
+                await self.send_pieces(pieces)
+                if self.fast:
+                    await self.send_allowed_fast(pieces)
+            if self.extended:
+                await self.send_extended_handshake()
+            await self.send_interested()
+        except BaseException:
+            self.protocol.close()
+            raise
 
         self._state_started()
         self._state_choked()
@@ -44,75 +236,179 @@ class Peer:
         asyncio.create_task(self.heartbeat())
 
     async def run(self):
-        async for msg in message.PeerMessageIterator(self.reader):
+        try:
+            await self._run()
+        finally:
+            self._state_stopped()
+            self._listener.peer_closed(self)
+
+    async def _run(self):
+        async for msg in self.protocol:
             if not self._state_is_running():
                 break
+            if isinstance(msg, _FAST_MESSAGES) and not self.fast:
+                logging.error(f'peer {self._peer_addr} sent {msg} without fast extension')
+                self._state_stopped()
+                break
+            if isinstance(msg, message.Extended) and not self.extended:
+                logging.warning(f'peer {self._peer_addr} sent extended message without extension protocol')
+                continue
 
             match msg:
                 case message.Unchoke():
                     self._state_unchoked()
+                    self._listener.peer_unchoked(self)
                 case message.Choke():
                     self._state_choked()
+                    self._listener.peer_choked(self)
                 case message.Interested():
-                    logging.info('skip interested message')
+                    self.peer_interested = True
                 case message.NotInterested():
-                    logging.info('skip not interested message')
+                    self.peer_interested = False
                 case message.Have():
-                    self._remote_pieces[msg.piece_index] = True
+                    if self._num_pieces == 0:
+                        # 还在下载元数据，不知道分片数量，也用不到对方有哪些分片
+                        continue
+                    if msg.piece_index >= self._remote_pieces.size:
+                        logging.warning(f'have message out of range: {msg.piece_index}')
+                    elif msg.piece_index not in self._remote_pieces:
+                        self._remote_pieces.add(msg.piece_index)
+                        self._listener.peer_have(self, msg.piece_index)
                 case message.KeepAlive():
                     logging.info('skip keep alive message')
                 case message.Piece():
-                    index = msg.index
-                    offset = msg.begin
-                    key = f'{index}-{offset}'
-                    if key not in self.futures:
-                        logging.warning(f'the piece message is not the one we want: {key}')
+                    key = (msg.index, msg.begin)
+                    future = self.futures.pop(key, None)
+                    if future is None:
+                        # endgame 里被 Cancel 的重复请求经常会晚到
+                        logging.debug(f'the piece message is not the one we want: {key}')
                         continue
-                    future = self.futures.pop(key)
-                    if future and not future.done():
+                    self._inflight.pop(key, None)
+                    sent_at = self._sent_at.pop(key, None)
+                    if sent_at is not None:
+                        self.block_latency.record(time.monotonic() - sent_at)
+                    self.downloaded += len(msg.block)
+                    self.download_rate.update(len(msg.block))
+                    if not future.done():
                         future.set_result(msg.block)
+                    # 挂起等下一条消息时不再引用这个 block，mmap 的窗口才能解除映射
+                    msg = future = None
 
                 case message.Bitfield():
-                    bitfield = msg.bitfield
-                    piece_index = 0
-                    for byte in bitfield:
-                        for i in range(7, -1, -1):
-                            bit = (byte >> i) & 1
-                            if bit == 1:
-                                self._remote_pieces[piece_index] = True
-                            piece_index += 1
+                    if self._num_pieces == 0:
+                        continue
+                    bitfield = Bitfield.from_bytes(msg.bitfield, self._num_pieces)
+                    added = bitfield - self._remote_pieces
+                    self._remote_pieces = self._remote_pieces | bitfield
+                    self._listener.peer_bitfield(self, added)
+
+                case message.HaveAll():
+                    if self._num_pieces == 0:
+                        logging.debug(f'have all from {self._peer_addr} before the number of pieces is known')
+                        continue
+                    added = Bitfield.full(self._num_pieces) - self._remote_pieces
+                    self._remote_pieces = Bitfield.full(self._num_pieces)
+                    self._listener.peer_bitfield(self, added)
+                case message.HaveNone():
+                    pass
+                case message.Suggest():
+                    if msg.piece_index < self._remote_pieces.size and msg.piece_index not in self.suggested:
+                        self.suggested.append(msg.piece_index)
+                case message.AllowedFast():
+                    if msg.piece_index < self._remote_pieces.size and msg.piece_index not in self.allowed_fast:
+                        self.allowed_fast.add(msg.piece_index)
+                        self._listener.peer_allowed_fast(self, msg.piece_index)
+                case message.RejectRequest():
+                    self._request_rejected(msg)
+                case message.Extended():
+                    self._extended_received(msg)
 
                 case message.Request():
-                    logging.info('skip request message')
+                    self._queue_upload(msg)
                 case message.Cancel():
-                    logging.info('skip cancel message')    
+                    self._cancel_upload(msg)
                 case _:
                     logging.error(f'unhandled message: {msg}')
                     self._state_stopped()
 
+    def _extended_received(self, msg: message.Extended):
+        if msg.extended_id == EXTENDED_HANDSHAKE_ID:
+            try:
+                handshake = ExtendedHandshake.decode(msg.payload)
+            except Exception as e:
+                logging.warning(f'bad extended handshake from {self._peer_addr}: {e}')
+                return
+            self.extensions = handshake.extensions
+            self.client_name = handshake.client
+            self.remote_listen_port = handshake.listen_port
+            logging.info(f'peer {self._peer_addr} ({self.client_name}) supports {sorted(self.extensions)}')
+            self._listener.peer_extended_handshake(self, handshake)
+            return
+
+        # 对方按我们在扩展握手里声明的编号发送
+        name = next((n for n, id in LOCAL_EXTENSIONS.items() if id == msg.extended_id), None)
+        if name is None:
+            logging.debug(f'unknown extended message {msg.extended_id} from {self._peer_addr}')
+            return
+        self._listener.peer_extension_message(self, name, msg.payload)
+
+    def supports(self, extension: str) -> bool:
+        return extension in self.extensions
+
+    async def send_extended_handshake(self):
+        handshake = ExtendedHandshake(LOCAL_EXTENSIONS, listen_port=self.listen_port, client=CLIENT_NAME,
+                                      metadata_size=self.metadata_size)
+        self.writer.write(message.Extended(EXTENDED_HANDSHAKE_ID, handshake.encode()).encode())
+        await self.writer.drain()
+        logging.debug(f'sent extended handshake to {self._peer_addr}')
+
+    async def send_extended(self, extension: str, payload: bytes):
+        '''
+        按对方声明的编号发送扩展消息，对方不支持这个扩展时什么都不做
+        '''
+        extended_id = self.extensions.get(extension)
+        if extended_id is None:
+            return
+        self.writer.write(message.Extended(extended_id, payload).encode())
+        await self.writer.drain()
+
+    def close(self):
+        '''
+        断开连接，run() 退出时会通知 listener
+        '''
+        self._state_stopped()
+        self.protocol.close()
+
     async def handshake(self):
         logging.info(f'handshaking with peer {self._peer_addr}')
+        reserved = bytearray(8)
+        reserved[FAST_EXTENSION_BYTE] |= FAST_EXTENSION_BIT
+        reserved[EXTENSION_BYTE] |= EXTENSION_BIT
         self.writer.write(struct.pack(
-            '>B19s8x20s20s',
+            '>B19s8s20s20s',
             19,                         # Single byte (B)
             b'BitTorrent protocol',     # String 19s
-                                        # Reserved 8x (pad byte, no value)
+            bytes(reserved),            # Reserved 8s
             self._info_hash,            # String 20s
             self._my_peer_id) 
         )
         await self.writer.drain()
 
-        data = await self.reader.read(68)
+        data = await asyncio.wait_for(self.protocol.handshake, timeout=10)
         logging.debug(f'received handshake: {data}')
 
-        parts = struct.unpack('>B19s8x20s20s', data)
+        parts = struct.unpack('>B19s8s20s20s', data)
         # check info hash
-        if parts[2] != self._info_hash:
+        if parts[3] != self._info_hash:
             logging.error('info hash mismatch')
             raise ValueError('info hash mismatch')
+        self.fast = bool(parts[2][FAST_EXTENSION_BYTE] & FAST_EXTENSION_BIT)
+        self.extended = bool(parts[2][EXTENSION_BYTE] & EXTENSION_BIT)
 
     async def heartbeat(self):
         while True:
+            if self.protocol.is_closing():
+                return
             if not self._state_is_running():
                 await asyncio.sleep(10)
                 continue
@@ -150,51 +446,213 @@ class Peer:
     def _state_is_choked(self):
         return self._state & PeerState.Choked.value
     
-    def can_downlowd(self):
-        return self._state_is_running() and not self._state_is_choked()
-
     async def send_interested(self):
-        self.writer.write(message.Interested().decode())
+        self.writer.write(message.Interested().encode())
         await self.writer.drain()
         logging.info('sent interested message')
 
-    def has_piece(self, piece_index: int) -> bool:
-        return piece_index in self._remote_pieces
+    def remote_pieces(self) -> Bitfield:
+        return self._remote_pieces
+
+    def requestable_pieces(self) -> Bitfield:
+        '''
+        现在可以请求的分片：unchoke 时是对方有的全部分片，choke 时只有 allowed fast 的分片
+        '''
+        if not self._state_is_running():
+            return Bitfield(self._remote_pieces.size)
+        if not self._state_is_choked():
+            return self._remote_pieces
+        return Bitfield(self._remote_pieces.size, (i for i in self.allowed_fast if i in self._remote_pieces))
+
+    def stats(self) -> Dict[str, float | str | bool]:
+        return {
+            'addr': str(self),
+            'transport': 'tcp' if self._utp is None else 'utp',
+            'choked': bool(self._state_is_choked()),
+            'am_choking': self.am_choking,
+            'interested': self.peer_interested,
+            'downloaded': self.downloaded,
+            'uploaded': self.uploaded,
+            'download_rate': self.download_rate.rate(),
+            'upload_rate': self.upload_rate.rate(),
+            'queued_blocks': len(self.futures),
+            'fast': self.fast,
+            'rejected': self.rejected,
+            'client': self.client_name or '',
+            'latency_p50': self.block_latency.percentile(50),
+            'latency_p90': self.block_latency.percentile(90),
+        }
     
-    async def get_piece(self, piece_index: int, offset: int, length: int=2**14) -> bytes:
-        data = message.Request(piece_index, offset, length).encode()
-        self.writer.write(data)
-        await self.writer.drain()
-        logging.debug(f'sent request message: piece_index={piece_index}, offset={offset}, length={length}')
+    def request_slots(self) -> int:
+        '''
+        还可以发出多少个请求。速率越快允许在途的请求越多
+        '''
+        depth = max(self.pipeline_depth,
+                    min(MAX_PIPELINE_DEPTH, int(self.download_rate.rate() * REQUEST_QUEUE_TIME) // 2**14))
+        return depth - len(self.futures)
 
-        future = asyncio.Future()
-        self.futures[f'{piece_index}-{offset}'] = future
-        try:
-            res = await asyncio.wait_for(future, timeout=60)
-            return res
-        except TimeoutError as e:
-            logging.error(f'timeout while waiting for piece {piece_index}-{offset}')
-            self.futures.pop(f'{piece_index}-{offset}', None)
-            raise
+    def request_block(self, piece_index: int, offset: int, length: int,
+                      dest: memoryview | None = None) -> asyncio.Future:
+        '''
+        立即发出一个请求，由调用方（Scheduler）按 request_slots 控制数量
+        '''
+        key = (piece_index, offset)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[key] = future
+        if dest is not None:
+            self.protocol.register_destination(piece_index, offset, dest)
+        request = message.Request(piece_index, offset, length)
+        self.writer.write(request.encode())
+        self._inflight[key] = request
+        self._sent_at[key] = time.monotonic()
+        return future
+
+    def cancel_block(self, piece_index: int, offset: int, send: bool = True):
+        '''
+        放弃一个请求，已经发出的发送 Cancel
+        '''
+        key = (piece_index, offset)
+        future = self.futures.pop(key, None)
+        if future is None:
+            return
+        self.protocol.discard_destination(piece_index, offset)
+        self._sent_at.pop(key, None)
+        request = self._inflight.pop(key, None)
+        if request is not None and send and not self.protocol.is_closing():
+            self.writer.write(message.Cancel(request.index, request.begin, request.length).encode())
+        if not future.done():
+            future.set_exception(RequestCancelled(f'block {piece_index}-{offset} cancelled'))
+
+    def _request_rejected(self, reject: message.RejectRequest):
+        key = (reject.index, reject.begin)
+        future = self.futures.pop(key, None)
+        if future is None:
+            logging.debug(f'reject for a request we did not send: {key}')
+            return
+        self.rejected += 1
+        self.protocol.discard_destination(reject.index, reject.begin)
+        self._sent_at.pop(key, None)
+        self._inflight.pop(key, None)
+        if not future.done():
+            future.set_exception(RequestRejected(f'block {reject.index}-{reject.begin} rejected by {self}'))
+
+    def drop_requests(self):
+        '''
+        被 choke 或者连接断开：对方不会再回复之前的请求，全部作废，不发送 Cancel
+        '''
+        for key in list(self.futures):
+            self.cancel_block(*key, send=False)
+
+    def expired_requests(self, timeout: float) -> List[Tuple[int, int]]:
+        now = time.monotonic()
+        return [key for key, sent_at in self._sent_at.items() if now - sent_at > timeout]
 
     async def send_have(self, piece_index: int):
         self.writer.write(message.Have(piece_index=piece_index).encode())
         await self.writer.drain()
         logging.info(f'sent have message: piece_index={piece_index}')
 
-    async def download_piece(self, piece: Piece) -> bytes:
-        buf = bytearray()
-        for block in piece.blocks:
-            block_data = await self.get_piece(piece.index, block.offset, block.length)
-            buf.extend(block_data)
+    async def send_bitfield(self, pieces: Bitfield):
+        self.writer.write(message.Bitfield(pieces.to_bytes()).encode())
+        await self.writer.drain()
+        logging.info(f'sent bitfield message: {len(pieces)} pieces')
 
-        piece_data = bytes(buf)
-        checksum = hashlib.sha1(piece_data)
-        if checksum.digest() != piece.checksum:
-            raise ValueError(f'piece checksum mismatch: {checksum.hexdigest()} != {piece.checksum.hex()}')
-        
-        await self.send_have(piece.index)
+    async def send_pieces(self, pieces: Bitfield):
+        '''
+        告诉对方我们有哪些分片，支持 Fast Extension 时用 HaveAll/HaveNone 代替 Bitfield
+        '''
+        if self.fast and pieces.size and pieces.all():
+            self.writer.write(message.HaveAll().encode())
+            await self.writer.drain()
+            logging.info('sent have all message')
+        elif self.fast and not pieces:
+            self.writer.write(message.HaveNone().encode())
+            await self.writer.drain()
+            logging.info('sent have none message')
+        elif pieces:
+            await self.send_bitfield(pieces)
 
-        logging.info(f'downloaded piece {piece.index} from {self._peer_addr}')
+    async def send_allowed_fast(self, pieces: Bitfield):
+        '''
+        允许对方在被 choke 时请求 allowed fast 集合里我们已有的分片
+        '''
+        allowed = [i for i in allowed_fast_set(self._peer_addr[0], self._info_hash, pieces.size) if i in pieces]
+        for index in allowed:
+            self.writer.write(message.AllowedFast(index).encode())
+        self._allowed_fast_sent.update(allowed)
+        if allowed:
+            await self.writer.drain()
+            logging.debug(f'sent allowed fast {allowed} to {self._peer_addr}')
 
-        return piece_data
\ No newline at end of file
+    async def choke(self):
+        if self.am_choking:
+            return
+        self.am_choking = True
+        # choke 之后对方未完成的请求都作废，allowed fast 的分片除外
+        rejected = [r for r in self._uploads if r.index not in self._allowed_fast_sent]
+        self._uploads = deque(r for r in self._uploads if r.index in self._allowed_fast_sent)
+        if self._serving is not None and self._serving[0] not in self._allowed_fast_sent:
+            rejected.append(message.Request(*self._serving))
+            self._serving = None
+        self.writer.write(message.Choke().encode())
+        # 支持 Fast Extension 的 peer 不会默认请求作废，需要逐个拒绝
+        for request in rejected:
+            self._reject_upload(request)
+        await self.writer.drain()
+        logging.debug(f'choked peer {self._peer_addr}')
+
+    async def unchoke(self):
+        if not self.am_choking:
+            return
+        self.am_choking = False
+        self.writer.write(message.Unchoke().encode())
+        await self.writer.drain()
+        logging.debug(f'unchoked peer {self._peer_addr}')
+
+    def _reject_upload(self, request: message.Request):
+        if self.fast:
+            self.writer.write(message.RejectRequest(request.index, request.begin, request.length).encode())
+
+    def _queue_upload(self, request: message.Request):
+        if self.am_choking and request.index not in self._allowed_fast_sent:
+            logging.debug(f'ignoring request from choked peer {self._peer_addr}')
+            self._reject_upload(request)
+            return
+        if request.length > MAX_REQUEST_LENGTH or len(self._uploads) >= MAX_UPLOAD_QUEUE:
+            logging.warning(f'ignoring request {request.index}-{request.begin}-{request.length} from {self._peer_addr}')
+            self._reject_upload(request)
+            return
+        self._uploads.append(request)
+        if self._uploader is None:
+            self._uploader = asyncio.create_task(self._upload())
+
+    def _cancel_upload(self, cancel: message.Cancel):
+        key = (cancel.index, cancel.begin, cancel.length)
+        if self._serving == key:
+            self._serving = None
+        self._uploads = deque(r for r in self._uploads if (r.index, r.begin, r.length) != key)
+
+    async def _upload(self):
+        try:
+            while self._uploads and self._state_is_running():
+                request = self._uploads.popleft()
+                self._serving = (request.index, request.begin, request.length)
+                block = await self._listener.read_block(self, request.index, request.begin, request.length)
+                if block is None or len(block) != request.length:
+                    logging.debug(f'cannot serve request {request.index}-{request.begin} from {self._peer_addr}')
+                    self._reject_upload(request)
+                    continue
+                if self._serving is None:
+                    # 读取期间被 Cancel 或 choke
+                    continue
+                self.writer.write(message.Piece(request.index, request.begin, block).encode())
+                self.uploaded += len(block)
+                self.upload_rate.update(len(block))
+                await self.writer.drain()
+        except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError) as e:
+            logging.error(f'peer {self._peer_addr} disconnected while uploading: {e}')
+        except Exception as e:
+            logging.error(f'failed to upload to peer {self._peer_addr}: {e}')
+        finally:
+            self._serving = None
+            self._uploader = None
@@ -0,0 +1,242 @@
+import bisect
+import random
+from enum import IntEnum
+from .bitfield import Bitfield
+from typing import Dict, Iterable, Iterator, List, Sequence, Set, Tuple
+
+
+class Priority(IntEnum):
+    '''
+    分片（文件）优先级：SKIP 不下载，其余的高优先级先下载，同一优先级内再按选择策略
+    '''
+    SKIP = 0
+    LOW = 1
+    NORMAL = 4
+    HIGH = 7
+
+
+class PickStrategy:
+    '''
+    选择下一个要下载的分片，peer_pieces 为 None 时表示不限定 peer
+    '''
+    def pick(self, picker: 'PiecePicker', peer_pieces: Bitfield | None) -> int | None:
+        raise NotImplementedError
+
+
+class SequentialStrategy(PickStrategy):
+    def pick(self, picker, peer_pieces):
+        for wanted in picker.wanted_levels():
+            if peer_pieces is not None:
+                index = wanted.first_common(peer_pieces)
+            else:
+                index = next((i for i in wanted if picker.availability[i] > 0), None)
+            if index is not None:
+                return index
+        return None
+
+
+class RarestFirstStrategy(PickStrategy):
+    def pick(self, picker, peer_pieces):
+        return picker.rarest(peer_pieces)
+
+
+class RandomFirstStrategy(PickStrategy):
+    '''
+    前 n 个分片随机选择，尽快拿到可以和别人交换的数据，之后退化为 rarest first
+    '''
+    def __init__(self, n: int = 4):
+        self.n = n
+
+    def pick(self, picker, peer_pieces):
+        if len(picker.done) + len(picker.in_progress) >= self.n:
+            return picker.rarest(peer_pieces)
+
+        for wanted in picker.wanted_levels():
+            if peer_pieces is not None:
+                candidates = list(wanted & peer_pieces)
+            else:
+                candidates = [i for i in wanted if picker.availability[i] > 0]
+            if candidates:
+                return random.choice(candidates)
+        return None
+
+
+class PiecePicker:
+    def __init__(self, num_pieces: int, strategy: PickStrategy | None = None):
+        self.num_pieces = num_pieces
+        self.strategy = strategy or RarestFirstStrategy()
+        self.availability = [0] * num_pieces
+
+        self.priorities = [Priority.NORMAL] * num_pieces
+        # 优先级不是 SKIP 的分片，全部完成就算下载完
+        self.selected = Bitfield.full(num_pieces)
+        self.wanted = Bitfield.full(num_pieces)
+        self.in_progress: Set[int] = set()
+        self.done = Bitfield(num_pieces)
+        # (优先级, availability) -> 尚未分配的分片，Have/Bitfield 到来时增量维护
+        self._buckets: Dict[Tuple[int, int], Set[int]] = {}
+        # 现有的桶按 (-优先级, availability) 排好序，rarest 按这个顺序查找
+        self._order: List[Tuple[int, int]] = []
+        if num_pieces:
+            self._buckets[(Priority.NORMAL, 0)] = set(range(num_pieces))
+            self._order.append((-Priority.NORMAL, 0))
+        # 流式播放：分片 -> 最晚什么时候（time.monotonic()）需要它，有截止时间的分片先于选择策略下载
+        self.deadlines: Dict[int, float] = {}
+
+    @property
+    def finished(self) -> bool:
+        return not self.selected - self.done
+
+    def interesting(self, peer_pieces: Bitfield) -> int | None:
+        '''
+        peer 拥有而我们还需要的第一个分片
+        '''
+        return ((peer_pieces & self.selected) - self.done).first()
+
+    def _bucket_add(self, index: int):
+        priority, level = self.priorities[index], self.availability[index]
+        bucket = self._buckets.get((priority, level))
+        if bucket is None:
+            bucket = self._buckets[(priority, level)] = set()
+            bisect.insort(self._order, (-priority, level))
+        bucket.add(index)
+
+    def _bucket_discard(self, index: int):
+        priority, level = self.priorities[index], self.availability[index]
+        bucket = self._buckets.get((priority, level))
+        if bucket is not None:
+            bucket.discard(index)
+            if not bucket:
+                del self._buckets[(priority, level)]
+                del self._order[bisect.bisect_left(self._order, (-priority, level))]
+
+    def _set_availability(self, index: int, value: int):
+        if index not in self.wanted:
+            self.availability[index] = value
+            return
+        self._bucket_discard(index)
+        self.availability[index] = value
+        self._bucket_add(index)
+
+    def add_peer_pieces(self, indices: Iterable[int]):
+        for index in indices:
+            self._set_availability(index, self.availability[index] + 1)
+
+    def remove_peer_pieces(self, indices: Iterable[int]):
+        for index in indices:
+            if self.availability[index] > 0:
+                self._set_availability(index, self.availability[index] - 1)
+
+    def rarest(self, peer_pieces: Bitfield | None = None) -> int | None:
+        # 先按优先级从高到低，再按 availability 从低到高
+        for priority, level in self._order:
+            if level == 0:
+                continue
+            bucket = self._buckets[(-priority, level)]
+            if peer_pieces is None:
+                candidates = list(bucket)
+            else:
+                candidates = [i for i in bucket if i in peer_pieces]
+            if candidates:
+                return random.choice(candidates)
+        return None
+
+    def wanted_levels(self) -> Iterator[Bitfield]:
+        '''
+        按优先级从高到低依次给出待下载的分片，只有一种优先级时就是 wanted
+        '''
+        levels = sorted({priority for priority, _ in self._buckets}, reverse=True)
+        if len(levels) <= 1:
+            yield self.wanted
+            return
+        for level in levels:
+            pieces = Bitfield(self.num_pieces)
+            for (priority, _), bucket in self._buckets.items():
+                if priority == level:
+                    for index in bucket:
+                        pieces.add(index)
+            yield pieces
+
+    def set_priorities(self, priorities: Sequence[int]):
+        '''
+        修改分片优先级，下载中随时生效。改成 SKIP 的分片不再分配，已经在下载的让它下载完
+        '''
+        for index, priority in enumerate(priorities):
+            if priority == self.priorities[index]:
+                continue
+            wanted = index in self.wanted
+            if wanted:
+                self._bucket_discard(index)
+            self.priorities[index] = priority
+            if priority == Priority.SKIP:
+                self.selected.discard(index)
+                self.wanted.discard(index)
+                continue
+            self.selected.add(index)
+            if wanted:
+                self._bucket_add(index)
+            elif index not in self.done and index not in self.in_progress:
+                self.wanted.add(index)
+                self._bucket_add(index)
+
+    def set_deadline(self, index: int, deadline: float):
+        if index not in self.done:
+            self.deadlines[index] = deadline
+
+    def clear_deadline(self, index: int):
+        self.deadlines.pop(index, None)
+
+    def urgent(self, peer_pieces: Bitfield | None = None) -> int | None:
+        '''
+        peer 拥有的、截止时间最早的待下载分片
+        '''
+        best = None
+        for index, deadline in self.deadlines.items():
+            if index not in self.wanted or (peer_pieces is not None and index not in peer_pieces):
+                continue
+            if best is None or deadline < self.deadlines[best]:
+                best = index
+        return best
+
+    def pick(self, peer_pieces: Bitfield | None = None) -> int | None:
+        index = self.urgent(peer_pieces)
+        if index is None:
+            index = self.strategy.pick(self, peer_pieces)
+        if index is None:
+            return None
+
+        self._take(index)
+        self.in_progress.add(index)
+        return index
+
+    def pick_piece(self, index: int) -> bool:
+        '''
+        直接选定某个分片（比如对方建议的），分片不在待下载集合里时返回 False
+        '''
+        if index not in self.wanted:
+            return False
+        self._take(index)
+        self.in_progress.add(index)
+        return True
+
+    def _take(self, index: int):
+        if index in self.wanted:
+            self.wanted.discard(index)
+            self._bucket_discard(index)
+
+    def abort(self, index: int):
+        '''
+        分片下载失败，放回待下载集合
+        '''
+        if index not in self.in_progress:
+            return
+        self.in_progress.discard(index)
+        if self.priorities[index] != Priority.SKIP:
+            self.wanted.add(index)
+            self._bucket_add(index)
+
+    def complete(self, index: int):
+        self.deadlines.pop(index, None)
+        self._take(index)
+        self.in_progress.discard(index)
+        self.done.add(index)
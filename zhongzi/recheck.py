@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Tuple
+from .bitfield import Bitfield
+from .storage import Storage
+
+
+def _hash_pieces(data: bytes | memoryview, piece_length: int, checksums: List[bytes]) -> List[bool]:
+    '''
+    在工作线程/进程中执行：data 是连续的若干个分片
+    '''
+    view = memoryview(data)
+    return [hashlib.sha1(view[i * piece_length:(i + 1) * piece_length]).digest() == checksum
+            for i, checksum in enumerate(checksums)]
+
+
+class Recheck:
+    '''
+    校验磁盘上已有的数据。按大块顺序读取，读和 sha1 计算重叠进行，sha1 分散到线程池或进程池。
+    '''
+    def __init__(self, storage: Storage, workers: int | None = None, chunk_size: int = 2**24,
+                 executor: str = 'thread'):
+        if executor not in ('thread', 'process'):
+            raise ValueError(f'unknown executor: {executor}')
+
+        self.storage = storage
+        self.torrent = storage.torrent
+        self.workers = workers or os.cpu_count() or 1
+        self.pieces_per_chunk = max(1, chunk_size // self.torrent.piece_length)
+        self.executor = executor
+
+        self.checked = 0
+        self.valid = 0
+        self.bytes_read = 0
+        self._started: float | None = None
+        self._elapsed = 0.0
+
+    def _readable(self, index: int, sizes: List[int]) -> bool:
+        # 文件不存在或者太短时直接判定无效，不去读（也不会创建文件）
+        return all(span.file_offset + span.length <= sizes[span.file_index]
+                   for span in self.storage.piece_spans(index))
+
+    def _chunks(self, pieces: List[int]) -> List[Tuple[int, int]]:
+        '''
+        把分片按连续的下标分组，每组不超过 pieces_per_chunk 个，返回 (起始分片, 分片数)
+        '''
+        chunks = []
+        for index in pieces:
+            if chunks and chunks[-1][0] + chunks[-1][1] == index and chunks[-1][1] < self.pieces_per_chunk:
+                chunks[-1] = (chunks[-1][0], chunks[-1][1] + 1)
+            else:
+                chunks.append((index, 1))
+        return chunks
+
+    def _read(self, start: int, count: int) -> bytearray | memoryview:
+        length = sum(self.torrent.pieces[i].length for i in range(start, start + count))
+        return self.storage.read(start * self.torrent.piece_length, length)
+
+    async def run(self, pieces: Iterable[int] | None = None,
+                  progress: Callable[['Recheck'], None] | None = None) -> Bitfield:
+        '''
+        校验 pieces（默认全部分片），返回校验通过的分片
+        '''
+        n = len(self.torrent.pieces)
+        indices = sorted(range(n) if pieces is None else set(pieces))
+        result = Bitfield(n)
+
+        sizes = []
+        for i in range(len(self.torrent.files)):
+            try:
+                sizes.append(os.path.getsize(self.storage.path(i)))
+            except FileNotFoundError:
+                sizes.append(-1)
+        readable = [i for i in indices if self._readable(i, sizes)]
+        self.checked += len(indices) - len(readable)
+
+        self._started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        pool: Executor
+        if self.executor == 'process':
+            # 事件循环进程里有别的线程，fork 出来的子进程可能死锁
+            pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='recheck')
+
+        # 同时在计算的块数有上限，内存占用不超过 2 * workers 个块
+        slots = asyncio.Semaphore(self.workers * 2)
+
+        async def hash_chunk(start: int, count: int, data: bytearray | memoryview):
+            try:
+                if self.executor == 'process':
+                    data = bytes(data)
+                checksums = [self.torrent.pieces[i].checksum for i in range(start, start + count)]
+                ok = await loop.run_in_executor(pool, _hash_pieces, data, self.torrent.piece_length, checksums)
+            finally:
+                slots.release()
+            for i, valid in enumerate(ok):
+                if valid:
+                    result.add(start + i)
+                    self.valid += 1
+            self.checked += count
+            if progress is not None:
+                progress(self)
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for start, count in self._chunks(readable):
+                    await slots.acquire()
+                    try:
+                        # 读取始终是一个线程按顺序进行，磁盘上是大块的顺序读
+                        data = await asyncio.to_thread(self._read, start, count)
+                    except BaseException:
+                        slots.release()
+                        raise
+                    self.bytes_read += len(data)
+                    tg.create_task(hash_chunk(start, count, data))
+        finally:
+            pool.shutdown(wait=False)
+            self._elapsed += time.monotonic() - self._started
+            self._started = None
+
+        logging.info(f'recheck done: {len(result)}/{len(indices)} pieces valid, '
+                     f'{self.bytes_read} bytes in {self.elapsed:.1f}s ({self.throughput / 2**20:.1f} MiB/s)')
+        return result
+
+    @property
+    def elapsed(self) -> float:
+        if self._started is None:
+            return self._elapsed
+        return self._elapsed + time.monotonic() - self._started
+
+    @property
+    def throughput(self) -> float:
+        '''
+        读取并校验的字节/秒
+        '''
+        if self.elapsed == 0:
+            return 0.0
+        return self.bytes_read / self.elapsed
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'checked': self.checked,
+            'valid': self.valid,
+            'bytes_read': self.bytes_read,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+        }
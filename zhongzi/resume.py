@@ -0,0 +1,103 @@
+import logging
+import os
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple
+from . import bencode
+from .bitfield import Bitfield
+from .storage import Storage
+from .torrent import Torrent
+
+
+class ResumeData:
+    '''
+    快速恢复文件的内容：已校验并写盘的分片、未完成分片中已写盘的 block、写入时各文件的大小和修改时间
+    '''
+    def __init__(self, info_hash: bytes, pieces: Bitfield, partial: Dict[int, Bitfield],
+                 files: List[Tuple[int, int]]):
+        self.info_hash = info_hash
+        self.pieces = pieces
+        self.partial = partial
+        self.files = files
+
+    def encode(self) -> bytes:
+        partial = OrderedDict()
+        for index in sorted(self.partial):
+            partial[str(index).encode()] = self.partial[index].to_bytes()
+
+        d = OrderedDict()
+        d[b'info-hash'] = self.info_hash
+        d[b'pieces'] = self.pieces.to_bytes()
+        d[b'partial'] = partial
+        d[b'files'] = [[size, mtime] for size, mtime in self.files]
+        return bytes(bencode.Encoder(d).encode())
+
+    @classmethod
+    def decode(cls, data: bytes, torrent: Torrent) -> 'ResumeData':
+        d = bencode.Decoder(data).decode()
+        pieces = Bitfield.from_bytes(d[b'pieces'], len(torrent.pieces))
+        partial = {}
+        for key, value in d[b'partial'].items():
+            index = int(key)
+            partial[index] = Bitfield.from_bytes(value, len(torrent.pieces[index].blocks))
+        files = [(size, mtime) for size, mtime in d[b'files']]
+        return cls(d[b'info-hash'], pieces, partial, files)
+
+
+def resume_path(storage: Storage) -> str:
+    '''
+    放在下载内容旁边：单文件是 <name>.resume，多文件是与目录同级的 <name>.resume
+    '''
+    return os.path.join(storage.base_dir, storage.torrent.name + '.resume')
+
+
+def file_states(storage: Storage) -> List[Tuple[int, int]]:
+    states = []
+    for i in range(len(storage.torrent.files)):
+        try:
+            st = os.stat(storage.path(i))
+            states.append((st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            states.append((-1, 0))
+    return states
+
+
+def save(storage: Storage, data: ResumeData):
+    path = resume_path(storage)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data.encode())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load(storage: Storage) -> ResumeData | None:
+    path = resume_path(storage)
+    try:
+        with open(path, 'rb') as f:
+            data = ResumeData.decode(f.read(), storage.torrent)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f'ignoring broken resume file {path}: {e}')
+        return None
+
+    if data.info_hash != storage.torrent.info_hash:
+        logging.warning(f'resume file {path} belongs to another torrent, ignoring')
+        return None
+    if len(data.files) != len(storage.torrent.files):
+        logging.warning(f'resume file {path} does not match the file list, ignoring')
+        return None
+    return data
+
+
+def changed_files(storage: Storage, data: ResumeData) -> Set[int]:
+    '''
+    大小或修改时间和恢复文件中记录的不一样的文件
+    '''
+    current = file_states(storage)
+    return {i for i, (old, new) in enumerate(zip(data.files, current)) if old != new}
+
+
+def piece_files(storage: Storage, index: int) -> Set[int]:
+    return {span.file_index for span in storage.piece_spans(index)}
@@ -0,0 +1,512 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Callable, Dict, Set, Tuple
+from .ban import SmartBan, block_digests, block_senders
+from .bitfield import Bitfield
+from .buffers import BufferPool
+from .hasher import HashPipeline, PieceHasher
+from .peer import Peer, RequestCancelled
+from .picker import PiecePicker
+from .stats import LatencyStats
+from .storage import Storage
+from .torrent import Block, Piece, Torrent
+
+
+class PieceDownload:
+    '''
+    一个正在下载的分片：block 可以分给不同的 peer，数据直接写进 buf
+    '''
+    def __init__(self, piece: Piece, buf: bytearray | memoryview):
+        self.piece = piece
+        self.buf = buf
+        self.view = memoryview(buf)
+        self._data = self.view[:piece.length]
+        self.hasher = PieceHasher(self._data)
+        self.received = Bitfield(len(piece.blocks))
+        # block 下标 -> 发送它的 peer 的 IP，用于校验失败时追查
+        self.senders: Dict[int, str] = {}
+        # block 下标 -> 正在向哪些 peer 请求
+        self.requested: Dict[int, Set[Peer]] = {}
+        # 请求失败、需要重新分配的 block
+        self._retry: Set[int] = set()
+        # 还没分配过的最小 block 下标
+        self._next = 0
+        self.started = time.monotonic()
+        self.endgame = False
+        self.verifying = False
+
+    @property
+    def index(self) -> int:
+        return self.piece.index
+
+    def complete(self) -> bool:
+        return self.received.all()
+
+    def next_block(self) -> Block | None:
+        while self._retry:
+            i = min(self._retry)
+            self._retry.discard(i)
+            if i not in self.received and i not in self.requested:
+                return self.piece.blocks[i]
+        blocks = self.piece.blocks
+        while self._next < len(blocks):
+            i = self._next
+            self._next += 1
+            if i not in self.received and i not in self.requested:
+                return blocks[i]
+        return None
+
+    def has_unrequested(self) -> bool:
+        return bool(self._retry) or self._next < len(self.piece.blocks)
+
+    def retry(self, block_index: int):
+        if block_index not in self.received and not self.requested.get(block_index):
+            self.requested.pop(block_index, None)
+            self._retry.add(block_index)
+
+    def release(self):
+        '''
+        释放引用缓冲区的视图，mmap 的窗口才能解除映射
+        '''
+        for view in (self._data, self.view):
+            try:
+                view.release()
+            except BufferError:
+                # 还在线程池里计算哈希
+                pass
+
+
+class Scheduler:
+    '''
+    由 peer 事件驱动的请求调度：peer 被 unchoke、收到 Have/Bitfield、一个 block 完成或者断开时，
+    立即用分片选择器给有空闲请求名额的 peer 分配 block。并发量由 peer 数量和各自的速率决定，
+    内存由 BufferPool 限制。存储能直接接收数据（mmap）时分片在线程池里映射，同样占用 BufferPool 的预算。
+
+    endgame 以 block 为单位：所有分片都已分配后，还没收到的 block 同时向最多 endgame_redundancy 个 peer 请求，
+    先到的那份生效，其余的发送 Cancel。
+
+    有截止时间的分片（流式播放）先于其他分片分配；过了截止时间还没下完的，没收到的 block 像 endgame 一样
+    再向别的 peer 请求一份。
+    '''
+    def __init__(self, torrent: Torrent, picker: PiecePicker, storage: Storage, buffer_pool: BufferPool,
+                 hash_pipeline: HashPipeline, on_piece_done: Callable[[Piece, memoryview, bytearray | memoryview], None],
+                 endgame: bool = True, endgame_redundancy: int = 2, request_timeout: float = 60.0,
+                 max_hash_failures: int = 2, on_ban: Callable[[str], None] | None = None,
+                 deadline_interval: float = 0.5):
+        self.torrent = torrent
+        self.picker = picker
+        self.storage = storage
+        self.buffer_pool = buffer_pool
+        self.hash_pipeline = hash_pipeline
+        self.on_piece_done = on_piece_done
+        self.endgame = endgame
+        self.endgame_redundancy = endgame_redundancy
+        self.request_timeout = request_timeout
+        self.smart_ban = SmartBan(max_hash_failures)
+        self.on_ban = on_ban
+
+        self.peers: Set[Peer] = set()
+        self.downloads: Dict[int, PieceDownload] = {}
+        # 快速恢复文件里记录的、已经在存储里的 block
+        self.resumed: Dict[int, Bitfield] = {}
+        # 因为没有空闲缓冲区而没能开始新的分片
+        self.starved = False
+        self._wake_scheduled = False
+        # 有截止时间的分片时，每隔 deadline_interval 秒检查一次有没有超时的
+        self.deadline_interval = deadline_interval
+        self._deadline_timer: asyncio.TimerHandle | None = None
+        self.piece_latency = {'normal': LatencyStats(), 'endgame': LatencyStats()}
+        self._closed = False
+
+    @property
+    def in_endgame(self) -> bool:
+        return self.endgame and not self.picker.wanted and bool(self.picker.in_progress)
+
+    def partial(self) -> Dict[int, Tuple[Bitfield, bytearray | memoryview]]:
+        return {index: (d.received, d.buf) for index, d in self.downloads.items() if not d.verifying}
+
+    # peer 事件
+
+    def add_peer(self, peer: Peer):
+        self.peers.add(peer)
+        self.fill(peer)
+
+    def remove_peer(self, peer: Peer):
+        self.peers.discard(peer)
+        # 回调里会把这些 block 放回去
+        peer.drop_requests()
+
+    def peer_choked(self, peer: Peer):
+        # 支持 Fast Extension 的 peer 会对不再处理的请求逐个发送 RejectRequest，
+        # allowed fast 的分片被 choke 后还可以继续下载
+        if not peer.fast:
+            peer.drop_requests()
+
+    # 分配
+
+    def wake(self):
+        '''
+        在下一轮事件循环里给所有 peer 补充请求，同一轮里多次调用只执行一次
+        '''
+        if self._wake_scheduled:
+            return
+        self._wake_scheduled = True
+        asyncio.get_running_loop().call_soon(self._wake)
+
+    def _wake(self):
+        self._wake_scheduled = False
+        self.fill_all()
+
+    def deadlines_changed(self):
+        '''
+        分片的截止时间变了：马上按新的优先级分配，并开始检查超时
+        '''
+        self.wake()
+        if self._deadline_timer is None and self.picker.deadlines:
+            self._deadline_timer = asyncio.get_running_loop().call_later(self.deadline_interval, self._check_deadlines)
+
+    def _check_deadlines(self):
+        self._deadline_timer = None
+        if not self.picker.deadlines:
+            return
+        self.fill_all()
+        self._deadline_timer = asyncio.get_running_loop().call_later(self.deadline_interval, self._check_deadlines)
+
+    def fill_all(self):
+        for peer in list(self.peers):
+            self.fill(peer)
+
+    def fill(self, peer: Peer):
+        if peer not in self.peers or self.smart_ban.is_banned(peer.addr[0]):
+            return
+        # 被 choke 时只能请求 allowed fast 的分片
+        pieces = peer.requestable_pieces()
+        if not pieces:
+            return
+        while peer.request_slots() > 0:
+            if not self._assign(peer, pieces):
+                break
+
+    def _assign(self, peer: Peer, pieces: Bitfield) -> bool:
+        if self.picker.deadlines and self._assign_urgent(peer, pieces):
+            return True
+
+        # 先把已经开始的分片下完，减少同时在下载的分片和占用的缓冲区
+        for d in self.downloads.values():
+            if d.verifying or not d.has_unrequested() or d.index not in pieces:
+                continue
+            block = d.next_block()
+            if block is not None:
+                return self._request(peer, d, block)
+
+        d = self._start_piece(peer, pieces)
+        if d is not None:
+            block = d.next_block()
+            if block is not None:
+                return self._request(peer, d, block)
+            # 所有 block 都来自快速恢复文件
+            return True
+
+        if self.in_endgame:
+            return self._endgame_request(peer, pieces)
+        return False
+
+    def _assign_urgent(self, peer: Peer, pieces: Bitfield) -> bool:
+        deadlines = self.picker.deadlines
+        now = time.monotonic()
+        urgent = [d for d in self.downloads.values() if d.index in deadlines and d.index in pieces and not d.verifying]
+        urgent.sort(key=lambda d: deadlines[d.index])
+        for d in urgent:
+            block = d.next_block()
+            if block is None and now >= deadlines[d.index]:
+                # 已经过了截止时间，没收到的 block 再向这个 peer 要一份
+                block = self._redundant_block(peer, d)
+                if block is not None:
+                    logging.debug(f'piece {d.index} is overdue, requesting block {block.offset} from {peer} too')
+            if block is not None:
+                return self._request(peer, d, block)
+
+        if self.picker.urgent(pieces) is None:
+            return False
+        d = self._start_piece(peer, pieces)
+        if d is None:
+            return False
+        block = d.next_block()
+        return block is None or self._request(peer, d, block)
+
+    def _pick(self, peer: Peer, pieces: Bitfield) -> int | None:
+        # 优先下载对方建议的分片，它们多半还在对方的缓存里
+        for index in reversed(peer.suggested):
+            if index in pieces and self.picker.pick_piece(index):
+                return index
+        return self.picker.pick(pieces)
+
+    def _start_piece(self, peer: Peer, pieces: Bitfield) -> PieceDownload | None:
+        index = self._pick(peer, pieces)
+        if index is None:
+            return None
+
+        if self.storage.direct:
+            # 映射文件会阻塞，放到线程池里，映射好之后再分配 block
+            if not self.buffer_pool.try_reserve():
+                self.picker.abort(index)
+                self.starved = True
+                return None
+            self.starved = False
+            asyncio.create_task(self._map_piece(index))
+            return None
+
+        buf = self.buffer_pool.try_acquire()
+        if buf is None:
+            # 内存预算用完，等写盘释放缓冲区后再继续
+            self.picker.abort(index)
+            self.starved = True
+            return None
+        self.starved = False
+        return self._add_download(index, buf)
+
+    async def _map_piece(self, index: int):
+        try:
+            buf = await asyncio.to_thread(self.storage.piece_buffer, index)
+        except Exception as e:
+            logging.warning(f'failed to map piece {index}: {e}')
+            buf = None
+        if self._closed:
+            if buf is not None:
+                self.storage.release_buffer(buf)
+            self.buffer_pool.unreserve()
+            return
+        if buf is None:
+            # 跨文件、跨窗口或者窗口都被占用，改用普通缓冲区
+            self.buffer_pool.unreserve()
+            buf = self.buffer_pool.try_acquire()
+            if buf is None:
+                self.picker.abort(index)
+                self.starved = True
+                return
+        self._add_download(index, buf)
+        self.wake()
+
+    def _add_download(self, index: int, buf: bytearray | memoryview) -> PieceDownload:
+        d = PieceDownload(self.torrent.pieces[index], buf)
+        self.downloads[index] = d
+        resumed = self.resumed.get(index)
+        if resumed:
+            self._load_resumed(d, resumed)
+        return d
+
+    def _load_resumed(self, d: PieceDownload, blocks: Bitfield):
+        '''
+        快速恢复的 block 不再请求。mmap 的缓冲区就是文件本身，普通缓冲区需要从存储里读回来
+        '''
+        for i in blocks:
+            d.requested[i] = set()
+        if not isinstance(d.buf, bytearray):
+            for i in blocks:
+                self._block_arrived(d, d.piece.blocks[i], None)
+            return
+
+        start = d.index * self.torrent.piece_length
+
+        def read():
+            for i in blocks:
+                block = d.piece.blocks[i]
+                d.view[block.offset:block.offset + block.length] = self.storage.read(start + block.offset, block.length)
+
+        async def load():
+            try:
+                await asyncio.to_thread(read)
+            except Exception as e:
+                logging.warning(f'failed to load resumed blocks of piece {d.index}: {e}')
+                self.resumed.pop(d.index, None)
+                for i in blocks:
+                    d.requested.pop(i, None)
+                    d.retry(i)
+                self.wake()
+                return
+            if self.downloads.get(d.index) is not d:
+                return
+            for i in blocks:
+                self._block_arrived(d, d.piece.blocks[i], None)
+
+        asyncio.create_task(load())
+
+    def _redundant_block(self, peer: Peer, d: PieceDownload) -> Block | None:
+        '''
+        已经在向别的 peer 请求、但请求数还不到 endgame_redundancy 的 block 里，请求数最少的一个
+        '''
+        best = None
+        best_count = 0
+        for i, requesters in d.requested.items():
+            n = len(requesters)
+            if n == 0 or n >= self.endgame_redundancy or peer in requesters:
+                continue
+            if best is None or n < best_count:
+                best, best_count = d.piece.blocks[i], n
+        return best
+
+    def _endgame_request(self, peer: Peer, pieces: Bitfield) -> bool:
+        # 找请求它的 peer 最少的 block
+        best = None
+        best_count = 0
+        for d in self.downloads.values():
+            if d.verifying or d.index not in pieces:
+                continue
+            block = self._redundant_block(peer, d)
+            if block is None:
+                continue
+            n = len(d.requested[block.index])
+            if best is None or n < best_count:
+                best, best_count = (d, block), n
+        if best is None:
+            return False
+        d, block = best
+        d.endgame = True
+        logging.debug(f'endgame: requesting block {d.index}-{block.offset} from {peer} too')
+        return self._request(peer, d, block)
+
+    def _request(self, peer: Peer, d: PieceDownload, block: Block) -> bool:
+        # 重复的请求（endgame、超时）写到自己的临时缓冲区，由先完成的那份拷进分片，
+        # 晚到的副本不会覆盖已经记在别的 peer 名下的数据
+        direct = not d.requested.get(block.index)
+        if direct:
+            dest = d.view[block.offset:block.offset + block.length]
+        else:
+            dest = memoryview(bytearray(block.length))
+        try:
+            future = peer.request_block(d.index, block.offset, block.length, dest)
+        except Exception as e:
+            logging.error(f'failed to send request to peer {peer}: {e}')
+            d.retry(block.index)
+            self.peers.discard(peer)
+            return False
+        d.requested.setdefault(block.index, set()).add(peer)
+        future.add_done_callback(functools.partial(self._block_done, d, block, peer, direct))
+        return True
+
+    # 完成
+
+    def _block_done(self, d: PieceDownload, block: Block, peer: Peer, direct: bool, future: asyncio.Future):
+        requesters = d.requested.get(block.index)
+        if requesters is not None:
+            requesters.discard(peer)
+
+        if future.cancelled() or future.exception() is not None:
+            exc = None if future.cancelled() else future.exception()
+            if not isinstance(exc, RequestCancelled):
+                logging.debug(f'block {d.index}-{block.offset} from {peer} failed: {exc}')
+            d.retry(block.index)
+            self.wake()
+            return
+
+        data = future.result()
+        if self.downloads.get(d.index) is not d or block.index in d.received:
+            # 已经从别的 peer 收到，或者这个分片已经放弃
+            self.fill(peer)
+            return
+        if len(data) != block.length:
+            logging.warning(f'unexpected block length {len(data)} for {d.index}-{block.offset} from {peer}')
+            d.retry(block.index)
+            self.wake()
+            return
+        if not direct or not isinstance(data, memoryview):
+            # 没有直接写进分片，补一次拷贝
+            d.view[block.offset:block.offset + block.length] = data
+
+        # endgame 下同一个 block 的其他请求都不需要了
+        for other in list(requesters or ()):
+            other.cancel_block(d.index, block.offset)
+        self._block_arrived(d, block, peer)
+        self.fill(peer)
+
+    def _block_arrived(self, d: PieceDownload, block: Block, peer: Peer | None):
+        d.requested.pop(block.index, None)
+        d.received.add(block.index)
+        if peer is not None:
+            d.senders[block.index] = peer.addr[0]
+        d.hasher.block_received(block.offset, block.length)
+        if d.complete() and not d.verifying:
+            d.verifying = True
+            asyncio.create_task(self._verify(d))
+
+    async def _verify(self, d: PieceDownload):
+        piece = d.piece
+        data = d.view[:piece.length]
+        try:
+            ok = await self.hash_pipeline.verify(piece, data, d.hasher)
+        except Exception as e:
+            logging.error(f'failed to verify piece {piece.index}: {e}')
+            ok = False
+        if self._closed:
+            return
+        self.resumed.pop(piece.index, None)
+
+        if ok:
+            bans = []
+            if self.smart_ban.has_suspects(piece.index):
+                # 之前校验失败过，和正确的数据逐个 block 比较找出发坏数据的 peer
+                good = await asyncio.to_thread(block_digests, data, piece.blocks)
+                bans = self.smart_ban.piece_passed(piece.index, good)
+            del self.downloads[piece.index]
+            self.piece_latency['endgame' if d.endgame else 'normal'].record(time.monotonic() - d.started)
+            self.picker.complete(piece.index)
+            logging.info(f'downloaded piece {piece.index}')
+            self.on_piece_done(piece, data, d.buf)
+        else:
+            blocks = await asyncio.to_thread(block_senders, data, piece.blocks, d.senders)
+            bans = self.smart_ban.piece_failed(piece.index, blocks)
+            del self.downloads[piece.index]
+            # 重新下载整个分片，快速恢复的 block 也可能是坏的
+            self.picker.abort(piece.index)
+            self.release(d.buf)
+        for ip in bans:
+            self._ban(ip)
+        self.fill_all()
+
+    def _ban(self, ip: str):
+        for peer in [p for p in self.peers if p.addr[0] == ip]:
+            self.remove_peer(peer)
+        if self.on_ban is not None:
+            self.on_ban(ip)
+
+    def release(self, buf: bytearray | memoryview):
+        if isinstance(buf, bytearray):
+            self.buffer_pool.release(buf)
+        else:
+            # 来自存储的映射，还给存储并释放占用的预算
+            self.storage.release_buffer(buf)
+            self.buffer_pool.unreserve()
+        if self.starved:
+            self.wake()
+
+    def close(self):
+        '''
+        停止下载：作废所有请求，释放还没下完的分片的缓冲区，之后存储才能关闭
+        '''
+        self._closed = True
+        for peer in list(self.peers):
+            peer.drop_requests()
+        self.peers.clear()
+        for d in self.downloads.values():
+            d.release()
+            self.release(d.buf)
+        self.downloads.clear()
+
+    # 超时
+
+    def expire_requests(self):
+        for peer in list(self.peers):
+            for index, offset in peer.expired_requests(self.request_timeout):
+                logging.warning(f'request {index}-{offset} to {peer} timed out')
+                peer.cancel_block(index, offset)
+
+    async def run(self):
+        '''
+        只负责超时检查，分配都由事件触发
+        '''
+        while not self.picker.finished:
+            await asyncio.sleep(self.request_timeout / 4)
+            self.expire_requests()
+            self.fill_all()
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, List, Tuple, TypeVar
+from .client import TorrentClient
+from .dht import DHTServer
+from .hasher import HashPipeline
+from .listener import InboundListener
+from .magnet import MagnetLink, MetadataFetcher
+from .torrent import Torrent
+from .tracker import _calculate_peer_id
+from .utp import UTPEndpoint
+
+
+K = TypeVar('K', bound=Hashable)
+
+
+def fair_share(total: int, demands: Dict[K, int], start: int = 0) -> Dict[K, int]:
+    '''
+    max-min 公平分配：需求不到平均份额的拿到自己的需求，剩下的由其余的平分。
+    除不尽的部分从第 start 个开始每个多分 1，调用方每轮换一个 start，长期来看谁也不吃亏
+    '''
+    result = {k: 0 for k in demands}
+    pending = [k for k, d in demands.items() if d > 0]
+    remaining = total
+    while pending and remaining > 0:
+        share = remaining // len(pending)
+        satisfied = [k for k in pending if demands[k] - result[k] <= share]
+        if satisfied:
+            for k in satisfied:
+                remaining -= demands[k] - result[k]
+                result[k] = demands[k]
+            pending = [k for k in pending if k not in satisfied]
+            continue
+        for k in pending:
+            result[k] += share
+        remaining -= share * len(pending)
+        offset = start % len(pending)
+        for k in (pending[offset:] + pending[:offset])[:remaining]:
+            result[k] += 1
+        break
+    return result
+
+
+class Session:
+    '''
+    在一个事件循环里运行多个种子，共用一个 DHT 节点、一个监听端口（TCP 和 uTP）、一个校验线程池和同一个 peer id。
+    连接数、内存、写缓存和打开的文件数是整个 Session 的总预算，每 rebalance_interval 秒按各个种子的需求公平地重新分配；
+    DHT 查找也由 Session 统一排队，每次最多 dht_concurrency 个，最久没查过的种子优先。
+    同时下载的种子不超过 max_active_downloads 个，其余的排队，下载完（或者移除）一个再启动下一个。
+    '''
+    def __init__(self, base_dir: str = '.', dht_port: int = 9999, listen_port: int = 6881,
+                 node_id: bytes | None = None, max_connections: int = 500, max_connecting: int = 50,
+                 memory_budget: int = 2**29, write_cache_bytes: int = 2**27, hash_workers: int = 4,
+                 max_active_downloads: int | None = None, utp: bool = False, dht_concurrency: int = 4,
+                 dht_interval: float = 30.0, bootstrap_interval: float = 600.0, rebalance_interval: float = 5.0,
+                 max_open_files: int = 256, **client_options):
+        self.base_dir = base_dir
+        self.dht_port = dht_port
+        self.listen_port = listen_port
+        self.node_id = os.urandom(20) if node_id is None else node_id
+        self.max_connections = max_connections
+        self.max_connecting = max_connecting
+        self.memory_budget = memory_budget
+        self.write_cache_bytes = write_cache_bytes
+        # 所有种子的存储一共打开的文件描述符，每个种子至少 1 个
+        self.max_open_files = max_open_files
+        self.max_active_downloads = max_active_downloads
+        self.utp = utp
+        self.dht_concurrency = dht_concurrency
+        self.dht_interval = dht_interval
+        self.bootstrap_interval = bootstrap_interval
+        self.rebalance_interval = rebalance_interval
+        # 其余参数原样传给每个 TorrentClient
+        self.client_options = client_options
+
+        self.peer_id = _calculate_peer_id()
+        self.hash_pipeline = HashPipeline(hash_workers)
+        self.dht: DHTServer | None = None
+        # 连进来的连接按 info hash 分给各个种子
+        self.listener = InboundListener(port=listen_port)
+        self.utp_endpoint: UTPEndpoint | None = None
+
+        self.torrents: Dict[bytes, TorrentClient] = {}
+        # 每个种子单独的上限：(连接数, 同时连接数, 内存, 写缓存, 打开的文件数)，分到的份额不会超过它
+        self._limits: Dict[bytes, Tuple[int, int, int, int, int]] = {}
+        self._tasks: Dict[bytes, asyncio.Task] = {}
+        self._queue: Deque[bytes] = deque()
+        self._next_lookup: Dict[bytes, float] = {}
+        self._last_bootstrap: float | None = None
+        self._round = 0
+        self._background: List[asyncio.Task] = []
+        self._started = False
+
+    async def start(self):
+        self.dht = DHTServer(('0.0.0.0', self.dht_port), ids=self.node_id)
+        await self.dht.run()
+        await self.listener.start()
+        self.listen_port = self.listener.port
+        if self.utp:
+            self.utp_endpoint = await UTPEndpoint.create(('0.0.0.0', self.listen_port),
+                                                         self.listener.protocol_factory)
+        # start 之前加入的种子
+        for client in self.torrents.values():
+            self._share(client)
+        self._started = True
+        self._background = [
+            asyncio.create_task(self.discovering()),
+            asyncio.create_task(self.rebalancing()),
+        ]
+        self._activate()
+
+    def add(self, torrent: Torrent, **options) -> TorrentClient:
+        '''
+        加入一个种子，options 覆盖 Session 的 client_options。同一个 info hash 重复加入时返回已有的
+        '''
+        client = self.torrents.get(torrent.info_hash)
+        if client is not None:
+            return client
+
+        options = {'base_dir': self.base_dir, **self.client_options, **options}
+        client = TorrentClient(torrent, peer_id=self.peer_id, hash_pipeline=self.hash_pipeline, discovery=False,
+                               **options)
+        self._share(client)
+        self.torrents[torrent.info_hash] = client
+        self._limits[torrent.info_hash] = (client.connections.max_connections, client.connections.max_connecting,
+                                           client.buffer_pool.budget, client.write_cache.max_bytes,
+                                           client.storage.max_open_files)
+        self._queue.append(torrent.info_hash)
+        logging.info(f'added torrent {torrent.info_hash.hex()}, {len(self.torrents)} torrents in session')
+        if self._started:
+            self._activate()
+            self.rebalance()
+        return client
+
+    def _share(self, client: TorrentClient):
+        client.dht = self.dht
+        client.listener = self.listener
+        if self.utp_endpoint is not None:
+            client.utp = True
+            client.utp_endpoint = self.utp_endpoint
+
+    async def add_magnet(self, uri: str, **options) -> TorrentClient:
+        '''
+        用共享的 DHT 下载元数据后加入种子
+        '''
+        link = MagnetLink.parse(uri)
+        client = self.torrents.get(link.info_hash)
+        if client is not None:
+            return client
+
+        fetcher = MetadataFetcher(link.info_hash, self.peer_id)
+        info = await fetcher.fetch(self.dht, link.peers)
+        client = self.add(Torrent.from_info(info, link.trackers), **options)
+        client.connections.add_peers(link.peers + fetcher.known_peers)
+        return client
+
+    async def remove(self, info_hash: bytes):
+        client = self.torrents.pop(info_hash, None)
+        if client is None:
+            return
+        self._limits.pop(info_hash, None)
+        self._next_lookup.pop(info_hash, None)
+        if info_hash in self._queue:
+            self._queue.remove(info_hash)
+        task = self._tasks.pop(info_hash, None)
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+        logging.info(f'removed torrent {info_hash.hex()}')
+        self._activate()
+
+    async def close(self):
+        for task in self._background:
+            task.cancel()
+        for info_hash in list(self.torrents):
+            await self.remove(info_hash)
+        self.listener.close()
+        if self.utp_endpoint is not None:
+            self.utp_endpoint.close()
+        if self.dht is not None:
+            self.dht.close()
+        self.hash_pipeline.close()
+
+    async def wait(self):
+        '''
+        等到所有种子都下载完。做种的种子不会结束，只等它们下载完成
+        '''
+        while any(not c.completed for c in self.torrents.values()):
+            await asyncio.sleep(1)
+
+    def _downloading(self) -> List[bytes]:
+        return [h for h, task in self._tasks.items()
+                if not task.done() and not self.torrents[h].completed]
+
+    def _activate(self):
+        '''
+        有空的下载名额时启动排队的种子
+        '''
+        while self._queue:
+            if self.max_active_downloads is not None and len(self._downloading()) >= self.max_active_downloads:
+                return
+            info_hash = self._queue.popleft()
+            task = asyncio.create_task(self.torrents[info_hash].start())
+            task.add_done_callback(lambda t, h=info_hash: self._finished(h, t))
+            self._tasks[info_hash] = task
+
+    def _finished(self, info_hash: bytes, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f'torrent {info_hash.hex()} failed: {task.exception()!r}')
+        if self._tasks.get(info_hash) is task:
+            self._activate()
+
+    def _running(self) -> Dict[bytes, TorrentClient]:
+        return {h: self.torrents[h] for h, task in self._tasks.items() if not task.done()}
+
+    def rebalance(self):
+        '''
+        按需求重新分配连接数、内存、写缓存和打开的文件数。不在下载的种子不分内存和写缓存；
+        没有连接也没有候选地址的种子也至少要 1 个连接的份额，这样 DHT 找到 peer 后马上就能连
+        '''
+        running = self._running()
+        self._round += 1
+        connections = {}
+        connecting = {}
+        memory = {}
+        cache = {}
+        files = {}
+        for h, client in running.items():
+            max_connections, max_connecting, max_memory, max_cache, max_files = self._limits[h]
+            files[h] = min(max_files, len(client.torrent.files))
+            wanted = client.connections.wanted()
+            connections[h] = min(max_connections, max(1, wanted))
+            connecting[h] = min(max_connecting, max(1, wanted - client.connections.connected))
+            if not client.completed:
+                left = client.left
+                memory[h] = min(max_memory, max(client.torrent.piece_length, left))
+                cache[h] = min(max_cache, left)
+
+        connections = fair_share(self.max_connections, connections, self._round)
+        connecting = fair_share(self.max_connecting, connecting, self._round)
+        memory = fair_share(self.memory_budget, memory, self._round)
+        cache = fair_share(self.write_cache_bytes, cache, self._round)
+        files = fair_share(self.max_open_files, files, self._round)
+        for h, client in running.items():
+            client.connections.set_limits(connections[h], connecting[h])
+            n = max(1, files[h])
+            if n != client.storage.max_open_files:
+                # 变小时要关掉多余的文件，可能要等写盘线程，不在事件循环里做
+                asyncio.get_running_loop().run_in_executor(None, client.storage.set_max_open_files, n)
+            if h in memory:
+                client.buffer_pool.set_budget(memory[h])
+                client.write_cache.max_bytes = cache[h]
+
+    async def rebalancing(self):
+        while True:
+            self._activate()
+            self.rebalance()
+            await asyncio.sleep(self.rebalance_interval)
+
+    async def _lookup(self, info_hash: bytes, client: TorrentClient):
+        try:
+            peers = await self.dht.get_peers(info_hash)
+        except Exception as e:
+            logging.warning(f'DHT lookup for {info_hash.hex()} failed: {e!r}')
+            peers = set()
+        added = client.connections.add_peers(peers)
+        logging.info(f'got {len(peers)} peers from DHT network for {info_hash.hex()}, {added} new')
+        # 找到了新的 peer 时，还缺连接就可以马上再查
+        self._next_lookup[info_hash] = time.monotonic() + (0 if added else self.dht_interval)
+
+    async def discovering(self):
+        '''
+        替所有种子在共享的 DHT 上找 peer：只查缺连接的种子，最久没查过的优先
+        '''
+        while True:
+            now = time.monotonic()
+            if self._last_bootstrap is None or now - self._last_bootstrap >= self.bootstrap_interval:
+                await self.dht.bootstrap(max_nodes=100)
+                self._last_bootstrap = time.monotonic()
+
+            due = [h for h, client in self._running().items()
+                   if client.connections.need_peers() and self._next_lookup.get(h, 0) <= now]
+            if not due:
+                await asyncio.sleep(1)
+                continue
+            due.sort(key=lambda h: self._next_lookup.get(h, 0))
+            batch = due[:self.dht_concurrency]
+            for h in batch:
+                # 查找期间不重复排队
+                self._next_lookup[h] = now + self.dht_interval
+            await asyncio.gather(*(self._lookup(h, self.torrents[h]) for h in batch if h in self.torrents))
+
+    def stats(self) -> Dict[str, int]:
+        running = self._running()
+        return {
+            'torrents': len(self.torrents),
+            'running': len(running),
+            'downloading': len(self._downloading()),
+            'queued': len(self._queue),
+            'connections': sum(c.connections.connected for c in running.values()),
+            'memory_in_use': sum(c.buffer_pool.in_use_bytes for c in running.values()),
+            'write_cache': sum(c.write_cache.size for c in running.values()),
+            'incoming': self.listener.accepted,
+        }
@@ -0,0 +1,77 @@
+import time
+from collections import deque
+from typing import Deque, Dict, List
+
+
+class LatencyStats:
+    '''
+    保留最近 max_samples 个样本，用于计算尾延迟
+    '''
+    def __init__(self, max_samples: int = 10000):
+        self._samples: Deque[float] = deque(maxlen=max_samples)
+        self.count = 0
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, p: float) -> float:
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * p / 100))
+        return samples[index]
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            'count': self.count,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': max(self._samples, default=0.0),
+        }
+
+    def __str__(self):
+        s = self.summary()
+        return f'count={s["count"]} p50={s["p50"]:.2f}s p90={s["p90"]:.2f}s p99={s["p99"]:.2f}s max={s["max"]:.2f}s'
+
+
+class RateMeter:
+    '''
+    最近 window 秒内的平均速率，按秒分桶累计，字节/秒
+    '''
+    def __init__(self, window: float = 20.0):
+        self.window = window
+        self.total = 0
+        self._buckets: Deque[List[int]] = deque()
+        self._bytes = 0
+        self._started: float | None = None
+
+    def update(self, nbytes: int, now: float | None = None):
+        now = time.monotonic() if now is None else now
+        if self._started is None:
+            self._started = now
+        second = int(now)
+        if self._buckets and self._buckets[-1][0] == second:
+            self._buckets[-1][1] += nbytes
+        else:
+            self._buckets.append([second, nbytes])
+        self._bytes += nbytes
+        self.total += nbytes
+        self._expire(now)
+
+    def _expire(self, now: float):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._bytes -= self._buckets.popleft()[1]
+
+    def rate(self, now: float | None = None) -> float:
+        if self._started is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        # 刚开始统计时按实际经过的时间算，至少 1 秒，避免第一个 block 算出极大的速率
+        elapsed = max(1.0, min(self.window, now - self._started))
+        return self._bytes / elapsed
+
+    def __str__(self):
+        return f'{self.rate() / 2**10:.1f}KiB/s'
@@ -0,0 +1,434 @@
+import bisect
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Sequence, Set, Tuple
+from .torrent import Torrent
+
+
+# pwritev 一次最多接受的 iovec 数量
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+
+def _slice_buffers(buffers: Sequence[memoryview], start: int, length: int) -> List[memoryview]:
+    '''
+    从一组连续的缓冲区里取出 [start, start + length) 这一段，不拷贝数据
+    '''
+    res = []
+    pos = 0
+    for buf in buffers:
+        end = pos + len(buf)
+        if end > start and pos < start + length:
+            lo = max(start, pos) - pos
+            hi = min(start + length, end) - pos
+            res.append(buf[lo:hi])
+        pos = end
+        if pos >= start + length:
+            break
+    return res
+
+
+@dataclass
+class FileSpan:
+    file_index: int
+    # 在文件内的偏移
+    file_offset: int
+    # 在这次读写的数据内的偏移
+    offset: int
+    length: int
+
+
+class Storage:
+    '''
+    把分片映射到它跨越的文件上，用 pwrite/preadv 按位置读写，打开的文件描述符有数量上限
+    '''
+    # piece_buffer 能返回直接接收分片数据的缓冲区
+    direct = False
+
+    def __init__(self, torrent: Torrent, base_dir: str = '.', max_open_files: int = 64, allocation: str = 'sparse'):
+        if allocation not in ('sparse', 'full'):
+            raise ValueError(f'unknown allocation mode: {allocation}')
+
+        self.torrent = torrent
+        self.base_dir = base_dir
+        self.max_open_files = max_open_files
+        self.allocation = allocation
+        self._offsets = [f.offset for f in torrent.files]
+        self._fds: OrderedDict[int, int] = OrderedDict()
+        self._dirty: Set[int] = set()
+        # 跳过的文件 open 时不创建，只有和别的文件共用的边界分片写进来时才创建并稀疏扩展
+        self.skipped: Set[int] = set()
+        self._opened = False
+        # 写盘、上传读取和重新校验在不同的线程里，淘汰文件描述符时不能有别的线程还在用
+        self._lock = threading.RLock()
+
+    def path(self, file_index: int) -> str:
+        file = self.torrent.files[file_index]
+        if self.torrent.is_multi_files:
+            path = os.path.join(self.base_dir, self.torrent.name, *file.name.split('/'))
+        else:
+            path = os.path.join(self.base_dir, file.name)
+        # Torrent 加载时已经检查过文件名，这里再确认一次不会写到 base_dir 外面
+        base = os.path.abspath(self.base_dir)
+        if os.path.commonpath([base, os.path.abspath(path)]) != base:
+            raise ValueError(f'file path escapes download directory: {file.name!r}')
+        return path
+
+    def spans(self, offset: int, length: int) -> List[FileSpan]:
+        '''
+        把种子数据中 [offset, offset + length) 这一段映射到各个文件上
+        '''
+        spans = []
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        pos = offset
+        end = offset + length
+        while pos < end and i < len(self.torrent.files):
+            file = self.torrent.files[i]
+            file_end = file.offset + file.length
+            if pos < file_end:
+                n = min(end, file_end) - pos
+                spans.append(FileSpan(i, pos - file.offset, pos - offset, n))
+                pos += n
+            i += 1
+        return spans
+
+    def piece_spans(self, index: int) -> List[FileSpan]:
+        piece = self.torrent.pieces[index]
+        return self.spans(index * self.torrent.piece_length, piece.length)
+
+    def open(self):
+        '''
+        创建目录和文件，并把文件扩展到最终大小（稀疏或真实分配），已有数据不会被截断。跳过的文件不创建
+        '''
+        with self._lock:
+            for i in range(len(self.torrent.files)):
+                if i not in self.skipped:
+                    self._allocate(i)
+            self._opened = True
+        logging.info(f'storage ready: {len(self.torrent.files) - len(self.skipped)} files under {self.base_dir}, '
+                     f'{len(self.skipped)} skipped')
+
+    def _allocate(self, file_index: int):
+        file = self.torrent.files[file_index]
+        path = self.path(file_index)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = self._fd(file_index)
+        size = os.fstat(fd).st_size
+        if size >= file.length:
+            return
+        if self.allocation == 'full' and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, file.length)
+                return
+            except OSError as e:
+                logging.warning(f'fallocate {path} failed, using sparse file: {e}')
+        os.ftruncate(fd, file.length)
+
+    def set_skipped(self, files: Iterable[int]):
+        '''
+        修改跳过的文件。已经 open 过时，不再跳过的文件马上创建并扩展；改成跳过的文件里已有的数据保留
+        '''
+        files = set(files)
+        with self._lock:
+            unskipped = self.skipped - files
+            self.skipped = files
+            if self._opened:
+                for i in sorted(unskipped):
+                    self._allocate(i)
+
+    def set_max_open_files(self, n: int):
+        '''
+        调整文件描述符上限，变小时马上关掉最久没用的。要等别的线程用完，应该在线程池里调用
+        '''
+        with self._lock:
+            self.max_open_files = max(1, n)
+            while len(self._fds) > self.max_open_files:
+                _, fd = self._fds.popitem(last=False)
+                os.close(fd)
+
+    def _fd(self, file_index: int) -> int:
+        fd = self._fds.get(file_index)
+        if fd is not None:
+            self._fds.move_to_end(file_index)
+            return fd
+
+        if len(self._fds) >= self.max_open_files:
+            _, old = self._fds.popitem(last=False)
+            os.close(old)
+
+        path = self.path(file_index)
+        skipped = file_index in self.skipped
+        if skipped:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        length = self.torrent.files[file_index].length
+        if skipped and os.fstat(fd).st_size < length:
+            # 只写边界分片的那一部分，稀疏扩展不占磁盘空间，也让 mmap 可以映射
+            os.ftruncate(fd, length)
+        self._fds[file_index] = fd
+        return fd
+
+    def write(self, offset: int, data: bytes | memoryview):
+        view = memoryview(data)
+        with self._lock:
+            for span in self.spans(offset, len(view)):
+                fd = self._fd(span.file_index)
+                self._dirty.add(span.file_index)
+                chunk = view[span.offset:span.offset + span.length]
+                written = 0
+                while written < span.length:
+                    written += os.pwrite(fd, chunk[written:], span.file_offset + written)
+
+    def write_piece(self, index: int, data: bytes | memoryview):
+        self.write(index * self.torrent.piece_length, data)
+
+    def writev(self, offset: int, buffers: Sequence[bytes | memoryview]):
+        '''
+        把连续的多个缓冲区写到 offset 处，每个文件只调用一次 pwritev（超过 IOV_MAX 时分批）
+        '''
+        views = [memoryview(b) for b in buffers]
+        total = sum(len(v) for v in views)
+        with self._lock:
+            for span in self.spans(offset, total):
+                fd = self._fd(span.file_index)
+                self._dirty.add(span.file_index)
+                chunks = _slice_buffers(views, span.offset, span.length)
+                file_offset = span.file_offset
+                while chunks:
+                    batch = chunks[:IOV_MAX]
+                    n = os.pwritev(fd, batch, file_offset)
+                    file_offset += n
+                    # 跳过已经写完的部分（可能只写了一部分）
+                    chunks = _slice_buffers(chunks, n, sum(len(c) for c in chunks) - n)
+
+    def sync(self):
+        with self._lock:
+            for file_index in sorted(self._dirty):
+                os.fsync(self._fd(file_index))
+            self._dirty.clear()
+
+    def read(self, offset: int, length: int) -> bytearray:
+        buf = bytearray(length)
+        view = memoryview(buf)
+        with self._lock:
+            for span in self.spans(offset, length):
+                fd = self._fd(span.file_index)
+                chunk = view[span.offset:span.offset + span.length]
+                done = 0
+                while done < span.length:
+                    n = os.preadv(fd, [chunk[done:]], span.file_offset + done)
+                    if n == 0:
+                        raise EOFError(f'short read from {self.path(span.file_index)}')
+                    done += n
+        return buf
+
+    def read_piece(self, index: int) -> bytearray:
+        piece = self.torrent.pieces[index]
+        return self.read(index * self.torrent.piece_length, piece.length)
+
+    def piece_buffer(self, index: int) -> memoryview | None:
+        '''
+        可以直接接收分片数据的缓冲区，普通文件存储没有
+        '''
+        return None
+
+    def release_buffer(self, buf: memoryview):
+        '''
+        归还 piece_buffer 返回的缓冲区
+        '''
+        pass
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds.clear()
+            self._opened = False
+
+
+class MmapStorage(Storage):
+    '''
+    把文件按窗口映射到内存：block 直接写进映射，校验和上传直接读映射，不需要额外的 read/write 系统调用。
+    同时映射的窗口数量有上限，所以可以处理比内存大的文件。
+
+    映射、淘汰时的 msync 都是阻塞调用，所有方法都应该在线程池里调用。piece_buffer 借出的窗口在 release_buffer
+    之前不会被淘汰；窗口数到了上限并且都被借出时 piece_buffer 返回 None，读写改用 pwrite/preadv。
+    '''
+    direct = True
+
+    def __init__(self, torrent: Torrent, base_dir: str = '.', max_open_files: int = 64, allocation: str = 'sparse',
+                 window_size: int = 2**26, max_windows: int = 16):
+        super().__init__(torrent, base_dir, max_open_files, allocation)
+        # 映射的偏移必须是 ALLOCATIONGRANULARITY 的整数倍
+        granularity = mmap.ALLOCATIONGRANULARITY
+        self.window_size = max(granularity, window_size // granularity * granularity)
+        self.max_windows = max_windows
+        self._windows: OrderedDict[Tuple[int, int], mmap.mmap] = OrderedDict()
+        self._dirty_windows: Set[Tuple[int, int]] = set()
+        # 窗口 -> 借出的分片缓冲区数量
+        self._pinned: Dict[Tuple[int, int], int] = {}
+        # id(缓冲区) -> (窗口, 缓冲区)
+        self._buffers: Dict[int, Tuple[Tuple[int, int], memoryview]] = {}
+        # 归还缓冲区在事件循环里调用，不能等 self._lock（别的线程可能正拿着它 msync）
+        self._pin_lock = threading.Lock()
+
+    def _window(self, file_index: int, n: int) -> mmap.mmap | None:
+        key = (file_index, n)
+        m = self._windows.get(key)
+        if m is not None:
+            self._windows.move_to_end(key)
+            return m
+
+        if not self._evict():
+            return None
+        file = self.torrent.files[file_index]
+        offset = n * self.window_size
+        length = min(self.window_size, file.length - offset)
+        m = mmap.mmap(self._fd(file_index), length, offset=offset)
+        self._windows[key] = m
+        return m
+
+    def _evict(self) -> bool:
+        '''
+        腾出一个窗口的位置，借出的窗口不淘汰。全部被借出时返回 False
+        '''
+        if len(self._windows) < self.max_windows:
+            return True
+        for key in list(self._windows):
+            if self._pinned.get(key):
+                continue
+            m = self._windows.pop(key)
+            if key in self._dirty_windows:
+                m.flush()
+            self._dirty_windows.discard(key)
+            try:
+                m.close()
+            except BufferError:
+                # 还有临时的视图（比如刚读出的数据）引用它，视图释放后由垃圾回收解除映射
+                logging.debug(f'mapping {key} still referenced, leaving it to the garbage collector')
+            return True
+        return False
+
+    def _views(self, offset: int, length: int) -> List[Tuple[Tuple[int, int], memoryview]] | None:
+        with self._lock:
+            return self._map_range(offset, length)
+
+    def _map_range(self, offset: int, length: int) -> List[Tuple[Tuple[int, int], memoryview]] | None:
+        views = []
+        for span in self.spans(offset, length):
+            pos = span.file_offset
+            end = span.file_offset + span.length
+            while pos < end:
+                n = pos // self.window_size
+                window_end = min(end, (n + 1) * self.window_size)
+                m = self._window(span.file_index, n)
+                if m is None:
+                    return None
+                start = pos - n * self.window_size
+                views.append(((span.file_index, n), memoryview(m)[start:start + window_end - pos]))
+                pos = window_end
+        return views
+
+    def piece_buffer(self, index: int) -> memoryview | None:
+        piece = self.torrent.pieces[index]
+        start = index * self.torrent.piece_length
+        if len(self.spans(start, piece.length)) != 1:
+            # 跨文件的分片不连续，仍然使用普通缓冲区
+            return None
+        with self._lock:
+            views = self._map_range(start, piece.length)
+            if views is None or len(views) != 1:
+                # 窗口都被借出，或者分片跨窗口
+                return None
+            key, view = views[0]
+            self._dirty_windows.add(key)
+            with self._pin_lock:
+                self._pinned[key] = self._pinned.get(key, 0) + 1
+                self._buffers[id(view)] = (key, view)
+        return view
+
+    def release_buffer(self, buf: memoryview):
+        with self._pin_lock:
+            entry = self._buffers.pop(id(buf), None)
+            if entry is None:
+                return
+            key, view = entry
+            self._pinned[key] -= 1
+            if not self._pinned[key]:
+                del self._pinned[key]
+            self._release_view(view)
+
+    def _release_view(self, view: memoryview):
+        try:
+            view.release()
+        except BufferError:
+            # 别的线程正在用它（比如还在计算哈希），等引用消失后再释放
+            pass
+
+    def write(self, offset: int, data: bytes | memoryview):
+        self.writev(offset, [data])
+
+    def writev(self, offset: int, buffers: Sequence[bytes | memoryview]):
+        views = [memoryview(b) for b in buffers]
+        total = sum(len(v) for v in views)
+        dests = self._views(offset, total)
+        if dests is None:
+            super().writev(offset, views)
+            return
+        pos = 0
+        for key, dest in dests:
+            with self._lock:
+                self._dirty_windows.add(key)
+            filled = 0
+            for chunk in _slice_buffers(views, pos, len(dest)):
+                dest[filled:filled + len(chunk)] = chunk
+                filled += len(chunk)
+            pos += len(dest)
+
+    def read(self, offset: int, length: int) -> bytearray | memoryview:
+        views = self._views(offset, length)
+        if views is None:
+            return super().read(offset, length)
+        if len(views) == 1:
+            return views[0][1]
+        return bytearray(b''.join(v for _, v in views))
+
+    def sync(self):
+        with self._lock:
+            for key in list(self._dirty_windows):
+                m = self._windows.get(key)
+                if m is not None:
+                    m.flush()
+            self._dirty_windows.clear()
+        super().sync()
+
+    def close(self):
+        with self._lock:
+            # 还没归还的分片缓冲区（比如没下完的分片）先释放，映射才能解除
+            with self._pin_lock:
+                for _, view in self._buffers.values():
+                    self._release_view(view)
+                self._buffers.clear()
+                self._pinned.clear()
+            self._close_windows()
+        super().close()
+
+    def _close_windows(self):
+        for key, m in list(self._windows.items()):
+            try:
+                if key in self._dirty_windows:
+                    m.flush()
+                m.close()
+            except BufferError:
+                logging.warning(f'mapping {key} still in use, leaving it to the garbage collector')
+        self._windows.clear()
+        self._dirty_windows.clear()
+
+
+STORAGE_BACKENDS = {
+    'file': Storage,
+    'mmap': MmapStorage,
+}
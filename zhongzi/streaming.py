@@ -0,0 +1,187 @@
+import json
+import logging
+import mimetypes
+import time
+from typing import Set
+from aiohttp import web
+from .client import TorrentClient
+from .picker import Priority
+
+
+class TorrentStream:
+    '''
+    把种子里的一个文件当作可以 seek 的异步文件读取。每次 read 都给要读的分片和后面 readahead 个分片设置截止时间，
+    第 i 个分片是 deadline_step * (i + 1) 秒之后，调度器会先于其他分片下载它们；read 只等到需要的分片校验通过。
+    打开跳过的文件时把它改回 NORMAL，下载已经结束时无法再下载，抛出 ValueError。
+    '''
+    def __init__(self, client: TorrentClient, file_index: int = 0, readahead: int = 8, deadline_step: float = 1.0):
+        if client.file_priorities[file_index] == Priority.SKIP:
+            if client.completed:
+                raise ValueError(f'file {file_index} is skipped and the download has finished')
+            client.set_file_priority(file_index, Priority.NORMAL)
+        self.client = client
+        self.file = client.torrent.files[file_index]
+        self.readahead = readahead
+        self.deadline_step = deadline_step
+        self.position = 0
+        # 这个流设置过截止时间的分片
+        self._deadlines: Set[int] = set()
+
+    @property
+    def size(self) -> int:
+        return self.file.length
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self.position = offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def _prioritize(self, n: int):
+        '''
+        这次要读的分片加上后面 readahead 个分片
+        '''
+        torrent = self.client.torrent
+        picker = self.client.picker
+        first = (self.file.offset + self.position) // torrent.piece_length
+        needed = (self.file.offset + self.position + max(n, 1) - 1) // torrent.piece_length
+        last = (self.file.offset + self.size - 1) // torrent.piece_length
+        window = range(first, min(last, needed + self.readahead) + 1)
+
+        for index in self._deadlines - set(window):
+            picker.clear_deadline(index)
+        now = time.monotonic()
+        for i, index in enumerate(window):
+            deadline = now + self.deadline_step * (i + 1)
+            # 已经设置过的不往后推
+            picker.set_deadline(index, min(deadline, picker.deadlines.get(index, deadline)))
+        self._deadlines = {index for index in window if index in picker.deadlines}
+        self.client.scheduler.deadlines_changed()
+
+    async def read(self, n: int = -1) -> bytes:
+        if self.position >= self.size:
+            return b''
+        n = self.size - self.position if n < 0 else min(n, self.size - self.position)
+        self._prioritize(n)
+
+        torrent = self.client.torrent
+        offset = self.file.offset + self.position
+        end = offset + n
+        data = bytearray()
+        while offset < end:
+            index = offset // torrent.piece_length
+            begin = offset - index * torrent.piece_length
+            length = min(end - offset, torrent.pieces[index].length - begin)
+            await self.client.wait_piece(index)
+            block = await self.client.read_block(None, index, begin, length)
+            if block is None:
+                # 刚好被移出写缓存，再等一次
+                continue
+            # 写缓存里的数据所在的缓冲区写盘后会被复用，马上拷贝
+            data += block
+            offset += length
+        self.position += n
+        return bytes(data)
+
+    def close(self):
+        for index in self._deadlines:
+            self.client.picker.clear_deadline(index)
+        self._deadlines.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+
+class StreamServer:
+    '''
+    本地 HTTP 服务，播放器可以边下边播：GET / 返回文件列表，GET /<文件序号> 返回文件内容并支持 Range
+    '''
+    def __init__(self, client: TorrentClient, host: str = '127.0.0.1', port: int = 0, chunk_size: int = 2**16,
+                 readahead: int = 8, deadline_step: float = 1.0):
+        self.client = client
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.deadline_step = deadline_step
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/', self._index)
+        app.router.add_get(r'/{index:\d+}', self._file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # port 为 0 时由系统分配
+        self.port = self._runner.addresses[0][1]
+        logging.info(f'streaming {self.client.torrent.name} on http://{self.host}:{self.port}/')
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def url(self, file_index: int = 0) -> str:
+        return f'http://{self.host}:{self.port}/{file_index}'
+
+    async def _index(self, request: web.Request) -> web.Response:
+        files = [{'name': f.name, 'length': f.length, 'url': self.url(i)}
+                 for i, f in enumerate(self.client.torrent.files)]
+        return web.Response(text=json.dumps(files, ensure_ascii=False), content_type='application/json')
+
+    async def _file(self, request: web.Request) -> web.StreamResponse:
+        index = int(request.match_info['index'])
+        if index >= len(self.client.torrent.files):
+            raise web.HTTPNotFound()
+        file = self.client.torrent.files[index]
+        size = file.length
+
+        try:
+            rng = request.http_range
+        except ValueError:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+        start, stop = rng.start, rng.stop
+        if start is None:
+            start = 0
+        elif start < 0:
+            # bytes=-N：最后 N 个字节
+            start = max(0, size + start)
+        stop = size if stop is None else min(stop, size)
+        partial = 'Range' in request.headers
+        if partial and start >= stop:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f'bytes */{size}'})
+        try:
+            stream = TorrentStream(self.client, index, self.readahead, self.deadline_step)
+        except ValueError:
+            raise web.HTTPNotFound()
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Content-Type': mimetypes.guess_type(file.name)[0] or 'application/octet-stream',
+            'Content-Length': str(stop - start),
+        }
+        if partial:
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        response = web.StreamResponse(status=206 if partial else 200, headers=headers)
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        async with stream:
+            stream.seek(start)
+            while stream.tell() < stop:
+                data = await stream.read(min(self.chunk_size, stop - stream.tell()))
+                await response.write(data)
+        await response.write_eof()
+        return response
@@ -4,43 +4,94 @@ from dataclasses import dataclass
 from typing import List
 
 
+def _check_path_part(part: str) -> str:
+    '''
+    种子里的文件名来自别人（磁力链接的元数据更是来自任意 peer），不能让它指向下载目录之外
+    '''
+    if part in ('', '.', '..') or '\0' in part or '/' in part or '\\' in part:
+        raise ValueError(f'unsafe path component in torrent: {part!r}')
+    return part
+
+
 @dataclass
 class TorrentFile:
     name: str
     length: int
+    # 文件在整个种子数据中的起始位置
+    offset: int = 0
 
 
 class Torrent:
     def __init__(self, filename):
         self._filename = filename
+        with open(self._filename, 'rb') as f:
+            meta = f.read()
+        self._load(bencode.Decoder(meta).decode())
+
+    @classmethod
+    def from_bytes(cls, meta: bytes) -> 'Torrent':
+        '''
+        从内存中的 .torrent 内容构造
+        '''
+        t = cls.__new__(cls)
+        t._filename = None
+        t._load(bencode.Decoder(meta).decode())
+        return t
+
+    @classmethod
+    def from_info(cls, info: bytes, trackers: List[str] | None = None) -> 'Torrent':
+        '''
+        从 info 字典构造（比如通过 ut_metadata 从 peer 那里拿到的），info hash 按原始字节计算
+        '''
+        meta_info = {b'info': bencode.Decoder(info).decode()}
+        if trackers:
+            meta_info[b'announce'] = trackers[0].encode('utf-8')
+        t = cls.__new__(cls)
+        t._filename = None
+        t._load(meta_info, bytes(info))
+        return t
+
+    def _load(self, meta_info, info: bytes | None = None):
         self.files: List[TorrentFile] = []
         self._is_multi_files = False
         self._pieces = None
 
-        with open(self._filename, 'rb') as f:
-            meta = f.read()
-            self.meta_info = bencode.Decoder(meta).decode()
-            info = bencode.Encoder(self.meta_info[b'info']).encode()
-            self._info_hash = sha1(info).digest()
-            self._name = self.meta_info[b'info'][b'name'].decode('utf-8')
-            self._piece_length = self.meta_info[b'info'][b'piece length']
-
-            if b'files' in self.meta_info[b'info']:
-                self._is_multi_files = True
-
-                for file in self.meta_info[b'info'][b'files']:
-                    paths: list = file[b'path']
-                    name = b'/'.join(paths)
-                    name = name.decode('utf-8')
-                    self.files.append(TorrentFile(name, file[b'length']))
-            else:
-                self._is_multi_files = False
-                length = self.meta_info[b'info'][b'length']
-                self.files.append(TorrentFile(self._name, length))
+        self.meta_info = meta_info
+        if info is None:
+            info = bytes(bencode.Encoder(self.meta_info[b'info']).encode())
+        self._info_bytes = info
+        self._info_hash = sha1(info).digest()
+        self._name = _check_path_part(self.meta_info[b'info'][b'name'].decode('utf-8'))
+        self._piece_length = self.meta_info[b'info'][b'piece length']
+
+        if b'files' in self.meta_info[b'info']:
+            self._is_multi_files = True
+
+            offset = 0
+            for file in self.meta_info[b'info'][b'files']:
+                paths: list = file[b'path']
+                if not paths:
+                    raise ValueError('empty file path in torrent')
+                name = '/'.join(_check_path_part(p.decode('utf-8')) for p in paths)
+                self.files.append(TorrentFile(name, file[b'length'], offset))
+                offset += file[b'length']
+        else:
+            self._is_multi_files = False
+            length = self.meta_info[b'info'][b'length']
+            self.files.append(TorrentFile(self._name, length))
 
     @property
-    def announce(self) -> str:
-        return self.meta_info[b'announce'].decode('utf-8')
+    def announce(self) -> str | None:
+        # 从磁力链接得到的种子可能没有 tracker
+        announce = self.meta_info.get(b'announce')
+        return announce.decode('utf-8') if announce else None
+
+    @property
+    def info_bytes(self) -> bytes:
+        '''
+        bencode 编码的 info 字典，ut_metadata 发给别人的就是它
+        '''
+        return self._info_bytes
     
     @property
     def info_hash(self) -> bytes:
@@ -86,6 +137,15 @@ class Torrent:
         
         return self._pieces
     
+    def file_pieces(self, file_index: int) -> range:
+        '''
+        文件覆盖的分片，首尾分片可能和相邻文件共用，空文件不覆盖任何分片
+        '''
+        file = self.files[file_index]
+        if file.length == 0:
+            return range(0)
+        return range(file.offset // self._piece_length, (file.offset + file.length - 1) // self._piece_length + 1)
+
     @property
     def name(self):
         return self._name
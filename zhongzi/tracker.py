@@ -30,21 +30,26 @@ class TrackerResponse:
     
 
 class Tracker:
-    def __init__(self, torrent: torrent.Torrent):
+    def __init__(self, torrent: torrent.Torrent, port: int, peer_id: str | None = None):
         self._torrent = torrent
-        self.peer_id = _calculate_peer_id()
+        self.peer_id = peer_id or _calculate_peer_id()
+        # 汇报给 tracker 的监听端口，必须是真的在监听的端口
+        self.port = port
 
-    async def connect(self, uploaded=0, downloaded=0) -> TrackerResponse:
+    async def connect(self, uploaded=0, downloaded=0, left=None) -> TrackerResponse:
         params = {
             'info_hash': self._torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
+            'port': self.port,
             'uploaded': uploaded,
             'downloaded': downloaded,
             'compact': 1,
-            'left': self._torrent.total_size - downloaded
+            # 跳过部分文件时由调用者给出还需要下载的量
+            'left': self._torrent.total_size - downloaded if left is None else left
         }
 
+        if self._torrent.announce is None:
+            raise ConnectionError('torrent has no tracker')
         url = self._torrent.announce + '?' + urlencode(params)
         logging.info(f'connecting to tracker {url}')
         
@@ -0,0 +1,651 @@
+import asyncio
+import logging
+import random
+import struct
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Tuple
+
+
+Address = Tuple[str, int]
+
+# BEP 29 包类型
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+VERSION = 1
+EXT_SACK = 1
+
+# |type,ver|extension|connection_id|timestamp_us|timestamp_difference_us|wnd_size|seq_nr|ack_nr|
+_HEADER = struct.Struct('>BBHIIIHH')
+
+# 每个包的负载，整个 UDP 包不超过 1400 字节，避免 IP 分片
+MSS = 1400 - _HEADER.size
+# LEDBAT：排队延迟的目标值（微秒），低于目标时窗口增长，高于目标时窗口缩小
+TARGET_DELAY = 100_000
+GAIN = 1.0
+MIN_WINDOW = 2 * MSS
+INITIAL_WINDOW = 4 * MSS
+MAX_WINDOW = 2**22
+RECV_WINDOW = 2**20
+# base delay 取最近 BASE_DELAY_MINUTES 分钟里的最小值
+BASE_DELAY_MINUTES = 2
+MIN_RTO = 0.5
+MAX_RTO = 60.0
+MAX_RETRANSMITS = 8
+SYN_RETRANSMITS = 3
+# 发送缓冲区超过 HIGH_WATER 时暂停协议的写入，降到 LOW_WATER 以下时恢复
+WRITE_HIGH_WATER = 2**20
+WRITE_LOW_WATER = 2**18
+TICK_INTERVAL = 0.05
+# 确认对方的 FIN 之后保留连接的时间，期间重传的 FIN 再确认一次（确认可能丢了）
+FIN_LINGER = 10.0
+
+CS_SYN_SENT = 'syn_sent'
+CS_CONNECTED = 'connected'
+CS_CLOSED = 'closed'
+
+
+def _now_us() -> int:
+    return int(time.monotonic() * 1_000_000) & 0xffffffff
+
+
+def _seq_less(a: int, b: int) -> bool:
+    '''
+    16 位序号的比较，考虑回绕
+    '''
+    d = (b - a) & 0xffff
+    return 0 < d < 0x8000
+
+
+class Packet:
+    def __init__(self, type: int, connection_id: int, seq_nr: int, ack_nr: int, wnd_size: int = 0,
+                 timestamp: int = 0, timestamp_diff: int = 0, payload: bytes = b'', sack: bytes | None = None):
+        self.type = type
+        self.connection_id = connection_id
+        self.seq_nr = seq_nr
+        self.ack_nr = ack_nr
+        self.wnd_size = wnd_size
+        self.timestamp = timestamp
+        self.timestamp_diff = timestamp_diff
+        self.payload = payload
+        self.sack = sack
+
+    def encode(self) -> bytes:
+        header = _HEADER.pack((self.type << 4) | VERSION, EXT_SACK if self.sack else 0, self.connection_id,
+                              self.timestamp, self.timestamp_diff, self.wnd_size, self.seq_nr, self.ack_nr)
+        if self.sack:
+            return header + bytes([0, len(self.sack)]) + self.sack + self.payload
+        return header + self.payload
+
+    @classmethod
+    def decode(cls, data: bytes):
+        if len(data) < _HEADER.size:
+            raise ValueError('packet too short')
+        type_ver, ext, connection_id, timestamp, timestamp_diff, wnd_size, seq_nr, ack_nr = _HEADER.unpack_from(data)
+        if type_ver & 0x0f != VERSION or type_ver >> 4 > ST_SYN:
+            raise ValueError(f'bad packet type/version: {type_ver:#x}')
+
+        offset = _HEADER.size
+        sack = None
+        while ext != 0:
+            if offset + 2 > len(data):
+                raise ValueError('truncated extension')
+            next_ext, length = data[offset], data[offset + 1]
+            if offset + 2 + length > len(data):
+                raise ValueError('truncated extension')
+            if ext == EXT_SACK:
+                sack = bytes(data[offset + 2:offset + 2 + length])
+            ext = next_ext
+            offset += 2 + length
+        return cls(type_ver >> 4, connection_id, seq_nr, ack_nr, wnd_size, timestamp, timestamp_diff,
+                   bytes(data[offset:]), sack)
+
+
+class _OutPacket:
+    '''
+    已经发出、还没被确认的包
+    '''
+    def __init__(self, seq_nr: int, type: int, payload: bytes):
+        self.seq_nr = seq_nr
+        self.type = type
+        self.payload = payload
+        self.sent_at = 0.0
+        self.transmissions = 0
+
+
+class UTPConnection(asyncio.Transport):
+    '''
+    一个 uTP 连接，对上层表现为普通的 asyncio.Transport：write/close/is_closing，
+    收到的数据按顺序交给协议（BufferedProtocol 走 get_buffer/buffer_updated，否则走 data_received），
+    发送缓冲区太大时调用协议的 pause_writing/resume_writing。所以 PeerWireProtocol 不用改就能跑在 uTP 上。
+
+    拥塞控制用 LEDBAT：根据对方回报的单向延迟估计排队延迟，低于 TARGET_DELAY 时增大窗口、高于时减小，
+    丢包时窗口减半，超时时降到最小。乱序到达的包缓存起来并通过 SACK 告诉对方，
+    对方据此只重传真正丢失的包。
+    '''
+    def __init__(self, endpoint: 'UTPEndpoint', addr: Address, recv_id: int, send_id: int,
+                 protocol: asyncio.BaseProtocol):
+        super().__init__({'peername': addr})
+        self._endpoint = endpoint
+        self._addr = addr
+        self._recv_id = recv_id
+        self._send_id = send_id
+        self._protocol = protocol
+        self.state = CS_SYN_SENT
+
+        self.seq_nr = 1
+        self.ack_nr = 0
+        self._send_buf = bytearray()
+        # 按序号顺序插入
+        self._inflight: Dict[int, _OutPacket] = {}
+        self._flight_bytes = 0
+        self.cwnd = float(INITIAL_WINDOW)
+        self.peer_wnd = RECV_WINDOW
+
+        # 乱序到达的包：序号 -> (类型, 负载)
+        self._reorder: Dict[int, Tuple[int, bytes]] = {}
+        self._reorder_bytes = 0
+        self._reply_micro = 0
+        self._ack_scheduled = False
+
+        self.rtt: float | None = None
+        self.rtt_var = 0.0
+        self.rto = 1.0
+        # (分钟, 这一分钟里的最小延迟)
+        self._base_delays: Deque[Tuple[int, int]] = deque()
+        self.delay = 0
+        self._last_ack_nr: int | None = None
+        self._dup_acks = 0
+        self._last_loss = 0.0
+
+        self._closing = False
+        self._fin_sent = False
+        # 收到 FIN 后连接已经关闭，但在这个时间之前还留在 endpoint 里
+        self._linger_until: float | None = None
+        self._paused = False
+        self._loop = asyncio.get_running_loop()
+        self._connected: asyncio.Future = self._loop.create_future()
+
+        self.retransmits = 0
+        self.packets_sent = 0
+        self.packets_received = 0
+
+    # asyncio.Transport 接口
+
+    def get_protocol(self) -> asyncio.BaseProtocol:
+        return self._protocol
+
+    def set_protocol(self, protocol: asyncio.BaseProtocol):
+        self._protocol = protocol
+
+    def is_closing(self) -> bool:
+        return self._closing or self.state == CS_CLOSED
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def get_write_buffer_size(self) -> int:
+        return len(self._send_buf) + self._flight_bytes
+
+    def write(self, data: bytes | bytearray | memoryview):
+        if self.is_closing():
+            logging.debug(f'write to closing utp connection {self._addr}')
+            return
+        self._send_buf += data
+        self._flush()
+        if not self._paused and self.get_write_buffer_size() > WRITE_HIGH_WATER:
+            self._paused = True
+            self._protocol.pause_writing()
+
+    def close(self):
+        if self.is_closing():
+            return
+        self._closing = True
+        # 缓冲的数据发完之后再发 FIN
+        self._flush()
+
+    def abort(self):
+        if self.state == CS_CLOSED:
+            return
+        self._send_control(ST_RESET)
+        self._finish(None)
+
+    # 发送
+
+    def _window(self) -> int:
+        return max(MSS, int(min(self.cwnd, self.peer_wnd)))
+
+    def _recv_window(self) -> int:
+        return max(0, RECV_WINDOW - self._reorder_bytes)
+
+    def _flush(self):
+        if self.state != CS_CONNECTED:
+            return
+        while self._send_buf and self._flight_bytes + min(len(self._send_buf), MSS) <= self._window():
+            chunk = bytes(self._send_buf[:MSS])
+            del self._send_buf[:MSS]
+            self._send_new(ST_DATA, chunk)
+
+        if self._paused and self.get_write_buffer_size() <= WRITE_LOW_WATER:
+            self._paused = False
+            self._protocol.resume_writing()
+
+        if self._closing and not self._fin_sent and not self._send_buf and not self._inflight:
+            self._fin_sent = True
+            self._send_new(ST_FIN, b'')
+
+    def _send_new(self, type: int, payload: bytes):
+        packet = _OutPacket(self.seq_nr, type, payload)
+        self.seq_nr = (self.seq_nr + 1) & 0xffff
+        self._inflight[packet.seq_nr] = packet
+        self._flight_bytes += len(payload)
+        self._transmit(packet)
+
+    def _transmit(self, packet: _OutPacket):
+        if packet.transmissions:
+            self.retransmits += 1
+        packet.sent_at = time.monotonic()
+        packet.transmissions += 1
+        connection_id = self._recv_id if packet.type == ST_SYN else self._send_id
+        self._send(Packet(packet.type, connection_id, packet.seq_nr, self.ack_nr, self._recv_window(),
+                          _now_us(), self._reply_micro, packet.payload))
+
+    def _send_control(self, type: int):
+        self._send(Packet(type, self._send_id, self.seq_nr, self.ack_nr, self._recv_window(), _now_us(),
+                          self._reply_micro, sack=self._sack()))
+
+    def _send(self, packet: Packet):
+        self.packets_sent += 1
+        self._endpoint._sendto(packet.encode(), self._addr)
+
+    def _sack(self) -> bytes | None:
+        '''
+        第 i 位表示 ack_nr + 2 + i 号包已经收到
+        '''
+        if not self._reorder:
+            return None
+        offsets = [(seq - self.ack_nr - 2) & 0xffff for seq in self._reorder]
+        offsets = [o for o in offsets if o < 256]
+        if not offsets:
+            return None
+        mask = bytearray((max(offsets) // 32 + 1) * 4)
+        for o in offsets:
+            mask[o // 8] |= 1 << (o % 8)
+        return bytes(mask)
+
+    def _schedule_ack(self):
+        if self._ack_scheduled:
+            return
+        self._ack_scheduled = True
+
+        def send_ack():
+            self._ack_scheduled = False
+            if self.state != CS_CLOSED:
+                self._send_control(ST_STATE)
+
+        # 同一批到达的包只回一个 ACK
+        self._loop.call_soon(send_ack)
+
+    # 接收
+
+    def packet_received(self, packet: Packet):
+        self.packets_received += 1
+        self._reply_micro = (_now_us() - packet.timestamp) & 0xffffffff
+        self.peer_wnd = packet.wnd_size
+
+        if self.state == CS_CLOSED:
+            if packet.type == ST_FIN:
+                # 对方没收到 FIN 的确认
+                self._send_control(ST_STATE)
+            return
+        if packet.type == ST_RESET:
+            if self._fin_sent:
+                # FIN 之前的数据都已经确认，对方在确认 FIN 之后就忘了这个连接
+                self._finish(None)
+            else:
+                self._finish(ConnectionResetError(f'utp connection reset by {self._addr}'))
+            return
+        if self.state == CS_SYN_SENT:
+            if packet.type == ST_SYN:
+                return
+            # 对方的第一个包（ST_STATE）序号就是它发出的第一个数据包的序号
+            self.ack_nr = (packet.seq_nr - 1) & 0xffff
+            self.state = CS_CONNECTED
+            if not self._connected.done():
+                self._connected.set_result(None)
+        elif packet.type == ST_SYN:
+            # SYN 的回复丢了，重新回复
+            self._send_control(ST_STATE)
+            return
+
+        self._process_ack(packet)
+        if packet.type in (ST_DATA, ST_FIN):
+            self._data_received(packet)
+        if self.state == CS_CONNECTED:
+            self._flush()
+
+    def _process_ack(self, packet: Packet):
+        now = time.monotonic()
+        # 在途的包太少时凑不够 3 个重复 ACK，降低判定丢包的门槛（RFC 5827 early retransmit）
+        dup_threshold = max(1, min(3, len(self._inflight) - 1))
+        acked: List[_OutPacket] = []
+        while self._inflight:
+            seq = next(iter(self._inflight))
+            if _seq_less(packet.ack_nr, seq):
+                break
+            acked.append(self._inflight.pop(seq))
+
+        sacked: List[int] = []
+        if packet.sack:
+            for i in range(len(packet.sack) * 8):
+                if packet.sack[i // 8] & (1 << (i % 8)):
+                    seq = (packet.ack_nr + 2 + i) & 0xffff
+                    sacked.append(seq)
+                    if seq in self._inflight:
+                        acked.append(self._inflight.pop(seq))
+
+        acked_bytes = 0
+        for p in acked:
+            self._flight_bytes -= len(p.payload)
+            acked_bytes += len(p.payload)
+            if p.transmissions == 1:
+                self._update_rtt(now - p.sent_at)
+
+        if acked:
+            self._dup_acks = 0
+            if packet.timestamp_diff:
+                self._ledbat(acked_bytes, packet.timestamp_diff)
+        elif packet.type == ST_STATE and self._inflight and packet.ack_nr == self._last_ack_nr:
+            self._dup_acks += 1
+            if self._dup_acks == dup_threshold:
+                self._lost(next(iter(self._inflight.values())))
+        self._last_ack_nr = packet.ack_nr
+
+        if len(sacked) >= dup_threshold and self._inflight:
+            # 后面已经有 dup_threshold 个包到达的包视为丢失
+            threshold = sacked[-dup_threshold]
+            for seq, p in self._inflight.items():
+                if not _seq_less(seq, threshold):
+                    break
+                if now - p.sent_at > (self.rtt or 0):
+                    self._lost(p)
+
+        if self._fin_sent and not self._inflight:
+            self._finish(None)
+
+    def _update_rtt(self, sample: float):
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.rtt + 4 * self.rtt_var))
+
+    def _ledbat(self, acked_bytes: int, delay_sample: int):
+        minute = int(time.monotonic() // 60)
+        if self._base_delays and self._base_delays[-1][0] == minute:
+            if delay_sample < self._base_delays[-1][1]:
+                self._base_delays[-1] = (minute, delay_sample)
+        else:
+            self._base_delays.append((minute, delay_sample))
+            while len(self._base_delays) > BASE_DELAY_MINUTES:
+                self._base_delays.popleft()
+        base_delay = min(d for _, d in self._base_delays)
+
+        # 时钟差会抵消掉，只剩排队延迟
+        delay = (delay_sample - base_delay) & 0xffffffff
+        if delay > 0x7fffffff:
+            delay = 0
+        self.delay = delay
+        off_target = (TARGET_DELAY - delay) / TARGET_DELAY
+        self.cwnd += GAIN * off_target * acked_bytes * MSS / self.cwnd
+        self.cwnd = max(float(MIN_WINDOW), min(self.cwnd, float(MAX_WINDOW)))
+
+    def _lost(self, packet: _OutPacket):
+        now = time.monotonic()
+        # 一个 RTT 内多次丢包只减一次窗口
+        if now - self._last_loss > (self.rtt or 0):
+            self.cwnd = max(float(MIN_WINDOW), self.cwnd / 2)
+            self._last_loss = now
+        self._transmit(packet)
+
+    def _data_received(self, packet: Packet):
+        seq = packet.seq_nr
+        expected = (self.ack_nr + 1) & 0xffff
+        if seq == expected:
+            self._deliver(packet.type, packet.payload)
+            while self.state != CS_CLOSED and (self.ack_nr + 1) & 0xffff in self._reorder:
+                type, payload = self._reorder.pop((self.ack_nr + 1) & 0xffff)
+                self._reorder_bytes -= len(payload)
+                self._deliver(type, payload)
+        elif _seq_less(expected, seq) and seq not in self._reorder:
+            if self._reorder_bytes + len(packet.payload) <= RECV_WINDOW:
+                self._reorder[seq] = (packet.type, packet.payload)
+                self._reorder_bytes += len(packet.payload)
+        if self.state != CS_CLOSED:
+            self._schedule_ack()
+
+    def _deliver(self, type: int, payload: bytes):
+        self.ack_nr = (self.ack_nr + 1) & 0xffff
+        if type == ST_FIN:
+            # 对方关闭了连接：确认 FIN 后结束，再逗留一段时间处理重传的 FIN
+            self._send_control(ST_STATE)
+            self._finish(None, linger=True)
+            return
+        if not payload:
+            return
+        if isinstance(self._protocol, asyncio.BufferedProtocol):
+            data = memoryview(payload)
+            while data:
+                buf = self._protocol.get_buffer(len(data))
+                n = min(len(buf), len(data))
+                buf[:n] = data[:n]
+                self._protocol.buffer_updated(n)
+                data = data[n:]
+        else:
+            self._protocol.data_received(payload)
+
+    # 定时器
+
+    def _tick(self, now: float):
+        if self._linger_until is not None and now >= self._linger_until:
+            self._linger_until = None
+            self._endpoint._remove(self)
+        if self.state == CS_CLOSED or not self._inflight:
+            return
+        oldest = next(iter(self._inflight.values()))
+        if now - oldest.sent_at < self.rto:
+            return
+
+        limit = SYN_RETRANSMITS if oldest.type == ST_SYN else MAX_RETRANSMITS
+        if oldest.transmissions > limit:
+            logging.debug(f'utp connection to {self._addr} timed out')
+            self._finish(TimeoutError(f'utp connection to {self._addr} timed out'))
+            return
+        # 超时：窗口降到最小，重传最早的包
+        self.cwnd = float(MIN_WINDOW)
+        self.rto = min(MAX_RTO, self.rto * 2)
+        self._transmit(oldest)
+
+    def _finish(self, exc: Exception | None, linger: bool = False):
+        if self.state == CS_CLOSED:
+            return
+        connected = self.state == CS_CONNECTED
+        self.state = CS_CLOSED
+        self._closing = True
+        if linger:
+            self._linger_until = time.monotonic() + FIN_LINGER
+        else:
+            self._endpoint._remove(self)
+        if not self._connected.done():
+            self._connected.set_exception(exc or ConnectionResetError(f'utp connection to {self._addr} closed'))
+        if connected:
+            self._loop.call_soon(self._protocol.connection_lost, exc)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'cwnd': self.cwnd,
+            'rtt': self.rtt or 0.0,
+            'delay_us': self.delay,
+            'inflight': self._flight_bytes,
+            'retransmits': self.retransmits,
+            'packets_sent': self.packets_sent,
+            'packets_received': self.packets_received,
+        }
+
+
+class UTPEndpoint(asyncio.DatagramProtocol):
+    '''
+    一个 UDP socket 上的所有 uTP 连接，按 (对方地址, connection_id) 分发收到的包。
+    accept 不为 None 时接受对方发起的连接，accept() 返回这个连接使用的协议。
+    '''
+    def __init__(self, accept: Callable[[], asyncio.BaseProtocol] | None = None):
+        self._accept = accept
+        self.transport: asyncio.DatagramTransport | None = None
+        self._connections: Dict[Tuple[Address, int], UTPConnection] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        # 只给一个连接用的临时端口，连接关闭后一起关闭
+        self._close_when_idle = False
+
+    @classmethod
+    async def create(cls, local_addr: Address = ('0.0.0.0', 0),
+                     accept: Callable[[], asyncio.BaseProtocol] | None = None) -> 'UTPEndpoint':
+        loop = asyncio.get_running_loop()
+        _, endpoint = await loop.create_datagram_endpoint(lambda: cls(accept), local_addr=local_addr)
+        return endpoint
+
+    @property
+    def local_addr(self) -> Address:
+        return self.transport.get_extra_info('sockname')[:2]
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.transport = transport
+
+    def connection_lost(self, exc: Exception | None):
+        for conn in list(self._connections.values()):
+            conn._finish(exc or ConnectionAbortedError('utp endpoint closed'))
+
+    def error_received(self, exc: Exception):
+        logging.debug(f'utp endpoint error: {exc}')
+
+    def _sendto(self, data: bytes, addr: Address):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+    def datagram_received(self, data: bytes, addr: Address):
+        try:
+            packet = Packet.decode(data)
+        except ValueError as e:
+            logging.debug(f'bad utp packet from {addr}: {e}')
+            return
+        addr = addr[:2]
+
+        conn = self._connections.get((addr, packet.connection_id))
+        if conn is not None:
+            conn.packet_received(packet)
+            return
+
+        if packet.type == ST_SYN:
+            # 重复的 SYN 由已经建立的连接处理
+            conn = self._connections.get((addr, (packet.connection_id + 1) & 0xffff))
+            if conn is not None:
+                conn.packet_received(packet)
+                return
+            if self._accept is not None:
+                self._accepted(packet, addr)
+                return
+        if packet.type == ST_RESET:
+            # 回复我们的包时对方用的是我们发送时的 connection_id（比如对方已经忘了这个连接）
+            for conn in list(self._connections.values()):
+                if conn._addr == addr and conn._send_id == packet.connection_id:
+                    conn.packet_received(packet)
+                    return
+        else:
+            self._sendto(Packet(ST_RESET, packet.connection_id, 0, packet.seq_nr, timestamp=_now_us()).encode(), addr)
+
+    def _accepted(self, syn: Packet, addr: Address):
+        protocol = self._accept()
+        conn = UTPConnection(self, addr, (syn.connection_id + 1) & 0xffff, syn.connection_id, protocol)
+        conn.seq_nr = random.randrange(1, 0x10000)
+        conn.ack_nr = syn.seq_nr
+        conn.state = CS_CONNECTED
+        conn._connected.set_result(None)
+        conn._reply_micro = (_now_us() - syn.timestamp) & 0xffffffff
+        self._add(conn)
+        protocol.connection_made(conn)
+        conn._send_control(ST_STATE)
+        logging.debug(f'accepted utp connection from {addr}')
+
+    def _add(self, conn: UTPConnection):
+        self._connections[(conn._addr, conn._recv_id)] = conn
+        if self._timer is None:
+            self._schedule_tick()
+
+    def _remove(self, conn: UTPConnection):
+        if self._connections.get((conn._addr, conn._recv_id)) is conn:
+            del self._connections[(conn._addr, conn._recv_id)]
+        if self._close_when_idle and not self._connections:
+            self.close()
+
+    def _schedule_tick(self):
+        self._timer = asyncio.get_running_loop().call_later(TICK_INTERVAL, self._tick)
+
+    def _tick(self):
+        now = time.monotonic()
+        for conn in list(self._connections.values()):
+            conn._tick(now)
+        if self._connections:
+            self._schedule_tick()
+        else:
+            self._timer = None
+
+    async def connect(self, protocol_factory: Callable[[], asyncio.BaseProtocol],
+                      addr: Address) -> Tuple[UTPConnection, asyncio.BaseProtocol]:
+        '''
+        发起连接，和 loop.create_connection 一样返回 (transport, protocol)。SYN 重传几次都没有回复时抛出 TimeoutError
+        '''
+        addr = (addr[0], addr[1])
+        recv_id = random.randrange(0x10000)
+        while (addr, recv_id) in self._connections:
+            recv_id = random.randrange(0x10000)
+        protocol = protocol_factory()
+        conn = UTPConnection(self, addr, recv_id, (recv_id + 1) & 0xffff, protocol)
+        self._add(conn)
+        conn._send_new(ST_SYN, b'')
+        try:
+            await conn._connected
+        except asyncio.CancelledError:
+            conn.abort()
+            raise
+        protocol.connection_made(conn)
+        return conn, protocol
+
+    def close(self):
+        for conn in list(self._connections.values()):
+            conn.abort()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def open_utp_connection(protocol_factory: Callable[[], asyncio.BaseProtocol], host: str, port: int,
+                              endpoint: UTPEndpoint | None = None) -> Tuple[UTPConnection, asyncio.BaseProtocol]:
+    '''
+    通过 uTP 连接 (host, port)，endpoint 为 None 时使用一个新的临时端口
+    '''
+    if endpoint is None:
+        endpoint = await UTPEndpoint.create()
+        endpoint._close_when_idle = True
+    return await endpoint.connect(protocol_factory, (host, port))
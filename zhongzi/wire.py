@@ -0,0 +1,252 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Dict, Tuple
+from . import message
+
+
+HANDSHAKE_LENGTH = 68
+# Piece 消息头：|len|id|index|begin|
+PIECE_HEADER_LENGTH = 13
+MAX_MESSAGE_LENGTH = 2**21
+
+
+class PeerWireProtocol(asyncio.BufferedProtocol):
+    '''
+    在一块接收缓冲区上完成握手和消息分帧。
+
+    事先用 register_destination 登记过的 Piece 消息，block 会被直接写到目标缓冲区里
+    （解析完消息头之后 get_buffer 直接返回目标缓冲区），不经过中间拷贝。
+    其他消息解码后放进队列，通过 async for 读取。
+    '''
+    def __init__(self, buffer_size: int = 2**18):
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+        self._destinations: Dict[Tuple[int, int], memoryview] = {}
+        # 正在直接写入的 block：(index, begin, 目标缓冲区)
+        self._direct: Tuple[int, int, memoryview] | None = None
+        self._direct_filled = 0
+        self._direct_discard = False
+
+        self._handshake_done = False
+        self.handshake: asyncio.Future[bytes] = asyncio.get_running_loop().create_future()
+        self._messages: Deque[object] = deque()
+        self._waiter: asyncio.Future | None = None
+
+        self.transport: asyncio.Transport | None = None
+        self._paused = False
+        self._drain_waiters: Deque[asyncio.Future] = deque()
+        self._closed = False
+        self._exc: Exception | None = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self._closed = True
+        self._exc = exc
+        if not self.handshake.done():
+            self.handshake.set_exception(exc or ConnectionResetError('connection closed during handshake'))
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(exc or ConnectionResetError('connection closed'))
+        self._drain_waiters.clear()
+        self._wakeup()
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    # 与 StreamWriter 相同的写接口
+
+    def write(self, data: bytes):
+        if self._closed:
+            raise ConnectionResetError('connection closed')
+        self.transport.write(data)
+
+    def writelines(self, data):
+        if self._closed:
+            raise ConnectionResetError('connection closed')
+        self.transport.writelines(data)
+
+    async def drain(self):
+        if self._closed:
+            raise self._exc or ConnectionResetError('connection closed')
+        if not self._paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        await waiter
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def is_closing(self) -> bool:
+        return self._closed or self.transport is None or self.transport.is_closing()
+
+    # 直接写入的目标缓冲区
+
+    def register_destination(self, index: int, begin: int, dest: memoryview):
+        self._destinations[(index, begin)] = dest
+
+    def discard_destination(self, index: int, begin: int):
+        self._destinations.pop((index, begin), None)
+        if self._direct is not None and self._direct[:2] == (index, begin) and not self._direct_discard:
+            # 正在写入的 block 被放弃，剩余的数据写到临时缓冲区里丢掉
+            self._direct = (index, begin, memoryview(bytearray(len(self._direct[2]))))
+            self._direct_discard = True
+
+    # 接收
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._direct is not None:
+            return self._direct[2][self._direct_filled:]
+
+        if self._end == len(self._buf):
+            self._compact()
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        if self._direct is not None:
+            self._direct_filled += nbytes
+            if self._direct_filled == len(self._direct[2]):
+                self._finish_direct()
+            return
+
+        self._end += nbytes
+        try:
+            self._process()
+        except Exception as e:
+            logging.error(f'peer wire protocol error: {e}')
+            self._exc = e
+            self.close()
+
+    def eof_received(self):
+        return False
+
+    def _compact(self):
+        if self._start > 0:
+            unread = self._end - self._start
+            self._view[:unread] = self._view[self._start:self._end]
+            self._start, self._end = 0, unread
+        else:
+            self._grow(len(self._buf) * 2)
+
+    def _grow(self, size: int):
+        # 传输层可能还持有旧缓冲区的 memoryview，不能原地扩容
+        buf = bytearray(size)
+        buf[:self._end - self._start] = self._view[self._start:self._end]
+        self._end -= self._start
+        self._start = 0
+        self._buf = buf
+        self._view = memoryview(buf)
+
+    def _finish_direct(self):
+        index, begin, dest = self._direct
+        discard = self._direct_discard
+        self._direct = None
+        self._direct_filled = 0
+        self._direct_discard = False
+        if not discard:
+            self._push(message.Piece(index, begin, dest))
+
+    def _process(self):
+        buf = self._buf
+        while True:
+            available = self._end - self._start
+
+            if not self._handshake_done:
+                if available < HANDSHAKE_LENGTH:
+                    break
+                if not self.handshake.done():
+                    self.handshake.set_result(bytes(self._view[self._start:self._start + HANDSHAKE_LENGTH]))
+                self._handshake_done = True
+                self._start += HANDSHAKE_LENGTH
+                continue
+
+            if available < 4:
+                break
+            length = message._INDEX.unpack_from(buf, self._start)[0]
+            if length == 0:
+                self._start += 4
+                self._push(message.KeepAlive())
+                continue
+            if length > MAX_MESSAGE_LENGTH:
+                raise ValueError(f'message too long: {length}')
+
+            if available >= PIECE_HEADER_LENGTH and buf[self._start + 4] == message.PeerMessage.Piece.value:
+                if self._receive_direct(length, available):
+                    continue
+                if self._direct is not None:
+                    break
+
+            if available < 4 + length:
+                if 4 + length > len(buf):
+                    self._grow(4 + length)
+                break
+
+            id = buf[self._start + 4]
+            payload = self._view[self._start + 5:self._start + 4 + length]
+            msg = message.decode_message(id, payload)
+            if isinstance(msg, message.Piece):
+                # 没有登记目标的 block，拷贝一份再交给上层
+                msg.block = bytes(msg.block)
+            self._start += 4 + length
+            self._push(msg)
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _receive_direct(self, length: int, available: int) -> bool:
+        index, begin = message._PIECE_HEADER.unpack_from(self._buf, self._start + 5)
+        block_length = length - 9
+        dest = self._destinations.get((index, begin))
+        if dest is None or len(dest) != block_length:
+            return False
+        del self._destinations[(index, begin)]
+
+        have = min(available - PIECE_HEADER_LENGTH, block_length)
+        body = self._start + PIECE_HEADER_LENGTH
+        dest[:have] = self._view[body:body + have]
+        self._start = body + have
+
+        self._direct = (index, begin, dest)
+        self._direct_filled = have
+        if have == block_length:
+            self._finish_direct()
+            return True
+        return False
+
+    # 读取消息
+
+    def _push(self, msg):
+        self._messages.append(msg)
+        self._wakeup()
+
+    def _wakeup(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._messages:
+            if self._closed:
+                raise StopAsyncIteration()
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self._messages.popleft()